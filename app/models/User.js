@@ -381,6 +381,10 @@ class User {
       }
 
       const data = await response.json();
+      // A password change revokes every earlier token, this one included
+      if (data.token) {
+        this.token = data.token;
+      }
       if (updates.profilePicture) {
         this.profilePicture = updates.profilePicture;
       }
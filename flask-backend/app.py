@@ -1,35 +1,68 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import requests
 import os
 import random
 from flask_cors import CORS
 from dotenv import load_dotenv
 import time
+import logging
 import threading
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import jwt
-from datetime import datetime, timedelta
+from datetime import timedelta
+
+# Load environment variables before importing modules that read configuration
+load_dotenv()
+
+import logs
+logs.configure()
+
 from database import (
     add_user,
     get_user,
     update_user_settings,
+    update_user_password,
     add_favorite,
     remove_favorite,
     get_user_favorites,
+    get_popular_nearby,
     create_playlist,
     get_user_playlists,
     get_playlist_items,
     add_to_playlist,
     remove_from_playlist,
     delete_playlist,
-    create_connection
+    create_connection,
+    bootstrap_schema,
+    check_schema,
+    start_write_behind,
+    stop_write_behind
 )
 import re
 from sqlite3 import Error
+from password_hashing import hash_password, verify_password, needs_rehash, PasswordHashUnavailable
+from token_cache import token_cache
+import places_api
+import photos
+import fanout
+from concurrent.futures import wait, FIRST_COMPLETED
+from quota import QuotaExceeded
+from rooms import rooms, RoomError
+from session_store import SessionCheckpoint
+from database_config import warm_db_pool, close_db_pool
+import password_hashing
+from metrics import (
+    Counter,
+    Gauge,
+    http_request_duration,
+    prefetch_outcomes,
+    render_latest,
+    CONTENT_TYPE_LATEST
+)
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
+# Sampled per-request summaries, kept apart so they can be filtered or routed separately
+request_logger = logging.getLogger('access')
 
 app = Flask(__name__)
 # Update CORS configuration to properly handle preflight requests
@@ -50,23 +83,126 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 restaurants_cache = {
     # Format: {session_id: {"all": [list_of_restaurants], "index": current_index}}
 }
+# Checkpoints restaurants_cache to disk so sessions survive restarts
+session_checkpoint = SessionCheckpoint(restaurants_cache)
+# Serializes merges into a session's pool from concurrent tile searches and prefetches
+session_merge_lock = threading.Lock()
+
+# Seconds to wait for a Nearby Search before seeding the pool from popular places instead
+NEARBY_SEARCH_TIMEOUT = float(os.getenv('NEARBY_SEARCH_TIMEOUT', 5))
+# Retry-After sent when Google answers OVER_QUERY_LIMIT and no fallback is available
+PLACES_OVER_QUOTA_RETRY_SECONDS = 60
+# Most saved restaurants used to seed a battle when Google is unavailable
+POPULAR_SEED_SIZE = 20
+POPULAR_NEARBY_MAX_LIMIT = 50
+
+# Background prefetch threads still running, so shutdown can wait for them
+background_threads = set()
+background_threads_lock = threading.Lock()
+draining = threading.Event()
+
+Gauge('battle_sessions', 'Battle sessions held in restaurants_cache', lambda: len(restaurants_cache))
+popular_fallbacks = Counter(
+    'battle_popular_fallbacks_total', 'Battle pools seeded from the popular-nearby index instead of Google',
+    ('reason',)
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Reuse the caller's correlation ID (e.g. from a proxy) so logs line up end to end
+    g.request_id = logs.bind_request_id(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def record_request_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        # Label by route pattern rather than raw path to keep cardinality bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        elapsed = time.perf_counter() - start
+        http_request_duration.observe(elapsed, route, request.method, str(response.status_code))
+        request_logger.info('%s %s %s', request.method, route, response.status_code, extra={
+            'method': request.method,
+            'route': route,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 2),
+            **logs.sampled(logs.LOG_REQUEST_SAMPLE_RATE)
+        })
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def clear_request_id(exc):
+    logs.clear_request_id()
+
+def get_bearer_token():
+    """Return the token from an "Authorization: Bearer <token>" header, if any"""
+    return request.headers.get('Authorization', '').partition(' ')[2].strip()
+
+def issue_token(username, issued_at=None):
+    """Sign a session token; its iat, to the millisecond, lets a later revocation reject it"""
+    issued_at = time.time() if issued_at is None else issued_at
+    return jwt.encode({
+        'username': username,
+        'iat': round(issued_at, 3),
+        'exp': int(issued_at + timedelta(days=7).total_seconds())
+    }, app.config['SECRET_KEY'])
+
+def decode_token(token):
+    """Return a token's verified claims, raising jwt.InvalidTokenError if invalid or revoked"""
+    return token_cache.decode(token, app.config['SECRET_KEY'])
+
+def get_optional_username():
+    """Return the username of a valid token on endpoints where auth is optional"""
+    token = get_bearer_token()
+    if not token:
+        return None
+    try:
+        return decode_token(token).get('username')
+    except jwt.InvalidTokenError:
+        return None
+
+def quota_exceeded_response(e):
+    """Degraded response for a Places call refused by the quota manager"""
+    retry_after = max(int(e.retry_after) + 1, 1)
+    response = jsonify({
+        'error': 'Restaurant search is temporarily rate limited, please try again later',
+        'retry_after': retry_after
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def places_error_response(e):
+    """Degraded response for a search Google answered with an error status"""
+    if e.over_quota:
+        # Google's own quota, not ours: the search works again once it resets
+        response = jsonify({
+            'error': 'Restaurant search is temporarily unavailable, please try again later',
+            'retry_after': PLACES_OVER_QUOTA_RETRY_SECONDS
+        })
+        response.headers['Retry-After'] = str(PLACES_OVER_QUOTA_RETRY_SECONDS)
+        return response, 503
+    return jsonify({'error': str(e)}), 502
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization'].split(" ")[1]
+        token = get_bearer_token()
         
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
         
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = get_user(data['username'])
-            if not current_user:
-                return jsonify({'error': 'User not found'}), 401
-        except:
+            data = decode_token(token)
+        except jwt.InvalidTokenError:
+            return jsonify({'error': 'Token is invalid'}), 401
+        
+        current_user = get_user(data.get('username'))
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+
+        if token_cache.revoked_for_user(data, current_user):
             return jsonify({'error': 'Token is invalid'}), 401
         
         return f(current_user, *args, **kwargs)
@@ -85,14 +221,14 @@ def signup():
     if get_user(username):
         return jsonify({'error': 'Username already exists'}), 409
     
-    password_hash = generate_password_hash(password)
+    try:
+        password_hash = hash_password(password)
+    except PasswordHashUnavailable:
+        return jsonify({'error': 'Server busy, please try again'}), 503
     user_id = add_user(username, password_hash, display_name)
     
     if user_id:
-        token = jwt.encode({
-            'username': username,
-            'exp': datetime.utcnow() + timedelta(days=7)
-        }, app.config['SECRET_KEY'])
+        token = issue_token(username)
         
         return jsonify({
             'token': token,
@@ -112,13 +248,17 @@ def login():
         return jsonify({'error': 'Missing username or password'}), 400
     
     user = get_user(username)
-    if not user or not check_password_hash(user['password_hash'], password):
-        return jsonify({'error': 'Invalid username or password'}), 401
+    try:
+        if not user or not verify_password(user['password_hash'], password):
+            return jsonify({'error': 'Invalid username or password'}), 401
+        
+        # Upgrade hashes made with older parameters while we have the plaintext
+        if needs_rehash(user['password_hash']):
+            update_user_password(user['id'], hash_password(password))
+    except PasswordHashUnavailable:
+        return jsonify({'error': 'Server busy, please try again'}), 503
     
-    token = jwt.encode({
-        'username': username,
-        'exp': datetime.utcnow() + timedelta(days=7)
-    }, app.config['SECRET_KEY'])
+    token = issue_token(username)
     
     return jsonify({
         'token': token,
@@ -158,39 +298,41 @@ def handle_user_settings(current_user):
                 ''', (data['displayName'], current_user['id']))
                 conn.commit()
             except Error as e:
-                print(f"Error updating display name: {e}")
+                logger.error("Error updating display name: %s", e)
                 return jsonify({'error': 'Could not update display name'}), 500
             finally:
                 conn.close()
     
     # Handle password update
     if 'password' in data and 'currentPassword' in data:
-        if not check_password_hash(current_user['password_hash'], data['currentPassword']):
-            return jsonify({'error': 'Current password is incorrect'}), 401
+        try:
+            if not verify_password(current_user['password_hash'], data['currentPassword']):
+                return jsonify({'error': 'Current password is incorrect'}), 401
+            
+            new_password_hash = hash_password(data['password'])
+        except PasswordHashUnavailable:
+            return jsonify({'error': 'Server busy, please try again'}), 503
         
-        new_password_hash = generate_password_hash(data['password'])
-        conn = create_connection()
-        if conn is not None:
-            try:
-                c = conn.cursor()
-                c.execute('''
-                    UPDATE users 
-                    SET password_hash = ?
-                    WHERE id = ?
-                ''', (new_password_hash, current_user['id']))
-                conn.commit()
-            except Error as e:
-                print(f"Error updating password: {e}")
-                return jsonify({'error': 'Could not update password'}), 500
-            finally:
-                conn.close()
+        # Every token issued before now stops working, in every worker
+        revoked_at = int(time.time() * 1000)
+        if not update_user_password(current_user['id'], new_password_hash, revoked_at):
+            return jsonify({'error': 'Could not update password'}), 500
+        token_cache.revoke_user(current_user['username'], revoked_at)
+        # Issued strictly after the revocation, which rejects everything at or before it
+        new_token = issue_token(current_user['username'], max(time.time(), (revoked_at + 1) / 1000))
+    else:
+        new_token = None
     
     if update_user_settings(current_user['id'], current_settings):
-        return jsonify({
+        response = {
             'message': 'Settings updated successfully',
             'profilePicture': current_settings.get('profilePicture', 'default'),
             'displayName': data.get('displayName', current_user['display_name'])
-        }), 200
+        }
+        if new_token:
+            # The caller's own token was revoked with the rest
+            response['token'] = new_token
+        return jsonify(response), 200
     return jsonify({'error': 'Could not update settings'}), 500
 
 @app.route('/api/favorites', methods=['GET', 'POST', 'DELETE'])
@@ -215,52 +357,185 @@ def handle_favorites(current_user):
             return jsonify({'message': 'Restaurant removed from favorites'}), 200
         return jsonify({'error': 'Could not remove from favorites'}), 500
 
+def start_background_thread(target, *args):
+    """Run target in a tracked thread; returns False once the worker is draining"""
+    if draining.is_set():
+        return False
+
+    def run():
+        try:
+            target(*args)
+        finally:
+            with background_threads_lock:
+                background_threads.discard(thread)
+
+    # Carry the request's correlation ID into the thread's log records
+    thread = threading.Thread(target=logs.in_current_context(run))
+    with background_threads_lock:
+        background_threads.add(thread)
+    thread.start()
+    return True
+
+def add_unseen_restaurants(session_data, restaurants):
+    """Append restaurants whose place_id the session has not seen or excluded; returns how many were added"""
+    seen = session_data["place_ids"]
+    added = 0
+    for restaurant in restaurants:
+        if restaurant["place_id"] not in seen:
+            seen.add(restaurant["place_id"])
+            session_data["all"].append(restaurant)
+            added += 1
+    return added
+
+def favorite_place_ids(username):
+    """Return the set of place_ids a user has favorited"""
+    user = get_user(username)
+    if not user:
+        return set()
+    return {favorite['place_id'] for favorite in get_user_favorites(user['id'])}
+
+def fill_session_from_tiles(session_id, session_data, latitude, longitude, radius):
+    """Search the ring of tiles around a sparse area concurrently, streaming results into the session.
+
+    Returns the tile search futures; each one merges its results (deduped by
+    place_id) into the session as soon as it completes.
+    """
+    radius = float(radius)
+    username = session_data["username"]
+
+    def search(lat, lng):
+        return fetch_restaurants_from_google(lat, lng, radius, username, session_id,
+                                             timeout=NEARBY_SEARCH_TIMEOUT)[0]
+
+    def merge(future):
+        if future.cancelled():
+            return
+        try:
+            restaurants = future.result()
+        except QuotaExceeded:
+            fanout.tile_searches.inc('quota')
+            return
+        except Exception as e:
+            fanout.tile_searches.inc('quota' if getattr(e, 'over_quota', False) else 'error')
+            logger.warning("Tile search failed: %s", e, extra=logs.sampled())
+            return
+        with session_merge_lock:
+            added = add_unseen_restaurants(session_data, restaurants)
+            if added:
+                # The center search may have added nothing (ZERO_RESULTS, all favorites)
+                session_data["last_fetch_size"] = added
+        fanout.tile_searches.inc('success' if added else 'empty')
+        session_checkpoint.touch(session_id)
+
+    centers = fanout.ring_centers(float(latitude), float(longitude), radius)
+    return fanout.submit_all(search, centers, merge)
+
 def fetch_next_page_async(session_id, next_page_token):
     """Asynchronously fetch the next page of restaurants"""
     try:
-        new_restaurants, new_token = fetch_next_page_restaurants(next_page_token)
-        if new_restaurants and session_id in restaurants_cache:
+        username = restaurants_cache.get(session_id, {}).get("username")
+        new_restaurants, new_token = fetch_next_page_restaurants(next_page_token, username, session_id)
+        prefetch_outcomes.inc('success' if new_restaurants else 'empty')
+        if session_id in restaurants_cache:
             session_data = restaurants_cache[session_id]
-            session_data["all"].extend(new_restaurants)
+            with session_merge_lock:
+                added = add_unseen_restaurants(session_data, new_restaurants)
             session_data["next_page_token"] = new_token
-            session_data["last_fetch_size"] = len(new_restaurants)
+            if added:
+                session_data["last_fetch_size"] = added
             session_data["is_fetching"] = False
+            session_checkpoint.touch(session_id)
+    except QuotaExceeded:
+        # Keep the page token so a later swipe can retry once budget is available
+        prefetch_outcomes.inc('quota')
+        if session_id in restaurants_cache:
+            restaurants_cache[session_id]["is_fetching"] = False
     except Exception as e:
-        print(f"Failed to fetch next page: {str(e)}")
+        prefetch_outcomes.inc('error')
+        logger.warning("Failed to fetch next page: %s", e, extra=logs.sampled())
         if session_id in restaurants_cache:
             restaurants_cache[session_id]["is_fetching"] = False
 
+def start_page_prefetch(session_id, session_data, next_page_token):
+    """Fetch the session's next page in the background unless a fetch is already running"""
+    # Check and mark together, so concurrent swipes start one fetch between them.
+    # Marked before the thread starts: a fast fetch may finish (and clear the
+    # flag) before start_background_thread returns.
+    with session_merge_lock:
+        if session_data.get("is_fetching"):
+            return
+        session_data["is_fetching"] = True
+    if not start_background_thread(fetch_next_page_async, session_id, next_page_token):
+        session_data["is_fetching"] = False
+
 @app.route('/api/nearby-restaurants', methods=['GET'])
 def get_nearby_restaurants():
     session_id = request.args.get('session_id', '')
     latitude = request.args.get('latitude')
     longitude = request.args.get('longitude')
     radius = request.args.get('radius', 1000)  # Default radius: 1000 meters
+    # Leave the user's favorites out of the battle pool
+    exclude_favorites = request.args.get('exclude_favorites', 'false').lower() == 'true'
 
     if not all([session_id, latitude, longitude]):
         return jsonify({"error": "Missing required parameters"}), 400
 
-    if session_id in restaurants_cache:
+    session_data = session_checkpoint.restore(session_id)
+    if session_data is not None:
         # Return the current restaurant pair
-        index = restaurants_cache[session_id]["index"]
-        restaurants = restaurants_cache[session_id]["all"]
+        index = session_data["index"]
+        restaurants = session_data["all"]
         return jsonify({"restaurants": restaurants[index:index+2]}), 200
 
+    username = get_optional_username()
+
+    source = "google"
     try:
-        restaurants, next_page_token = fetch_restaurants_from_google(latitude, longitude, radius)
-        if not restaurants:
-            return jsonify({"error": "No restaurants found nearby"}), 404
+        try:
+            restaurants, next_page_token = fetch_restaurants_from_google(
+                latitude, longitude, radius, username, session_id, timeout=NEARBY_SEARCH_TIMEOUT
+            )
+        except (QuotaExceeded, places_api.PlacesStatusError, requests.RequestException) as e:
+            # Seed the battle from the most saved places nearby rather than failing it
+            restaurants = popular_battle_restaurants(latitude, longitude)
+            if len(restaurants) < 2:
+                raise
+            over_quota = isinstance(e, QuotaExceeded) or getattr(e, 'over_quota', False)
+            popular_fallbacks.inc('quota' if over_quota else 'upstream')
+            next_page_token = None
+            source = "popular"
 
-        restaurants_cache[session_id] = {
-            "all": restaurants,
+        session_data = {
+            "all": [],
+            # Every place_id already in "all" or excluded up front; later pages skip these
+            "place_ids": favorite_place_ids(username) if exclude_favorites and username else set(),
             "index": 3,
             "next_page_token": next_page_token,
-            "last_fetch_size": len(restaurants),
-            "is_fetching": False
+            "is_fetching": False,
+            "username": username
         }
+        session_data["last_fetch_size"] = add_unseen_restaurants(session_data, restaurants)
+        restaurants_cache[session_id] = session_data
+        session_checkpoint.touch(session_id)
 
-        return jsonify({"restaurants": restaurants[:2]}), 200
+        if source == "google" and len(session_data["all"]) < fanout.FANOUT_MIN_RESULTS and not draining.is_set():
+            # Sparse area: widen the search, but answer as soon as there is a pair to show
+            pending = set(fill_session_from_tiles(session_id, session_data, latitude, longitude, radius))
+            deadline = time.monotonic() + NEARBY_SEARCH_TIMEOUT
+            while pending and len(session_data["all"]) < 2 and time.monotonic() < deadline:
+                _, pending = wait(pending, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
 
+        if not session_data["all"]:
+            del restaurants_cache[session_id]
+            session_checkpoint.touch(session_id)
+            return jsonify({"error": "No restaurants found nearby"}), 404
+
+        return jsonify({"restaurants": session_data["all"][:2], "source": source}), 200
+
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e)
+    except places_api.PlacesStatusError as e:
+        return places_error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -272,35 +547,27 @@ def get_next_restaurant():
     if not session_id:
         return jsonify({"error": "Missing session_id"}), 400
 
-    if session_id not in restaurants_cache:
+    session_data = session_checkpoint.restore(session_id)
+    if session_data is None:
         return jsonify({"error": "Session not found"}), 404
 
-    session_data = restaurants_cache[session_id]
     all_restaurants = session_data["all"]
     index = session_data["index"]
     next_page_token = session_data.get("next_page_token")
-    last_fetch_size = session_data.get("last_fetch_size", 20)
-    is_fetching = session_data.get("is_fetching", False)
+    # 0 when no fetch has added anything yet (e.g. an older checkpoint); assume a full page
+    last_fetch_size = session_data.get("last_fetch_size") or 20
 
     # Calculate how many restaurants we've viewed in the current batch
     restaurants_viewed_in_batch = (index + 1) % last_fetch_size
 
     # If we're 5 restaurants away from the end of current batch and have a next page token
-    # and we're not already fetching
-    if (restaurants_viewed_in_batch >= (last_fetch_size - 5) and 
-        next_page_token and 
-        not is_fetching):
-        # Start fetching next page in background
-        session_data["is_fetching"] = True
-        thread = threading.Thread(
-            target=fetch_next_page_async,
-            args=(session_id, next_page_token)
-        )
-        thread.start()
+    if restaurants_viewed_in_batch >= (last_fetch_size - 5) and next_page_token:
+        start_page_prefetch(session_id, session_data, next_page_token)
 
     # Move to the next restaurant, stopping at the end
     next_index = min(index + 1, len(all_restaurants) - 1)
-    restaurants_cache[session_id]["index"] = next_index
+    session_data["index"] = next_index
+    session_checkpoint.touch(session_id)
 
     return jsonify({
         "restaurant": all_restaurants[next_index],
@@ -315,15 +582,13 @@ def reset_session():
     if not session_id:
         return jsonify({"error": "Missing session ID"}), 400
 
-    if session_id in restaurants_cache:
-        del restaurants_cache[session_id]
+    # Also deletes the checkpointed copy, which restore() would otherwise bring back
+    session_checkpoint.discard(session_id)
 
     return jsonify({"success": True, "message": "Session reset successfully"}), 200
 
-def fetch_restaurants_from_google(latitude, longitude, radius):
+def fetch_restaurants_from_google(latitude, longitude, radius, username=None, session_id=None, timeout=None):
     """Fetch restaurants from Google Places API"""
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    
     # Initial request parameters
     params = {
         "location": f"{latitude},{longitude}",
@@ -332,11 +597,15 @@ def fetch_restaurants_from_google(latitude, longitude, radius):
         "key": GOOGLE_API_KEY
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    # Nearby points share cached results (~110m grid)
+    area_key = ('area', round(float(latitude), 3), round(float(longitude), 3), str(radius))
+    data = places_api.get_json('nearby', params, cache_key=area_key, user=username, session_id=session_id,
+                               timeout=timeout)
 
+    if data["status"] == "ZERO_RESULTS":
+        return [], None
     if data["status"] != "OK":
-        raise Exception(f"Google API Error: {data.get('status')}")
+        raise places_api.PlacesStatusError('nearby', data["status"], data.get("error_message"))
 
     # Extract relevant information from each restaurant
     restaurants = []
@@ -359,10 +628,33 @@ def fetch_restaurants_from_google(latitude, longitude, radius):
 
     return restaurants, data.get("next_page_token")
 
-def fetch_next_page_restaurants(next_page_token):
+def catalog_to_battle_restaurant(restaurant):
+    """Convert a catalog row to the restaurant format used in battle sessions"""
+    return {
+        "place_id": restaurant["place_id"],
+        "name": restaurant["name"],
+        "vicinity": restaurant["address"] or "",
+        "rating": restaurant["rating"] or 0,
+        "user_ratings_total": 0,
+        "price_level": restaurant["price"] or 0,
+        "photo_reference": restaurant["picture"] or "",
+        "location": {
+            "lat": restaurant["lat"],
+            "lng": restaurant["lng"]
+        },
+        "open_now": None
+    }
+
+def popular_battle_restaurants(latitude, longitude):
+    """Return the most saved restaurants around a point in battle format"""
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return []
+    return [catalog_to_battle_restaurant(r) for r in get_popular_nearby(latitude, longitude, POPULAR_SEED_SIZE)]
+
+def fetch_next_page_restaurants(next_page_token, username=None, session_id=None):
     """Fetch the next page of restaurants using the page token"""
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    
     # Wait for token to become valid
     time.sleep(2)
     
@@ -371,15 +663,13 @@ def fetch_next_page_restaurants(next_page_token):
         "pagetoken": next_page_token
     }
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    data = places_api.get_json('nearby', params, user=username, session_id=session_id)
 
     if data["status"] != "OK":
         if data["status"] == "INVALID_REQUEST":
             # Token might not be ready yet, wait longer and try one more time
             time.sleep(3)
-            response = requests.get(url, params=params)
-            data = response.json()
+            data = places_api.get_json('nearby', params, user=username, session_id=session_id)
             if data["status"] != "OK":
                 return [], None
         else:
@@ -406,30 +696,144 @@ def fetch_next_page_restaurants(next_page_token):
 
     return restaurants, data.get("next_page_token")
 
+def room_error_response(e):
+    return jsonify({'error': str(e)}), e.status
+
+def room_state_response(room):
+    return app.response_class(room.state(), status=200, mimetype='application/json')
+
+def fetch_room_page_async(room_id, next_page_token):
+    """Add the next page of restaurants to a shared room"""
+    try:
+        new_restaurants, new_token = fetch_next_page_restaurants(next_page_token, session_id=room_id)
+        prefetch_outcomes.inc('success' if new_restaurants else 'empty')
+        rooms.extend(room_id, new_restaurants, new_token)
+    except QuotaExceeded:
+        prefetch_outcomes.inc('quota')
+        rooms.extend(room_id, [], next_page_token)
+    except Exception as e:
+        prefetch_outcomes.inc('error')
+        logger.warning("Failed to fetch next page for room %s: %s", room_id, e, extra=logs.sampled())
+        rooms.extend(room_id, [], None)
+
+def refill_room(room_id, next_page_token):
+    """Fetch the page a room update claimed; a claim left unfetched is taken again after ROOM_FETCH_TIMEOUT"""
+    if next_page_token and not start_background_thread(fetch_room_page_async, room_id, next_page_token):
+        rooms.extend(room_id, [], next_page_token)
+
+@app.route('/api/rooms', methods=['POST'])
+@token_required
+def create_room(current_user):
+    data = request.json or {}
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    radius = data.get('radius', 1000)
+
+    if latitude is None or longitude is None:
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    try:
+        restaurants, next_page_token = fetch_restaurants_from_google(
+            latitude, longitude, radius, current_user['username']
+        )
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e)
+    except places_api.PlacesStatusError as e:
+        return places_error_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if len(restaurants) < 2:
+        return jsonify({'error': 'No restaurants found nearby'}), 404
+
+    room = rooms.create(current_user['username'], restaurants, next_page_token)
+    return room_state_response(room), 201
+
+@app.route('/api/rooms/<room_id>', methods=['GET'])
+@token_required
+def get_room(current_user, room_id):
+    """Return the room state; long-polls and event streams are served by push_server.py"""
+    try:
+        room, next_page_token = rooms.refresh(room_id)
+    except RoomError as e:
+        return room_error_response(e)
+    refill_room(room_id, next_page_token)
+    return room_state_response(room)
+
+@app.route('/api/rooms/<room_id>/join', methods=['POST'])
+@token_required
+def join_room(current_user, room_id):
+    try:
+        room = rooms.join(room_id, current_user['username'])
+    except RoomError as e:
+        return room_error_response(e)
+    return room_state_response(room)
+
+@app.route('/api/rooms/<room_id>/leave', methods=['POST'])
+@token_required
+def leave_room(current_user, room_id):
+    try:
+        rooms.leave(room_id, current_user['username'])
+    except RoomError as e:
+        return room_error_response(e)
+    return jsonify({'success': True}), 200
+
+@app.route('/api/rooms/<room_id>/vote', methods=['POST'])
+@token_required
+def vote_in_room(current_user, room_id):
+    data = request.json or {}
+    place_id = data.get('place_id')
+    if not place_id:
+        return jsonify({'error': 'Missing place_id'}), 400
+
+    try:
+        room, next_page_token = rooms.vote(room_id, current_user['username'], place_id)
+    except RoomError as e:
+        return room_error_response(e)
+
+    refill_room(room_id, next_page_token)
+    return room_state_response(room)
+
+@app.route('/api/popular-nearby', methods=['GET'])
+def popular_nearby():
+    """Most saved restaurants around a point, from the incrementally maintained popularity index"""
+    try:
+        latitude = float(request.args.get('latitude'))
+        longitude = float(request.args.get('longitude'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Missing required parameters"}), 400
+    limit = max(1, min(request.args.get('limit', 10, type=int), POPULAR_NEARBY_MAX_LIMIT))
+
+    return jsonify({"restaurants": get_popular_nearby(latitude, longitude, limit)}), 200
+
 @app.route('/api/photo', methods=['GET'])
 def get_photo():
     """Proxy for Google Places photos to avoid exposing API key to client"""
     photo_reference = request.args.get('photo_reference')
     max_width = request.args.get('max_width', 400)
+    session_id = request.args.get('session_id')
 
     if not photo_reference:
         return jsonify({"error": "Missing photo reference"}), 400
 
-    url = "https://maps.googleapis.com/maps/api/place/photo"
-    params = {
-        "photoreference": photo_reference,
-        "maxwidth": max_width,
-        "key": GOOGLE_API_KEY
-    }
-
-    response = requests.get(url, params=params, stream=True)
+    try:
+        content, status, headers = photos.get_photo(
+            photo_reference,
+            max_width,
+            request.headers.get('Accept'),
+            GOOGLE_API_KEY,
+            user=get_optional_username(),
+            session_id=session_id
+        )
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e)
 
     # Return the image directly
-    return response.content, response.status_code, response.headers.items()
+    return content, status, headers
 
 def parse_google_maps_url(url):
     try:
-        print(f"🔍 Parsing Google Maps URL: {url}")
+        logger.debug("Parsing Google Maps URL %s", url)
         place_id = None
         
         # Clean the URL by removing any trailing slashes or parameters
@@ -437,97 +841,75 @@ def parse_google_maps_url(url):
         
         if 'maps.app.goo.gl' in url or 'goo.gl' in url:
             # Format: https://maps.app.goo.gl/A8mmiPFV7VnvpBJZ9
-            print(f"🔄 Detected shortened URL format: {url}")
-            
             try:
                 # Set up a session to handle redirects manually
                 session = requests.Session()
                 
                 # First, make a HEAD request to get the redirect chain
                 head_response = session.head(url, allow_redirects=True)
-                print(f"🔄 Redirect chain: {head_response.history}")
                 final_url = head_response.url
-                print(f"🔄 Final URL after redirect: {final_url}")
+                logger.debug("Shortened URL redirected %d times to %s", len(head_response.history), final_url)
                 
                 # Now make a GET request to get the actual content
                 response = session.get(final_url)
                 content = response.text
-                print(f"🔄 Got response content length: {len(content)}")
                 
                 # Try different methods to extract the place_id
                 if 'place_id=' in final_url:
                     place_id = final_url.split('place_id=')[1].split('&')[0]
-                    print(f"✅ Extracted place_id from redirected URL query: {place_id}")
                 elif 'data=!3m1!4b1!4m' in content:
                     # Try to find place_id in the page content
                     match = re.search(r'!1s([^!]+)!', content)
                     if match:
                         place_id = match.group(1)
-                        print(f"✅ Extracted place_id from page content: {place_id}")
-                    else:
-                        print("❌ Could not find place_id pattern in page content")
                 elif '/place/' in final_url:
                     parts = final_url.split('/place/')
                     if len(parts) > 1:
                         potential_id = parts[1].split('/')[0]
                         if potential_id.startswith('ChI'):
                             place_id = potential_id
-                            print(f"✅ Extracted place_id from URL path: {place_id}")
-                        else:
-                            print(f"❌ Found path segment but not a valid place_id: {potential_id}")
                 
                 if not place_id:
                     # Try to find coordinates and search nearby
                     coord_match = re.search(r'@(-?\d+\.\d+),(-?\d+\.\d+)', final_url)
                     if coord_match:
                         lat, lng = coord_match.groups()
-                        print(f"✅ Found coordinates: {lat}, {lng}")
                         
                         # Use Places API nearby search
-                        search_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
                         search_params = {
                             "location": f"{lat},{lng}",
                             "radius": "50",  # Very small radius to get exact match
                             "key": GOOGLE_API_KEY
                         }
                         
-                        search_response = requests.get(search_url, params=search_params)
-                        search_data = search_response.json()
+                        search_data = places_api.get_json('nearby', search_params, cache_key=('point', lat, lng))
                         
                         if search_data.get("status") == "OK" and search_data.get("results"):
                             place_id = search_data["results"][0]["place_id"]
-                            print(f"✅ Found place_id from nearby search: {place_id}")
                         else:
-                            print(f"❌ Nearby search failed: {search_data.get('status')}")
-                    else:
-                        print("❌ Could not find coordinates in URL")
+                            logger.debug("Nearby search for %s,%s returned %s", lat, lng, search_data.get('status'))
                 
             except requests.exceptions.RequestException as e:
-                print(f"❌ Error following redirect: {str(e)}")
                 raise ValueError(f"Failed to follow redirect: {str(e)}")
             
         elif 'place_id=' in url:
             # Format: https://www.google.com/maps/place/?q=place_id:ChIJ...
             place_id = url.split('place_id=')[1].split('&')[0]
-            print(f"✅ Extracted place_id from query parameter: {place_id}")
         else:
-            print(f"❌ Unsupported URL format: {url}")
             raise ValueError("Unsupported URL format")
         
         if not place_id:
-            print("❌ Could not extract place_id using any method")
             raise ValueError("Could not extract place_id from URL")
         
         # Validate the place_id format
         if not place_id.startswith('ChI'):
-            print(f"❌ Invalid place_id format: {place_id}")
             raise ValueError("Invalid place_id format")
             
-        print(f"✅ Final place_id: {place_id}")
+        logger.debug("Parsed place_id %s from %s", place_id, url)
         return place_id
         
     except Exception as e:
-        print(f"❌ Error parsing Google Maps URL: {str(e)}")
+        logger.info("Could not parse Google Maps URL %s: %s", url, e)
         raise ValueError(f"Failed to parse Google Maps URL: {str(e)}")
 
 @app.route('/api/playlists', methods=['GET', 'POST'])
@@ -591,15 +973,18 @@ def search_restaurants(current_user):
     
     try:
         # Use Google Places Autocomplete API
-        url = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
         params = {
             "input": query,
             "types": "restaurant",
             "key": GOOGLE_API_KEY
         }
         
-        response = requests.get(url, params=params, timeout=10)
-        data = response.json()
+        data = places_api.get_json(
+            'autocomplete', params,
+            cache_key=query.strip().lower(),
+            user=current_user['username'],
+            timeout=10
+        )
         
         if data["status"] != "OK":
             error_message = data.get("error_message", "Unknown error")
@@ -616,8 +1001,10 @@ def search_restaurants(current_user):
         
         return jsonify({'results': results}), 200
     
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e)
     except Exception as e:
-        print(f"❌ Exception in search_restaurants: {str(e)}")
+        logger.exception("Exception in search_restaurants")
         return jsonify({'error': f'Failed to search restaurants: {str(e)}'}), 500
 
 @app.route('/api/favorites/manual', methods=['POST'])
@@ -627,27 +1014,27 @@ def add_manual_favorite(current_user):
     place_id = data.get('place_id')
     
     if not place_id:
-        print("❌ No place_id provided in request")
         return jsonify({'error': 'Place ID is required'}), 400
     
     try:
         # Make a request to Google Places API to get restaurant details
-        url = "https://maps.googleapis.com/maps/api/place/details/json"
         params = {
             "place_id": place_id,
             "fields": "name,formatted_address,rating,price_level,photos",
             "key": GOOGLE_API_KEY
         }
         
-        print(f"🔄 Making Places API request with params: {params}")
         try:
-            response = requests.get(url, params=params, timeout=10)
-            data = response.json()
-            print(f"🔄 Places API response status: {data.get('status')}")
+            data = places_api.get_json(
+                'details', params,
+                cache_key=place_id,
+                user=current_user['username'],
+                timeout=10
+            )
             
             if data["status"] != "OK":
                 error_message = data.get("error_message", "Unknown error")
-                print(f"❌ Places API error: {error_message}")
+                logger.warning("Places details for %s returned %s: %s", place_id, data["status"], error_message)
                 return jsonify({'error': f'Could not fetch restaurant details: {error_message}'}), 400
             
             result = data["result"]
@@ -660,16 +1047,17 @@ def add_manual_favorite(current_user):
                 "picture": result.get("photos", [{}])[0].get("photo_reference", "") if result.get("photos") else ""
             }
             
-            print(f"✅ Adding favorite with data: {restaurant_data}")
             if add_favorite(current_user['id'], restaurant_data):
                 return jsonify({'message': 'Restaurant added to favorites'}), 201
             return jsonify({'error': 'Could not add to favorites'}), 500
+        except QuotaExceeded as e:
+            return quota_exceeded_response(e)
         except requests.exceptions.RequestException as e:
-            print(f"❌ Error making Places API request: {str(e)}")
+            logger.warning("Error making Places API request: %s", e)
             return jsonify({'error': f'Failed to connect to Google Places API: {str(e)}'}), 500
         
     except Exception as e:
-        print(f"❌ Exception in add_manual_favorite: {str(e)}")
+        logger.exception("Exception in add_manual_favorite")
         return jsonify({'error': f'Failed to process request: {str(e)}'}), 500
 
 @app.route('/api/config/google-api-key', methods=['GET'])
@@ -680,6 +1068,63 @@ def get_google_api_key():
         return jsonify({'error': 'Google API key not configured'}), 500
     return jsonify({'apiKey': api_key})
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    metrics_token = os.getenv('METRICS_TOKEN')
+    if metrics_token and request.headers.get('Authorization', '').partition(' ')[2] != metrics_token:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return render_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+def warm_up():
+    """Open pooled resources in a freshly started worker before it accepts traffic"""
+    warm_db_pool()
+    if not check_schema():
+        # Every query touching a newer column would fail; refuse to serve until migrated
+        raise RuntimeError("Database schema is behind this code; run 'flask init-db' first")
+    places_api.warm_up()
+    password_hashing.warm_up()
+    start_write_behind()
+    session_checkpoint.start()
+
+def begin_drain():
+    """Stop starting background work, so in-flight requests finish"""
+    draining.set()
+
+def shutdown(timeout=5):
+    """Drain background work and close pooled resources when a worker exits"""
+    begin_drain()
+    deadline = time.monotonic() + timeout
+    with background_threads_lock:
+        pending = list(background_threads)
+    for thread in pending:
+        thread.join(max(deadline - time.monotonic(), 0))
+    with background_threads_lock:
+        if background_threads:
+            logger.warning("Shutting down with %d background fetches still running", len(background_threads))
+    fanout.shutdown(wait=False)
+    photos.shutdown()
+    stop_write_behind()
+    session_checkpoint.stop()
+    close_db_pool()
+    places_api.close()
+    password_hashing.shutdown()
+    logs.stop()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema; run once per deployment"""
+    print(f"Schema is at version {bootstrap_schema()}")
+
 if __name__ == '__main__':
+    # The development server bootstraps its own SQLite schema
+    bootstrap_schema()
+    start_write_behind()
+    session_checkpoint.start()
+    places_api.refresher.start()
     port = int(os.environ.get('PORT', 5001))
+    # The reloader's parent process only watches files; push from the serving child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        import push_server
+        push_server.start_in_thread(port + 1)
     app.run(host='0.0.0.0', port=port, debug=True)
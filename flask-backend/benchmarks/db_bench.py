@@ -0,0 +1,345 @@
+"""Micro-benchmarks for the helpers in database.py.
+
+Seeds synthetic users, favorites, playlists and playlist items at several
+scales, then measures the latency and memory allocations of each helper.
+Every backend/scale combination runs in a fresh child process against a
+fresh database, so results do not depend on import-time state.
+
+Usage:
+    python benchmarks/db_bench.py --scales 1000,10000,100000 --output bench.json
+    python benchmarks/db_bench.py --backend postgres --pg-url postgresql://localhost/bench
+    python benchmarks/db_bench.py --compare old.json --output new.json
+
+    # Popularity index reads and the save_count updates on already popular places
+    python benchmarks/db_bench.py --only get_popular_nearby,add_favorite_popular,add_to_playlist_popular
+
+    # Planning time saved by prepared statements on the auth/profile reads
+    python benchmarks/db_bench.py --backend postgres --only get_user,get_user_favorites --no-prepared --output plain.json
+    python benchmarks/db_bench.py --backend postgres --only get_user,get_user_favorites --compare plain.json
+
+Scales count rows in each of favorites and playlist_items. The PostgreSQL
+run creates a throwaway schema in the given database and drops it afterwards.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows per user in favorites and in playlist_items
+ROWS_PER_USER = 100
+PLAYLISTS_PER_USER = 2
+# Restaurants are spread over these city centres, +/- CITY_SPREAD degrees, so
+# the popularity index has busy geotiles as it would in production
+CITIES = [(40.71, -74.01), (34.05, -118.24), (41.88, -87.63), (51.51, -0.13), (35.68, 139.69)]
+CITY_SPREAD = 0.2
+# Seeded restaurants that the *_popular cases keep saving, i.e. hot save_count rows
+POPULAR_PLACES = 20
+
+def _percentile(sorted_values, pct):
+    index = min(int(pct / 100 * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def _restaurant(rng, n):
+    lat, lng = rng.choice(CITIES)
+    return {
+        'place_id': f'ChIJbench{n:010d}',
+        'name': f'Bench Restaurant {n}',
+        'picture': f'photo{n}',
+        'address': f'{n} Benchmark St',
+        'rating': round(rng.uniform(1, 5), 1),
+        'price': rng.randint(1, 4),
+        'lat': lat + rng.uniform(-CITY_SPREAD, CITY_SPREAD),
+        'lng': lng + rng.uniform(-CITY_SPREAD, CITY_SPREAD)
+    }
+
+def _near_city(rng):
+    lat, lng = rng.choice(CITIES)
+    return (lat + rng.uniform(-CITY_SPREAD, CITY_SPREAD), lng + rng.uniform(-CITY_SPREAD, CITY_SPREAD))
+
+def seed(database, database_config, scale, rng):
+    """Bulk insert synthetic rows and return ids used by the benchmarks"""
+    users = max(scale // ROWS_PER_USER, 10)
+    with database_config.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            'INSERT INTO users (id, username, password_hash, display_name) VALUES (%s, %s, %s, %s)',
+            [(u, f'user{u}', 'x', f'User {u}') for u in range(1, users + 1)]
+        )
+        cursor.executemany(
+            'INSERT INTO playlists (id, user_id, name) VALUES (%s, %s, %s)',
+            [(u * PLAYLISTS_PER_USER + p, u, f'Playlist {p}')
+             for u in range(1, users + 1) for p in range(PLAYLISTS_PER_USER)]
+        )
+        batch = []
+        for n in range(scale):
+            r = _restaurant(rng, n)
+            user_id = n % users + 1
+            # Spread each user's rows evenly over that user's playlists
+            playlist_id = user_id * PLAYLISTS_PER_USER + (n // users) % PLAYLISTS_PER_USER
+            # Each restaurant is in one favorite and one playlist item, so save_count is 2
+            batch.append((user_id, playlist_id, r['place_id'], r['name'], r['picture'], r['address'],
+                          r['rating'], r['price'], r['lat'], r['lng'], database.geotile(r['lat'], r['lng']), 2))
+            if len(batch) >= 10000 or n == scale - 1:
+                cursor.executemany(
+                    'INSERT INTO restaurants (place_id, name, picture, address, rating, price, lat, lng, tile, save_count) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', [row[2:] for row in batch]
+                )
+                cursor.executemany(
+                    'INSERT INTO favorites (user_id, place_id) VALUES (%s, %s)',
+                    [(row[0], row[2]) for row in batch]
+                )
+                cursor.executemany(
+                    'INSERT INTO playlist_items (playlist_id, place_id) VALUES (%s, %s)',
+                    [(row[1], row[2]) for row in batch]
+                )
+                batch = []
+        if database_config.ENV == 'production':
+            # Keep the id sequences ahead of the explicit ids inserted above
+            for table in ('users', 'playlists'):
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+        else:
+            cursor.execute('ANALYZE')
+        conn.commit()
+    return users
+
+def benchmark_cases(database, users, scale, rng):
+    """Return (name, setup, call) triples; setup returns the args for one call"""
+    counter = iter(range(10 ** 9))
+
+    def random_user():
+        return rng.randint(1, users)
+
+    def new_restaurant():
+        return _restaurant(rng, 10 ** 8 + next(counter))
+
+    def fresh_playlist():
+        return (database.create_playlist(random_user(), 'temp'),)
+
+    def favorited():
+        user_id = random_user()
+        restaurant = new_restaurant()
+        database.add_favorite(user_id, restaurant)
+        return (user_id, restaurant['place_id'])
+
+    def popular_place():
+        # A sparse record, as for a manual save, so the seeded details are kept
+        n = rng.randrange(min(POPULAR_PLACES, scale))
+        return {'place_id': f'ChIJbench{n:010d}', 'name': f'Bench Restaurant {n}'}
+
+    def new_fan():
+        return database.add_user(f'fan{next(counter)}', 'x', 'Fan')
+
+    def popular_favorite():
+        return (new_fan(), popular_place())
+
+    def popular_playlist_item():
+        return (database.create_playlist(new_fan(), 'Fan playlist'), popular_place())
+
+    def playlisted():
+        playlist_id = random_user() * PLAYLISTS_PER_USER
+        restaurant = new_restaurant()
+        database.add_to_playlist(playlist_id, restaurant)
+        return (playlist_id, restaurant['place_id'])
+
+    return [
+        ('get_user', lambda: (f'user{random_user()}',), database.get_user),
+        ('add_user', lambda: (f'new{next(counter)}', 'x', 'New User'), database.add_user),
+        ('update_user_settings', lambda: (random_user(), {'profilePicture': 'sushi'}), database.update_user_settings),
+        ('get_user_favorites', lambda: (random_user(),), database.get_user_favorites),
+        ('add_favorite', lambda: (random_user(), new_restaurant()), database.add_favorite),
+        ('remove_favorite', favorited, database.remove_favorite),
+        ('create_playlist', lambda: (random_user(), 'Bench playlist'), database.create_playlist),
+        ('get_user_playlists', lambda: (random_user(),), database.get_user_playlists),
+        ('get_playlist_items', lambda: (random_user() * PLAYLISTS_PER_USER,), database.get_playlist_items),
+        ('add_to_playlist', lambda: (random_user() * PLAYLISTS_PER_USER, new_restaurant()), database.add_to_playlist),
+        ('remove_from_playlist', playlisted, database.remove_from_playlist),
+        ('delete_playlist', fresh_playlist, database.delete_playlist),
+        ('get_popular_nearby', lambda: _near_city(rng) + (10,), database.get_popular_nearby),
+        ('add_favorite_popular', popular_favorite, database.add_favorite),
+        ('add_to_playlist_popular', popular_playlist_item, database.add_to_playlist)
+    ]
+
+def measure(setup, call, iterations, warmup):
+    """Time `call` over fresh setup args, then measure its peak allocation"""
+    for _ in range(warmup):
+        call(*setup())
+
+    timings = []
+    for _ in range(iterations):
+        args = setup()
+        start = time.perf_counter()
+        call(*args)
+        timings.append(time.perf_counter() - start)
+
+    # Allocation pass is separate because tracing slows every allocation down
+    alloc_samples = min(iterations, 50)
+    peaks = []
+    tracemalloc.start()
+    for _ in range(alloc_samples):
+        args = setup()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        call(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': sum(timings) / len(timings) * 1e6,
+        'p50_us': _percentile(timings, 50) * 1e6,
+        'p95_us': _percentile(timings, 95) * 1e6,
+        'p99_us': _percentile(timings, 99) * 1e6,
+        'ops_per_sec': len(timings) / sum(timings),
+        'peak_alloc_bytes': sum(peaks) / len(peaks)
+    }
+
+def run_child(args):
+    """Benchmark one backend at one scale; expects the environment prepared by the parent"""
+    sys.path.insert(0, BACKEND_DIR)
+    import database_config
+    import database
+
+    database.bootstrap_schema()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    users = seed(database, database_config, args.scale, rng)
+    seed_seconds = time.perf_counter() - started
+
+    results = []
+    for name, setup, call in benchmark_cases(database, users, args.scale, rng):
+        if args.only and name not in args.only:
+            continue
+        row = {'backend': args.backend, 'scale': args.scale, 'function': name}
+        row.update(measure(setup, call, args.iterations, args.warmup))
+        results.append(row)
+    json.dump({'seed_seconds': seed_seconds, 'users': users, 'results': results}, sys.stdout)
+
+def _pg_schema_url(url, schema):
+    separator = '&' if '?' in url else '?'
+    return f'{url}{separator}options=-csearch_path%3D{schema}'
+
+def _pg_execute(url, statement):
+    import psycopg2
+    conn = psycopg2.connect(url)
+    try:
+        conn.autocommit = True
+        conn.cursor().execute(statement)
+    finally:
+        conn.close()
+
+def run_one(args, backend, scale):
+    env = dict(os.environ)
+    child_args = [sys.executable, os.path.abspath(__file__), '--child', '--backend', backend,
+                  '--scale', str(scale), '--iterations', str(args.iterations),
+                  '--warmup', str(args.warmup), '--seed', str(args.seed)]
+    if args.only:
+        child_args += ['--only', ','.join(args.only)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        schema = None
+        if backend == 'sqlite':
+            env['FLASK_ENV'] = 'development'
+            env['SQLITE_DATABASE'] = os.path.join(workdir, 'bench.db')
+        else:
+            schema = f'bench_{os.getpid()}_{scale}'
+            _pg_execute(args.pg_url, f'CREATE SCHEMA {schema}')
+            env['FLASK_ENV'] = 'production'
+            env['DATABASE_URL'] = _pg_schema_url(args.pg_url, schema)
+        if args.no_prepared:
+            env['DB_PREPARED_STATEMENTS'] = '0'
+        try:
+            output = subprocess.run(child_args, env=env, cwd=workdir, check=True,
+                                    stdout=subprocess.PIPE, text=True).stdout
+        finally:
+            if schema:
+                _pg_execute(args.pg_url, f'DROP SCHEMA {schema} CASCADE')
+    # Helpers may print errors; the report is the last line of output
+    return json.loads(output.strip().splitlines()[-1])
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current):
+    """Print mean latency changes against an earlier report"""
+    before = {(r['backend'], r['scale'], r['function']): r for r in previous['results']}
+    print(f"\n{'backend':<10}{'scale':>9} {'function':<22}{'before us':>11}{'after us':>11}{'change':>9}")
+    for row in current['results']:
+        old = before.get((row['backend'], row['scale'], row['function']))
+        if old:
+            change = (row['mean_us'] - old['mean_us']) / old['mean_us'] * 100
+            print(f"{row['backend']:<10}{row['scale']:>9} {row['function']:<22}"
+                  f"{old['mean_us']:>11.1f}{row['mean_us']:>11.1f}{change:>+8.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('sqlite', 'postgres', 'both'), default='sqlite')
+    parser.add_argument('--pg-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help='PostgreSQL-compatible database to create a throwaway schema in')
+    parser.add_argument('--scales', default='1000,10000,100000', help='comma separated row counts, e.g. 1000,1000000')
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', type=lambda v: v.split(','), help='comma separated function names')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    parser.add_argument('--no-prepared', action='store_true',
+                        help='send the hot queries unprepared (PostgreSQL only) to measure planning time')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    backends = ['sqlite', 'postgres'] if args.backend == 'both' else [args.backend]
+    if 'postgres' in backends and not args.pg_url:
+        parser.error('--pg-url (or BENCH_DATABASE_URL) is required for the postgres backend')
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'iterations': args.iterations,
+            'prepared_statements': not args.no_prepared
+        },
+        'seeding': [],
+        'results': []
+    }
+    print(f"{'backend':<10}{'scale':>9} {'function':<22}{'mean us':>10}{'p50 us':>10}{'p95 us':>10}{'ops/s':>10}{'alloc B':>10}")
+    for backend in backends:
+        for scale in (int(s) for s in args.scales.split(',')):
+            result = run_one(args, backend, scale)
+            report['seeding'].append({'backend': backend, 'scale': scale, 'users': result['users'],
+                                      'seed_seconds': result['seed_seconds']})
+            for row in result['results']:
+                report['results'].append(row)
+                print(f"{backend:<10}{scale:>9} {row['function']:<22}{row['mean_us']:>10.1f}{row['p50_us']:>10.1f}"
+                      f"{row['p95_us']:>10.1f}{row['ops_per_sec']:>10.0f}{row['peak_alloc_bytes']:>10.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Local stand-in for the Google Places web service.
+
+Serves deterministic Nearby (with page tokens), Details, Autocomplete and
+Photo responses so the backend can be load tested without spending quota.
+
+Usage:
+    python benchmarks/fake_places.py --port 8765 --latency-ms 80
+    PLACES_BASE_URL=http://127.0.0.1:8765/maps/api/place python app.py
+"""
+import io
+import argparse
+import hashlib
+import random
+import threading
+import time
+from functools import lru_cache
+from flask import Flask, request, jsonify, Response
+from PIL import Image
+
+app = Flask(__name__)
+
+# Tunables, overridden from the command line
+settings = {
+    'latency_ms': 50.0,      # mean simulated upstream latency
+    'jitter_ms': 20.0,       # uniform jitter added to the latency
+    'token_delay': 2.0,      # seconds before a next_page_token becomes valid
+    'page_size': 20,
+    'max_pages': 3,          # Google returns at most 60 results per search
+    'photo_bytes': 40000     # approximate size of an encoded photo
+}
+
+# Google serves photos up to 1600px wide and scales them down to `maxwidth`
+PHOTO_MAX_WIDTH = 1600
+# Encoder qualities tried, best first, when fitting a photo to photo_bytes
+PHOTO_QUALITIES = (95, 85, 75, 60, 45, 30, 15)
+
+# Issued page tokens: token -> (issued_at, lat, lng, radius, page)
+page_tokens = {}
+page_tokens_lock = threading.Lock()
+
+# Simple request counters, shown at /stats
+stats = {}
+stats_lock = threading.Lock()
+
+def _count(endpoint):
+    with stats_lock:
+        stats[endpoint] = stats.get(endpoint, 0) + 1
+
+def _simulate_latency():
+    delay = settings['latency_ms'] + random.uniform(0, settings['jitter_ms'])
+    time.sleep(delay / 1000)
+
+def _place(lat, lng, radius, n):
+    """Build one deterministic place result near a location"""
+    seed = hashlib.sha1(f'{lat:.3f},{lng:.3f},{n}'.encode()).hexdigest()
+    rng = random.Random(seed)
+    # Spread results over the search radius (1 degree latitude ~ 111km)
+    spread = float(radius) / 111000
+    return {
+        'place_id': 'ChIJfake' + seed[:20],
+        'name': f'Fake Restaurant {seed[:6]}',
+        'vicinity': f'{rng.randint(1, 999)} Benchmark St',
+        'rating': round(rng.uniform(2.5, 5.0), 1),
+        'user_ratings_total': rng.randint(0, 5000),
+        'price_level': rng.randint(1, 4),
+        'photos': [{'photo_reference': 'fakephoto' + seed[20:36], 'width': 1600, 'height': 1200}],
+        'geometry': {'location': {
+            'lat': lat + rng.uniform(-spread, spread),
+            'lng': lng + rng.uniform(-spread, spread)
+        }},
+        'opening_hours': {'open_now': rng.random() > 0.2}
+    }
+
+def _nearby_page(lat, lng, radius, page):
+    size = settings['page_size']
+    results = [_place(lat, lng, radius, page * size + i) for i in range(size)]
+    body = {'status': 'OK', 'results': results}
+    if page + 1 < settings['max_pages']:
+        token = hashlib.sha1(f'{lat},{lng},{radius},{page},{time.time()}'.encode()).hexdigest()
+        with page_tokens_lock:
+            page_tokens[token] = (time.time(), lat, lng, radius, page + 1)
+        body['next_page_token'] = token
+    return body
+
+@app.route('/maps/api/place/nearbysearch/json')
+def nearby():
+    _count('nearby')
+    _simulate_latency()
+
+    token = request.args.get('pagetoken')
+    if token:
+        with page_tokens_lock:
+            entry = page_tokens.get(token)
+        if entry is None:
+            return jsonify({'status': 'INVALID_REQUEST', 'results': []})
+        issued_at, lat, lng, radius, page = entry
+        # Like Google, a token is rejected until it has had time to become valid
+        if time.time() - issued_at < settings['token_delay']:
+            return jsonify({'status': 'INVALID_REQUEST', 'results': []})
+        with page_tokens_lock:
+            page_tokens.pop(token, None)
+        return jsonify(_nearby_page(lat, lng, radius, page))
+
+    location = request.args.get('location', '')
+    try:
+        lat, lng = (float(v) for v in location.split(','))
+    except ValueError:
+        return jsonify({'status': 'INVALID_REQUEST', 'results': []})
+    radius = request.args.get('radius', 1000)
+    return jsonify(_nearby_page(lat, lng, radius, 0))
+
+@app.route('/maps/api/place/details/json')
+def details():
+    _count('details')
+    _simulate_latency()
+    place_id = request.args.get('place_id', '')
+    rng = random.Random(place_id)
+    return jsonify({'status': 'OK', 'result': {
+        'name': f'Fake Restaurant {place_id[-6:]}',
+        'formatted_address': f'{rng.randint(1, 999)} Benchmark St, Testville',
+        'rating': round(rng.uniform(2.5, 5.0), 1),
+        'price_level': rng.randint(1, 4),
+        'photos': [{'photo_reference': 'fakephoto' + place_id[-16:]}]
+    }})
+
+@app.route('/maps/api/place/autocomplete/json')
+def autocomplete():
+    _count('autocomplete')
+    _simulate_latency()
+    query = request.args.get('input', '')
+    predictions = []
+    for i in range(5):
+        digest = hashlib.sha1(f'{query}{i}'.encode()).hexdigest()
+        predictions.append({
+            'place_id': 'ChIJfake' + digest[:20],
+            'structured_formatting': {
+                'main_text': f'{query.title()} Place {i + 1}',
+                'secondary_text': f'{i + 1} Benchmark St, Testville'
+            }
+        })
+    return jsonify({'status': 'OK', 'predictions': predictions})
+
+@lru_cache(maxsize=256)
+def _photo_jpeg(reference, width):
+    """A decodable 4:3 JPEG, deterministic per reference, close to photo_bytes in size"""
+    seed = hashlib.sha1(reference.encode()).digest()
+    # Upscaled noise compresses roughly like a photo, unlike flat colour
+    noise = Image.frombytes('RGB', (40, 30), random.Random(seed).randbytes(40 * 30 * 3))
+    image = noise.resize((width, width * 3 // 4), Image.BICUBIC)
+    for quality in PHOTO_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality)
+        if buffer.tell() <= settings['photo_bytes']:
+            break
+    return buffer.getvalue()
+
+@app.route('/maps/api/place/photo')
+def photo():
+    _count('photo')
+    _simulate_latency()
+    reference = request.args.get('photoreference', '')
+    width = min(request.args.get('maxwidth', PHOTO_MAX_WIDTH, type=int), PHOTO_MAX_WIDTH)
+    return Response(_photo_jpeg(reference, max(width, 16)), mimetype='image/jpeg')
+
+@app.route('/stats')
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=settings['latency_ms'])
+    parser.add_argument('--jitter-ms', type=float, default=settings['jitter_ms'])
+    parser.add_argument('--token-delay', type=float, default=settings['token_delay'])
+    parser.add_argument('--page-size', type=int, default=settings['page_size'])
+    parser.add_argument('--max-pages', type=int, default=settings['max_pages'])
+    parser.add_argument('--photo-bytes', type=int, default=settings['photo_bytes'])
+    args = parser.parse_args()
+
+    settings.update(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        token_delay=args.token_delay,
+        page_size=args.page_size,
+        max_pages=args.max_pages,
+        photo_bytes=args.photo_bytes
+    )
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
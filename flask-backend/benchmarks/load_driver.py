@@ -0,0 +1,187 @@
+"""Load driver that replays battle-flow user journeys against the backend.
+
+Each simulated user signs up (or logs in), opens a battle session, swipes
+through restaurants while fetching photos and liking some of them, lists
+favorites and resets the session, then starts over until the run ends.
+
+Usage (with benchmarks/fake_places.py running and the backend pointed at it):
+    PLACES_BASE_URL=http://127.0.0.1:8765/maps/api/place PLACES_QUOTA_ENABLED=0 python app.py
+    python benchmarks/load_driver.py --base-url http://127.0.0.1:5001 --users 20 --duration 60
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+import requests
+
+class Recorder:
+    """Collects latency samples and errors per endpoint"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+class User:
+    """One simulated client with its own HTTP connection pool"""
+
+    def __init__(self, base_url, recorder, args, rng):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.args = args
+        self.rng = rng
+        self.http = requests.Session()
+        self.token = None
+
+    def call(self, endpoint, method, path, expected=(200, 201), **kwargs):
+        if self.token:
+            kwargs.setdefault('headers', {})['Authorization'] = f'Bearer {self.token}'
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=self.args.timeout, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(endpoint, time.perf_counter() - start, False)
+            return None
+        self.recorder.record(endpoint, time.perf_counter() - start, response.status_code in expected)
+        return response
+
+    def think(self):
+        if self.args.think_ms:
+            time.sleep(self.rng.uniform(0, self.args.think_ms) / 1000)
+
+    def authenticate(self):
+        username = f'bench_{uuid.uuid4().hex[:12]}'
+        credentials = {'username': username, 'password': 'bench-password'}
+        response = self.call('signup', 'POST', '/api/auth/signup', json=credentials)
+        if response is None or response.status_code != 201:
+            response = self.call('login', 'POST', '/api/auth/login', json=credentials)
+        if response is not None and response.status_code in (200, 201):
+            self.token = response.json().get('token')
+
+    def fetch_photo(self, restaurant):
+        reference = (restaurant or {}).get('photo_reference')
+        if reference:
+            self.call('photo', 'GET', '/api/photo', params={
+                'photo_reference': reference,
+                'max_width': self.rng.choice((200, 400, 800))
+            })
+
+    def journey(self):
+        if self.token is None:
+            self.authenticate()
+
+        session_id = uuid.uuid4().hex
+        lat = self.args.latitude + self.rng.uniform(-0.05, 0.05)
+        lng = self.args.longitude + self.rng.uniform(-0.05, 0.05)
+        response = self.call('nearby', 'GET', '/api/nearby-restaurants', params={
+            'session_id': session_id, 'latitude': lat, 'longitude': lng, 'radius': self.args.radius
+        })
+        if response is None or response.status_code != 200:
+            return
+        for restaurant in response.json().get('restaurants', []):
+            self.fetch_photo(restaurant)
+
+        for _ in range(self.args.swipes):
+            self.think()
+            response = self.call('next', 'POST', '/api/next-restaurant', json={'session_id': session_id})
+            if response is None or response.status_code != 200:
+                break
+            restaurant = response.json().get('restaurant')
+            self.fetch_photo(restaurant)
+            if restaurant and self.token and self.rng.random() < self.args.like_rate:
+                self.call('favorite_add', 'POST', '/api/favorites', json={
+                    'place_id': restaurant['place_id'],
+                    'name': restaurant['name'],
+                    'picture': restaurant.get('photo_reference'),
+                    'address': restaurant.get('vicinity'),
+                    'rating': restaurant.get('rating'),
+                    'price': restaurant.get('price_level'),
+                    'lat': restaurant['location']['lat'],
+                    'lng': restaurant['location']['lng']
+                })
+
+        if self.token:
+            self.call('favorites', 'GET', '/api/favorites')
+        self.call('reset', 'POST', '/api/reset-session', json={'session_id': session_id})
+
+def run(args):
+    recorder = Recorder()
+    deadline = time.monotonic() + args.duration
+
+    def worker(seed):
+        user = User(args.base_url, recorder, args, random.Random(seed))
+        while time.monotonic() < deadline:
+            user.journey()
+
+    threads = [threading.Thread(target=worker, args=(args.seed + i,), daemon=True) for i in range(args.users)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return report(recorder, elapsed)
+
+def report(recorder, elapsed):
+    endpoints = {}
+    total = 0
+    for endpoint, samples in sorted(recorder.samples.items()):
+        samples.sort()
+        total += len(samples)
+        endpoints[endpoint] = {
+            'count': len(samples),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput_rps': len(samples) / elapsed,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p90_ms': percentile(samples, 90) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+            'max_ms': samples[-1] * 1000
+        }
+    return {'elapsed_seconds': elapsed, 'requests': total, 'throughput_rps': total / elapsed, 'endpoints': endpoints}
+
+def print_report(result):
+    print(f"{result['requests']} requests in {result['elapsed_seconds']:.1f}s ({result['throughput_rps']:.1f} req/s)")
+    print(f"{'endpoint':<14}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for endpoint, row in result['endpoints'].items():
+        print(f"{endpoint:<14}{row['count']:>8}{row['errors']:>8}{row['throughput_rps']:>9.1f}"
+              f"{row['p50_ms']:>9.1f}{row['p90_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5001')
+    parser.add_argument('--users', type=int, default=10, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='run time in seconds')
+    parser.add_argument('--swipes', type=int, default=40, help='next-restaurant calls per journey')
+    parser.add_argument('--like-rate', type=float, default=0.15, help='probability of favoriting a restaurant')
+    parser.add_argument('--think-ms', type=float, default=0, help='max random pause between swipes')
+    parser.add_argument('--latitude', type=float, default=40.7128)
+    parser.add_argument('--longitude', type=float, default=-74.0060)
+    parser.add_argument('--radius', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help='also write the report as JSON')
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
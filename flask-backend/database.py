@@ -1,9 +1,44 @@
 import json
+import math
+import logging
 from pathlib import Path
-from database_config import get_db_cursor, get_db_connection, convert_sqlite_to_postgres_query, ENV
+from database_config import (
+    get_db_cursor,
+    get_db_connection,
+    convert_sqlite_to_postgres_query,
+    register_statement,
+    execute_prepared,
+    ENV
+)
+from metrics import timed_query
+import write_behind
+
+logger = logging.getLogger(__name__)
 
 DATABASE_PATH = Path(__file__).parent / "restaurant_battle.db"
 
+# Bump when adding a migration to MIGRATIONS; stored in the schema_version table
+SCHEMA_VERSION = 5
+
+# Arbitrary key for the PostgreSQL advisory lock held while migrating
+SCHEMA_LOCK_ID = 7243001
+
+# Side of the square geotiles popularity is tracked in (~5.5km of latitude).
+# Stored per restaurant, so changing it needs the tiles recomputed.
+POPULAR_TILE_DEGREES = 0.05
+
+def geotile(lat, lng):
+    """Return the geotile key containing a point, or None without coordinates"""
+    if lat is None or lng is None:
+        return None
+    return f'{math.floor(lat / POPULAR_TILE_DEGREES)}:{math.floor(lng / POPULAR_TILE_DEGREES)}'
+
+def nearby_geotiles(lat, lng):
+    """Return the tile containing a point and its eight neighbours"""
+    row = math.floor(lat / POPULAR_TILE_DEGREES)
+    col = math.floor(lng / POPULAR_TILE_DEGREES)
+    return [f'{row + dr}:{col + dc}' for dr in (-1, 0, 1) for dc in (-1, 0, 1)]
+
 def create_connection():
     """Create a database connection to SQLite database"""
     conn = None
@@ -11,85 +46,443 @@ def create_connection():
         conn = sqlite3.connect(DATABASE_PATH)
         return conn
     except Error as e:
-        print(f"Error connecting to database: {e}")
+        logger.error("Error connecting to database: %s", e)
     return conn
 
-def init_db():
-    """Initialize the database with required tables"""
+def _migration_1_base_tables(cursor):
+    """Create the users, favorites, playlists and playlist_items tables"""
+    # Create users table
+    users_table = convert_sqlite_to_postgres_query('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            display_name TEXT,
+            app_settings TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(users_table)
+    
+    # Create favorites table
+    favorites_table = convert_sqlite_to_postgres_query('''
+        CREATE TABLE IF NOT EXISTS favorites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            place_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            picture TEXT,
+            address TEXT,
+            rating REAL,
+            price INTEGER,
+            lat REAL,
+            lng REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, place_id)
+        )
+    ''')
+    cursor.execute(favorites_table)
+
+    # Create playlists table
+    playlists_table = convert_sqlite_to_postgres_query('''
+        CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute(playlists_table)
+
+    # Create playlist_items table
+    playlist_items_table = convert_sqlite_to_postgres_query('''
+        CREATE TABLE IF NOT EXISTS playlist_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            playlist_id INTEGER,
+            place_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            picture TEXT,
+            address TEXT,
+            rating REAL,
+            price INTEGER,
+            lat REAL,
+            lng REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id),
+            UNIQUE(playlist_id, place_id)
+        )
+    ''')
+    cursor.execute(playlist_items_table)
+
+def _migration_2_restaurant_catalog(cursor):
+    """Move restaurant details into a restaurants table shared by favorites and playlists"""
+    # SQLite stores a TEXT primary key in a separate index unless the table is WITHOUT ROWID
+    without_rowid = '' if ENV == 'production' else ' WITHOUT ROWID'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS restaurants (
+            place_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            picture TEXT,
+            address TEXT,
+            rating REAL,
+            price INTEGER,
+            lat REAL,
+            lng REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ){without_rowid}
+    ''')
+
+    # One catalog row per place_id from the copies held by favorites and playlist items
+    cursor.execute('''
+        INSERT INTO restaurants (place_id, name, picture, address, rating, price, lat, lng)
+        SELECT place_id, MAX(name), MAX(picture), MAX(address), MAX(rating), MAX(price), MAX(lat), MAX(lng)
+        FROM (
+            SELECT place_id, name, picture, address, rating, price, lat, lng FROM favorites
+            UNION ALL
+            SELECT place_id, name, picture, address, rating, price, lat, lng FROM playlist_items
+        ) AS copies
+        GROUP BY place_id
+    ''')
+
+    for table in ('favorites', 'playlist_items'):
+        for column in ('name', 'picture', 'address', 'rating', 'price', 'lat', 'lng'):
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+        if ENV == 'production':
+            # SQLite cannot add constraints to an existing table (and does not enforce them by default)
+            cursor.execute(f'ALTER TABLE {table} ADD FOREIGN KEY (place_id) REFERENCES restaurants (place_id)')
+
+    # Covering indexes serve the newest-first list reads without touching the tables
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS favorites_user_created ON favorites (user_id, created_at, place_id)'
+    )
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS playlist_items_playlist_created ON playlist_items (playlist_id, created_at, place_id)'
+    )
+
+def _migration_3_popularity(cursor):
+    """Track per-restaurant save counts by geotile for the popular-nearby leaderboard"""
+    cursor.execute('ALTER TABLE restaurants ADD COLUMN tile TEXT')
+    cursor.execute('ALTER TABLE restaurants ADD COLUMN save_count INTEGER NOT NULL DEFAULT 0')
+
+    cursor.execute('SELECT place_id, lat, lng FROM restaurants WHERE lat IS NOT NULL AND lng IS NOT NULL')
+    cursor.executemany(
+        'UPDATE restaurants SET tile = %s WHERE place_id = %s',
+        [(geotile(lat, lng), place_id) for place_id, lat, lng in cursor.fetchall()]
+    )
+    cursor.execute('''
+        SELECT place_id, COUNT(*)
+        FROM (
+            SELECT place_id FROM favorites
+            UNION ALL
+            SELECT place_id FROM playlist_items
+        ) AS saves
+        GROUP BY place_id
+    ''')
+    cursor.executemany(
+        'UPDATE restaurants SET save_count = %s WHERE place_id = %s',
+        [(count, place_id) for place_id, count in cursor.fetchall()]
+    )
+
+    # Top-K per tile is a short scan from the front of this index
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS restaurants_tile_popularity ON restaurants (tile, save_count DESC)'
+    )
+
+def _migration_4_token_revocation(cursor):
+    """Record when each user's tokens were last revoked, e.g. by a password change"""
+    # Epoch milliseconds; tokens issued (iat) at or before it are rejected
+    cursor.execute('ALTER TABLE users ADD COLUMN tokens_revoked_at BIGINT')
+
+def _migration_5_rooms(cursor):
+    """Keep multiplayer battle rooms in the database so every worker and the push server share them"""
+    # data is the full room as JSON, state the snapshot participants see; the
+    # push server polls version and round_deadline without reading either
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            state TEXT NOT NULL,
+            round_deadline DOUBLE PRECISION,
+            updated_at DOUBLE PRECISION NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS rooms_updated ON rooms (updated_at)')
+
+# Ordered (version, migration) pairs applied by bootstrap_schema
+MIGRATIONS = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_restaurant_catalog),
+    (3, _migration_3_popularity),
+    (4, _migration_4_token_revocation),
+    (5, _migration_5_rooms),
+]
+
+def get_schema_version(cursor):
+    """Return the schema version stored in the database"""
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    row = cursor.fetchone()
+    return row[0] or 0
+
+@timed_query
+def bootstrap_schema():
+    """Apply pending migrations once per deployment; returns the resulting schema version"""
     with get_db_connection() as conn:
+        cursor = conn.cursor()
         try:
-            cursor = conn.cursor()
-            
-            # Create users table
-            users_table = convert_sqlite_to_postgres_query('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    display_name TEXT,
-                    app_settings TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute(users_table)
-            
-            # Create favorites table
-            favorites_table = convert_sqlite_to_postgres_query('''
-                CREATE TABLE IF NOT EXISTS favorites (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    place_id TEXT NOT NULL,
-                    name TEXT NOT NULL,
-                    picture TEXT,
-                    address TEXT,
-                    rating REAL,
-                    price INTEGER,
-                    lat REAL,
-                    lng REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    UNIQUE(user_id, place_id)
-                )
-            ''')
-            cursor.execute(favorites_table)
-
-            # Create playlists table
-            playlists_table = convert_sqlite_to_postgres_query('''
-                CREATE TABLE IF NOT EXISTS playlists (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    name TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            cursor.execute(playlists_table)
-
-            # Create playlist_items table
-            playlist_items_table = convert_sqlite_to_postgres_query('''
-                CREATE TABLE IF NOT EXISTS playlist_items (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    playlist_id INTEGER,
-                    place_id TEXT NOT NULL,
-                    name TEXT NOT NULL,
-                    picture TEXT,
-                    address TEXT,
-                    rating REAL,
-                    price INTEGER,
-                    lat REAL,
-                    lng REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (playlist_id) REFERENCES playlists (id),
-                    UNIQUE(playlist_id, place_id)
+            if ENV == 'production':
+                # Serialize concurrent bootstraps from several deploying hosts
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER NOT NULL
                 )
             ''')
-            cursor.execute(playlist_items_table)
-            
+            version = get_schema_version(cursor)
+            for target, migration in MIGRATIONS:
+                if target > version:
+                    logger.info("Applying schema migration %d: %s", target, migration.__doc__)
+                    migration(cursor)
+                    cursor.execute('INSERT INTO schema_version (version) VALUES (%s)', (target,))
+                    version = target
             conn.commit()
+            return version
+        except Exception as e:
+            logger.error("Error bootstrapping schema: %s", e)
+            conn.rollback()
+            raise
+
+def check_schema():
+    """Return True if the database schema is at the version this code expects"""
+    with get_db_cursor() as cursor:
+        try:
+            version = get_schema_version(cursor)
+            if version < SCHEMA_VERSION:
+                logger.error("Database schema is at version %d, this code needs %d", version, SCHEMA_VERSION)
+                return False
+            return True
         except Exception as e:
-            print(f"Error creating tables: {e}")
+            logger.error("Error checking schema version: %s", e)
+            return False
+
+def init_db():
+    """Initialize the database with required tables"""
+    return bootstrap_schema()
+
+# Hot read queries, prepared once per pooled PostgreSQL connection
+GET_USER = register_statement('get_user', '''
+    SELECT id, username, password_hash, display_name, app_settings, created_at, tokens_revoked_at
+    FROM users
+    WHERE username = %s
+''')
+GET_USER_FAVORITES = register_statement('get_user_favorites', '''
+    SELECT r.place_id, r.name, r.picture, r.address, r.rating, r.price, r.lat, r.lng
+    FROM favorites f
+    JOIN restaurants r ON r.place_id = f.place_id
+    WHERE f.user_id = %s
+    ORDER BY f.created_at DESC
+''')
+GET_USER_PLAYLISTS = register_statement('get_user_playlists', '''
+    SELECT id, name, created_at
+    FROM playlists
+    WHERE user_id = %s
+    ORDER BY created_at DESC
+''')
+GET_PLAYLIST_ITEMS = register_statement('get_playlist_items', '''
+    SELECT r.place_id, r.name, r.picture, r.address, r.rating, r.price, r.lat, r.lng
+    FROM playlist_items i
+    JOIN restaurants r ON r.place_id = i.place_id
+    WHERE i.playlist_id = %s
+    ORDER BY i.created_at DESC
+''')
+GET_POPULAR_IN_TILE = register_statement('get_popular_in_tile', '''
+    SELECT place_id, name, picture, address, rating, price, lat, lng, save_count
+    FROM restaurants
+    WHERE tile = %s AND save_count > 0
+    ORDER BY save_count DESC
+    LIMIT %s
+''')
+
+RESTAURANT_FIELDS = ('place_id', 'name', 'picture', 'address', 'rating', 'price', 'lat', 'lng')
+
+# Newer details win, but a sparse record (e.g. a manual favorite) never blanks known ones
+UPSERT_RESTAURANT = '''
+    INSERT INTO restaurants (place_id, name, picture, address, rating, price, lat, lng, tile)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (place_id) DO UPDATE SET
+        name = excluded.name,
+        picture = COALESCE(excluded.picture, restaurants.picture),
+        address = COALESCE(excluded.address, restaurants.address),
+        rating = COALESCE(excluded.rating, restaurants.rating),
+        price = COALESCE(excluded.price, restaurants.price),
+        lat = COALESCE(excluded.lat, restaurants.lat),
+        lng = COALESCE(excluded.lng, restaurants.lng),
+        tile = COALESCE(excluded.tile, restaurants.tile),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# Saving a place twice is a no-op; rowcount tells whether save_count should move
+INSERT_FAVORITE = '''
+    INSERT INTO favorites (user_id, place_id)
+    VALUES (%s, %s)
+    ON CONFLICT (user_id, place_id) DO NOTHING
+'''
+INSERT_PLAYLIST_ITEM = '''
+    INSERT INTO playlist_items (playlist_id, place_id)
+    VALUES (%s, %s)
+    ON CONFLICT (playlist_id, place_id) DO NOTHING
+'''
+
+def _save_restaurant(insert, owner_id, restaurant_data):
+    """Upsert the catalog row and insert one reference to it in a single transaction"""
+    place_id = restaurant_data['place_id']
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(UPSERT_RESTAURANT, _restaurant_row(restaurant_data))
+            cursor.execute(insert, (owner_id, place_id))
+            if cursor.rowcount > 0:
+                _add_save_counts(cursor, {place_id: 1})
+            conn.commit()
+        except Exception:
+            # Keep nothing, not even the catalog upsert, from a save that failed
             conn.rollback()
+            raise
+
+def _restaurant_fields(restaurant_data):
+    """Pick the stored restaurant columns out of request data"""
+    return {field: restaurant_data.get(field) for field in RESTAURANT_FIELDS}
+
+def _restaurant_row(restaurant_data):
+    row = tuple(restaurant_data.get(field) for field in RESTAURANT_FIELDS)
+    return row + (geotile(restaurant_data.get('lat'), restaurant_data.get('lng')),)
+
+def _add_save_counts(cursor, deltas):
+    """Apply per-place_id changes in the number of favorites and playlist items"""
+    cursor.executemany(
+        'UPDATE restaurants SET save_count = save_count + %s WHERE place_id = %s',
+        [(delta, place_id) for place_id, delta in deltas.items() if delta]
+    )
+
+def _validate_restaurant(restaurant_data):
+    """Raise ValueError for restaurant data the catalog would reject"""
+    if not isinstance(restaurant_data.get('place_id'), str) or not restaurant_data['place_id']:
+        raise ValueError('place_id is required')
+    if restaurant_data.get('name') is None:
+        raise ValueError('name is required')
+    for field in RESTAURANT_FIELDS:
+        value = restaurant_data.get(field)
+        if value is not None and not isinstance(value, (str, int, float)):
+            raise ValueError(f'{field} must be a string or a number')
+    for field in ('lat', 'lng'):
+        value = restaurant_data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f'{field} must be a number')
+
+def _validate_write(op):
+    """Refuse queued saves the synchronous path would fail on, before they are acknowledged"""
+    if op['action'] == 'put' and op['key'].split(':', 1)[0] in ('favorite', 'item'):
+        _validate_restaurant(op['data'])
+
+# DB-API error classes (sqlite3 and psycopg2 alike) that retrying the same write cannot fix
+PERMANENT_ERRORS = ('IntegrityError', 'DataError', 'ProgrammingError', 'InterfaceError')
+
+def _is_permanent_error(error):
+    if isinstance(error, (ValueError, TypeError, KeyError)):
+        return True
+    return any(cls.__name__ in PERMANENT_ERRORS for cls in type(error).__mro__)
+
+def _queue_write(owner_type, owner_id, key, action, data):
+    """Hand a mutation to the write-behind queue; returns False when it is not running.
+
+    Raises ValueError for a mutation the database would reject.
+    """
+    queue = write_behind.queue
+    if queue is None:
+        return False
+    queue.submit({'owner': [owner_type, owner_id], 'key': key, 'action': action, 'data': data})
+    return True
 
+def _queued_ops(owner_type, owner_id):
+    queue = write_behind.queue
+    return queue.overlay((owner_type, owner_id)) if queue is not None else []
+
+def _overlay_restaurants(rows, ops, prefix):
+    """Apply queued puts and deletes to rows read from the database (newest first)"""
+    ops = [op for op in ops if op['key'].startswith(prefix)]
+    if not ops:
+        return rows
+    queued = {op['data']['place_id']: op for op in ops}
+    stored = {row['place_id'] for row in rows}
+    rows = [row for row in rows if queued.get(row['place_id'], {}).get('action') != 'delete']
+    added = [op['data'] for op in reversed(ops) if op['action'] == 'put' and op['data']['place_id'] not in stored]
+    return added + rows
+
+@timed_query
+def _apply_write_batch(ops):
+    """Commit a batch of write-behind mutations in a single transaction"""
+    # Catalog rows go first so favorites and playlist items can reference them.
+    # Saves and removals run one by one so only rows that changed move save_count.
+    statements = {
+        ('restaurant', 'put'): UPSERT_RESTAURANT,
+        ('settings', 'put'): 'UPDATE users SET app_settings = %s WHERE id = %s',
+        ('favorite', 'put'): INSERT_FAVORITE,
+        ('favorite', 'delete'): 'DELETE FROM favorites WHERE user_id = %s AND place_id = %s',
+        ('item', 'put'): '''
+            INSERT INTO playlist_items (playlist_id, place_id)
+            SELECT %s, %s
+            WHERE EXISTS (SELECT 1 FROM playlists WHERE id = %s)
+            ON CONFLICT (playlist_id, place_id) DO NOTHING
+        ''',
+        ('item', 'delete'): 'DELETE FROM playlist_items WHERE playlist_id = %s AND place_id = %s',
+    }
+    groups = {group: [] for group in statements}
+    for op in ops:
+        owner_type, owner_id = op['owner']
+        kind = op['key'].split(':', 1)[0]
+        data = op['data']
+        if kind == 'settings':
+            groups[kind, 'put'].append((json.dumps(data), owner_id))
+        elif op['action'] == 'put':
+            groups['restaurant', 'put'].append(_restaurant_row(data))
+            params = (owner_id, data['place_id'])
+            if kind == 'item':
+                # Skip items whose playlist was deleted since they were queued
+                params += (owner_id,)
+            groups[kind, 'put'].append(params)
+        else:
+            groups[kind, 'delete'].append((owner_id, data['place_id']))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            deltas = {}
+            for (kind, action), params in groups.items():
+                if kind in ('restaurant', 'settings'):
+                    if params:
+                        cursor.executemany(statements[kind, action], params)
+                    continue
+                for row in params:
+                    cursor.execute(statements[kind, action], row)
+                    if cursor.rowcount > 0:
+                        deltas[row[1]] = deltas.get(row[1], 0) + (1 if action == 'put' else -1)
+            _add_save_counts(cursor, deltas)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def start_write_behind():
+    """Start the write-behind queue if WRITE_BEHIND_ENABLED is set"""
+    return write_behind.start(_apply_write_batch, validate=_validate_write, is_permanent=_is_permanent_error)
+
+def stop_write_behind():
+    """Flush queued mutations and stop the write-behind queue"""
+    write_behind.stop()
+
+@timed_query
 def add_user(username, password_hash, display_name=None, app_settings=None):
     """Add a new user to the database"""
     with get_db_cursor() as cursor:
@@ -101,14 +494,15 @@ def add_user(username, password_hash, display_name=None, app_settings=None):
             ''', (username, password_hash, display_name, json.dumps(app_settings) if app_settings else None))
             return cursor.fetchone()[0]
         except Exception as e:
-            print(f"Error adding user: {e}")
+            logger.error("Error adding user: %s", e)
             return None
 
+@timed_query
 def get_user(username):
     """Get user by username"""
     with get_db_cursor() as cursor:
         try:
-            cursor.execute('SELECT * FROM users WHERE username = %s', (username,))
+            execute_prepared(cursor, GET_USER, (username,))
             user = cursor.fetchone()
             if user:
                 # Properly handle app_settings deserialization
@@ -119,32 +513,41 @@ def get_user(username):
                     except json.JSONDecodeError:
                         app_settings = {}
                 
+                # Settings still waiting in the write-behind queue win over the stored ones
+                for op in _queued_ops('user', user[0]):
+                    if op['key'] == 'settings':
+                        app_settings = op['data']
+
                 return {
                     'id': user[0],
                     'username': user[1],
                     'password_hash': user[2],
                     'display_name': user[3],
                     'app_settings': app_settings,
-                    'created_at': user[5]
+                    'created_at': user[5],
+                    'tokens_revoked_at': user[6]
                 }
             return None
         except Exception as e:
-            print(f"Error getting user: {e}")
+            logger.error("Error getting user: %s", e)
             return None
 
+@timed_query
 def update_user_settings(user_id, app_settings):
     """Update user's app settings"""
+    # Ensure app_settings is a dictionary before serializing
+    if app_settings is None:
+        app_settings = {}
+    elif isinstance(app_settings, str):
+        try:
+            app_settings = json.loads(app_settings)
+        except json.JSONDecodeError:
+            app_settings = {}
+
+    if _queue_write('user', user_id, 'settings', 'put', app_settings):
+        return True
     with get_db_cursor() as cursor:
         try:
-            # Ensure app_settings is a dictionary before serializing
-            if app_settings is None:
-                app_settings = {}
-            elif isinstance(app_settings, str):
-                try:
-                    app_settings = json.loads(app_settings)
-                except json.JSONDecodeError:
-                    app_settings = {}
-            
             cursor.execute('''
                 UPDATE users 
                 SET app_settings = %s
@@ -152,56 +555,65 @@ def update_user_settings(user_id, app_settings):
             ''', (json.dumps(app_settings), user_id))
             return True
         except Exception as e:
-            print(f"Error updating user settings: {e}")
+            logger.error("Error updating user settings: %s", e)
             return False
 
-def add_favorite(user_id, restaurant_data):
-    """Add a restaurant to user's favorites"""
+@timed_query
+def update_user_password(user_id, password_hash, tokens_revoked_at=None):
+    """Replace a user's password hash, revoking tokens issued before `tokens_revoked_at` if given"""
     with get_db_cursor() as cursor:
         try:
             cursor.execute('''
-                INSERT INTO favorites 
-                (user_id, place_id, name, picture, address, rating, price, lat, lng)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                user_id,
-                restaurant_data['place_id'],
-                restaurant_data['name'],
-                restaurant_data.get('picture', None),
-                restaurant_data.get('address', None),
-                restaurant_data.get('rating', None),
-                restaurant_data.get('price', None),
-                restaurant_data.get('lat', None),
-                restaurant_data.get('lng', None)
-            ))
+                UPDATE users 
+                SET password_hash = %s,
+                    tokens_revoked_at = COALESCE(%s, tokens_revoked_at)
+                WHERE id = %s
+            ''', (password_hash, tokens_revoked_at, user_id))
             return True
         except Exception as e:
-            print(f"Error adding favorite: {e}")
+            logger.error("Error updating password: %s", e)
             return False
 
+@timed_query
+def add_favorite(user_id, restaurant_data):
+    """Add a restaurant to user's favorites"""
+    try:
+        if _queue_write('user', user_id, 'favorite:' + str(restaurant_data.get('place_id')), 'put',
+                        _restaurant_fields(restaurant_data)):
+            return True
+    except ValueError as e:
+        logger.error("Error adding favorite: %s", e)
+        return False
+    try:
+        _save_restaurant(INSERT_FAVORITE, user_id, restaurant_data)
+        return True
+    except Exception as e:
+        logger.error("Error adding favorite: %s", e)
+        return False
+
+@timed_query
 def remove_favorite(user_id, place_id):
     """Remove a restaurant from user's favorites"""
+    if _queue_write('user', user_id, 'favorite:' + place_id, 'delete', {'place_id': place_id}):
+        return True
     with get_db_cursor() as cursor:
         try:
             cursor.execute('''
                 DELETE FROM favorites 
                 WHERE user_id = %s AND place_id = %s
             ''', (user_id, place_id))
+            _add_save_counts(cursor, {place_id: -cursor.rowcount})
             return True
         except Exception as e:
-            print(f"Error removing favorite: {e}")
+            logger.error("Error removing favorite: %s", e)
             return False
 
+@timed_query
 def get_user_favorites(user_id):
     """Get all favorite restaurants for a user"""
     with get_db_cursor() as cursor:
         try:
-            cursor.execute('''
-                SELECT place_id, name, picture, address, rating, price, lat, lng
-                FROM favorites
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            ''', (user_id,))
+            execute_prepared(cursor, GET_USER_FAVORITES, (user_id,))
             favorites = []
             for row in cursor.fetchall():
                 favorites.append({
@@ -214,11 +626,12 @@ def get_user_favorites(user_id):
                     'lat': row[6],
                     'lng': row[7]
                 })
-            return favorites
+            return _overlay_restaurants(favorites, _queued_ops('user', user_id), 'favorite:')
         except Exception as e:
-            print(f"Error getting user favorites: {e}")
+            logger.error("Error getting user favorites: %s", e)
             return []
 
+@timed_query
 def create_playlist(user_id, name):
     """Create a new playlist for a user"""
     with get_db_cursor() as cursor:
@@ -230,19 +643,15 @@ def create_playlist(user_id, name):
             ''', (user_id, name))
             return cursor.fetchone()[0]
         except Exception as e:
-            print(f"Error creating playlist: {e}")
+            logger.error("Error creating playlist: %s", e)
             return None
 
+@timed_query
 def get_user_playlists(user_id):
     """Get all playlists for a user"""
     with get_db_cursor() as cursor:
         try:
-            cursor.execute('''
-                SELECT id, name, created_at
-                FROM playlists
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            ''', (user_id,))
+            execute_prepared(cursor, GET_USER_PLAYLISTS, (user_id,))
             playlists = []
             for row in cursor.fetchall():
                 playlists.append({
@@ -252,19 +661,15 @@ def get_user_playlists(user_id):
                 })
             return playlists
         except Exception as e:
-            print(f"Error getting user playlists: {e}")
+            logger.error("Error getting user playlists: %s", e)
             return []
 
+@timed_query
 def get_playlist_items(playlist_id):
     """Get all items in a playlist"""
     with get_db_cursor() as cursor:
         try:
-            cursor.execute('''
-                SELECT place_id, name, picture, address, rating, price, lat, lng
-                FROM playlist_items
-                WHERE playlist_id = %s
-                ORDER BY created_at DESC
-            ''', (playlist_id,))
+            execute_prepared(cursor, GET_PLAYLIST_ITEMS, (playlist_id,))
             items = []
             for row in cursor.fetchall():
                 items.append({
@@ -277,61 +682,177 @@ def get_playlist_items(playlist_id):
                     'lat': row[6],
                     'lng': row[7]
                 })
-            return items
+            return _overlay_restaurants(items, _queued_ops('playlist', playlist_id), 'item:')
         except Exception as e:
-            print(f"Error getting playlist items: {e}")
+            logger.error("Error getting playlist items: %s", e)
             return []
 
+@timed_query
 def add_to_playlist(playlist_id, restaurant_data):
     """Add a restaurant to a playlist"""
-    with get_db_cursor() as cursor:
-        try:
-            cursor.execute('''
-                INSERT INTO playlist_items 
-                (playlist_id, place_id, name, picture, address, rating, price, lat, lng)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                playlist_id,
-                restaurant_data['place_id'],
-                restaurant_data['name'],
-                restaurant_data.get('picture', None),
-                restaurant_data.get('address', None),
-                restaurant_data.get('rating', None),
-                restaurant_data.get('price', None),
-                restaurant_data.get('lat', None),
-                restaurant_data.get('lng', None)
-            ))
+    try:
+        if _queue_write('playlist', playlist_id, 'item:' + str(restaurant_data.get('place_id')), 'put',
+                        _restaurant_fields(restaurant_data)):
             return True
-        except Exception as e:
-            print(f"Error adding to playlist: {e}")
-            return False
+    except ValueError as e:
+        logger.error("Error adding to playlist: %s", e)
+        return False
+    try:
+        _save_restaurant(INSERT_PLAYLIST_ITEM, playlist_id, restaurant_data)
+        return True
+    except Exception as e:
+        logger.error("Error adding to playlist: %s", e)
+        return False
 
+@timed_query
 def remove_from_playlist(playlist_id, place_id):
     """Remove a restaurant from a playlist"""
+    # Queued as well, so it cannot be overtaken by a still-queued add of the same item
+    if _queue_write('playlist', playlist_id, 'item:' + place_id, 'delete', {'place_id': place_id}):
+        return True
     with get_db_cursor() as cursor:
         try:
             cursor.execute('''
                 DELETE FROM playlist_items 
                 WHERE playlist_id = %s AND place_id = %s
             ''', (playlist_id, place_id))
+            _add_save_counts(cursor, {place_id: -cursor.rowcount})
             return True
         except Exception as e:
-            print(f"Error removing from playlist: {e}")
+            logger.error("Error removing from playlist: %s", e)
             return False
 
+@timed_query
 def delete_playlist(playlist_id):
     """Delete a playlist and all its items"""
+    if write_behind.queue is not None:
+        write_behind.queue.discard_owner(('playlist', playlist_id))
     with get_db_connection() as conn:
         try:
             cursor = conn.cursor()
             # First delete all items in the playlist
-            cursor.execute('DELETE FROM playlist_items WHERE playlist_id = %s', (playlist_id,))
+            cursor.execute('DELETE FROM playlist_items WHERE playlist_id = %s RETURNING place_id', (playlist_id,))
+            _add_save_counts(cursor, {place_id: -1 for place_id, in cursor.fetchall()})
             # Then delete the playlist itself
             cursor.execute('DELETE FROM playlists WHERE id = %s', (playlist_id,))
             return True
         except Exception as e:
-            print(f"Error deleting playlist: {e}")
+            logger.error("Error deleting playlist: %s", e)
             return False
 
-# Initialize database when module is imported
-init_db() 
\ No newline at end of file
+@timed_query
+def get_popular_nearby(lat, lng, limit=10):
+    """Return the most saved restaurants in the geotiles around a point, most saved first"""
+    with get_db_cursor() as cursor:
+        try:
+            rows = []
+            # Each tile is a LIMIT-bounded index scan, so the cost does not grow with the tables
+            for tile in nearby_geotiles(lat, lng):
+                execute_prepared(cursor, GET_POPULAR_IN_TILE, (tile, limit))
+                rows.extend(cursor.fetchall())
+            rows.sort(key=lambda row: (row[8], row[4] or 0), reverse=True)
+            return [{
+                'place_id': row[0],
+                'name': row[1],
+                'picture': row[2],
+                'address': row[3],
+                'rating': row[4],
+                'price': row[5],
+                'lat': row[6],
+                'lng': row[7],
+                'save_count': row[8]
+            } for row in rows[:limit]]
+        except Exception as e:
+            logger.error("Error getting popular restaurants: %s", e)
+            return []
+
+# Room ids per query when polling many rooms at once
+ROOM_QUERY_BATCH = 500
+
+@timed_query
+def insert_room(row):
+    """Store a new room; returns False if its id is already taken"""
+    with get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO rooms (id, version, data, state, round_deadline, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (id) DO NOTHING
+        ''', (row['id'], row['version'], row['data'], row['state'], row['round_deadline'], row['updated_at']))
+        return cursor.rowcount > 0
+
+@timed_query
+def get_room(room_id):
+    """Return a room's stored data as JSON, or None"""
+    with get_db_cursor() as cursor:
+        cursor.execute('SELECT data FROM rooms WHERE id = %s', (room_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+@timed_query
+def update_room(room_id, change):
+    """Rewrite a room in one transaction that holds its row lock.
+
+    change(data) gets the stored JSON and returns the row to write back, or
+    None to leave it as it is; an exception from it rolls the transaction
+    back. Returns False if there is no such room.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if ENV == 'production':
+                cursor.execute('SELECT data FROM rooms WHERE id = %s FOR UPDATE', (room_id,))
+            else:
+                # SQLite has no row locks; take the database's write lock before reading instead
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('SELECT data FROM rooms WHERE id = %s', (room_id,))
+            stored = cursor.fetchone()
+            if stored is None:
+                conn.rollback()
+                return False
+            row = change(stored[0])
+            if row is not None:
+                cursor.execute('''
+                    UPDATE rooms
+                    SET version = %s, data = %s, state = %s, round_deadline = %s, updated_at = %s
+                    WHERE id = %s
+                ''', (row['version'], row['data'], row['state'], row['round_deadline'], row['updated_at'], room_id))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+def _select_rooms(columns, room_ids):
+    with get_db_cursor() as cursor:
+        rows = []
+        room_ids = list(room_ids)
+        for start in range(0, len(room_ids), ROOM_QUERY_BATCH):
+            batch = room_ids[start:start + ROOM_QUERY_BATCH]
+            cursor.execute(
+                f'SELECT id, {columns} FROM rooms WHERE id IN ({", ".join(["%s"] * len(batch))})', batch
+            )
+            rows.extend(cursor.fetchall())
+        return rows
+
+@timed_query
+def get_room_versions(room_ids):
+    """Return {room_id: (version, round_deadline)} for the rooms that exist"""
+    return {row[0]: (row[1], row[2]) for row in _select_rooms('version, round_deadline', room_ids)}
+
+@timed_query
+def get_room_states(room_ids):
+    """Return {room_id: (version, state, round_deadline)} for the rooms that exist"""
+    return {row[0]: (row[1], row[2], row[3]) for row in _select_rooms('version, state, round_deadline', room_ids)}
+
+@timed_query
+def delete_idle_rooms(cutoff):
+    """Delete rooms last changed before `cutoff` (epoch seconds)"""
+    with get_db_cursor() as cursor:
+        cursor.execute('DELETE FROM rooms WHERE updated_at < %s', (cutoff,))
+        return cursor.rowcount
+
+if __name__ == '__main__':
+    import logs
+    logs.configure()
+    print(f"Schema is at version {bootstrap_schema()}")
+ 
\ No newline at end of file
@@ -1,17 +1,22 @@
 import os
-from dotenv import load_dotenv
-import psycopg2
-from psycopg2.pool import SimpleConnectionPool
+import re
+import logging
+import sqlite3
+import time
+import threading
 from contextlib import contextmanager
+from metrics import Counter, Histogram
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Configuration is read from the environment at import time; entry points
+# (app.py, scripts) call load_dotenv() before importing this module.
 
 # Database configuration
 DB_CONFIG = {
     'development': {
         'type': 'sqlite',
-        'database': 'restaurant_battle.db'
+        'database': os.getenv('SQLITE_DATABASE', 'restaurant_battle.db')
     },
     'production': {
         'type': 'postgresql',
@@ -22,48 +27,155 @@ DB_CONFIG = {
 # Get environment
 ENV = os.getenv('FLASK_ENV', 'development')
 
-# Connection pool for PostgreSQL
+# Connection pool sizes for PostgreSQL, per worker process. By default every
+# gunicorn request thread can hold one, plus the write-behind flusher and one spare.
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', int(os.getenv('GUNICORN_THREADS', 32)) + 2))
+# Seconds a thread waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+
+# Connection pool for PostgreSQL, created on first use
 pg_pool = None
+pg_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted, so
+# checkouts queue on this first
+pg_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# Idle SQLite connections kept for reuse in development. Opening one per call
+# re-reads the schema and starts from a cold page cache every time.
+sqlite_idle = []
+sqlite_idle_lock = threading.Lock()
+
+pool_wait_duration = Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a free pooled PostgreSQL connection'
+)
+
+# Set to "0" to send registered statements as plain queries, e.g. to benchmark the difference
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', '1') != '0'
+
+# Hot statements prepared once per pooled PostgreSQL connection: name -> query
+PREPARED_STATEMENTS = {}
+
+statement_prepares = Counter(
+    'db_statement_prepares_total', 'Registered statements prepared on a pooled connection',
+    ('statement',)
+)
+
+class SQLiteCursor(sqlite3.Cursor):
+    """Cursor accepting the %s placeholders used by the PostgreSQL queries"""
+
+    def execute(self, sql, parameters=()):
+        return super().execute(sql.replace('%s', '?'), parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(sql.replace('%s', '?'), seq_of_parameters)
+
+class SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+def _sqlite_connect():
+    # Pooled connections move between threads, but only one uses them at a time
+    conn = sqlite3.connect(DB_CONFIG['development']['database'], factory=SQLiteConnection,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _prepared_connection_class():
+    from psycopg2.extensions import connection
+
+    class PreparedConnection(connection):
+        """psycopg2 connection that remembers which registered statements it has prepared"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+    return PreparedConnection
 
 def init_db_pool():
     """Initialize the PostgreSQL connection pool"""
     global pg_pool
     if ENV == 'production':
+        # Imported here so development and tooling never load the driver
+        from psycopg2.pool import ThreadedConnectionPool
         config = DB_CONFIG['production']
         try:
-            print("Attempting to initialize database pool...")
+            logger.info("Initializing database pool")
             # Hide password in the connection string for logging
             masked_url = config['url'].replace(os.getenv('DATABASE_URL', '').split('@')[0].split(':')[2], '***')
-            print(f"Connection string (with password hidden): {masked_url}")
-            pg_pool = SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=config['url']
+            logger.debug("Connection string (with password hidden): %s", masked_url)
+            # Threaded pool: request threads share it within a worker
+            pg_pool = ThreadedConnectionPool(
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                dsn=config['url'],
+                connection_factory=_prepared_connection_class()
             )
-            print("Successfully initialized database pool")
+            logger.info("Initialized database pool with up to %d connections", DB_POOL_MAX)
         except Exception as e:
-            print(f"Error initializing database pool: {str(e)}")
+            logger.error("Error initializing database pool: %s", e)
             raise
 
+def warm_db_pool():
+    """Open the pool and check that its connections work before serving traffic"""
+    if ENV != 'production':
+        return
+    with get_db_cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+def close_db_pool():
+    """Close every pooled connection, e.g. before forking workers or on shutdown"""
+    global pg_pool
+    with pg_pool_lock:
+        if pg_pool is not None:
+            pg_pool.closeall()
+            pg_pool = None
+    with sqlite_idle_lock:
+        while sqlite_idle:
+            sqlite_idle.pop().close()
+
 @contextmanager
 def get_db_connection():
     """Context manager for database connections"""
     if ENV == 'development':
-        import sqlite3
-        conn = sqlite3.connect(DB_CONFIG['development']['database'])
-        conn.row_factory = sqlite3.Row
-        yield conn
-        conn.close()
+        with sqlite_idle_lock:
+            conn = sqlite_idle.pop() if sqlite_idle else None
+        if conn is None:
+            conn = _sqlite_connect()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            # Never hand on a connection that may hold a half-done transaction
+            conn.close()
+            raise
+        with sqlite_idle_lock:
+            if len(sqlite_idle) < DB_POOL_MAX:
+                sqlite_idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
     else:
         global pg_pool
         if pg_pool is None:
-            init_db_pool()
-        conn = pg_pool.getconn()
+            with pg_pool_lock:
+                if pg_pool is None:
+                    init_db_pool()
+        start = time.perf_counter()
+        if not pg_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            from psycopg2.pool import PoolError
+            raise PoolError(f'no pooled connection free after {DB_POOL_TIMEOUT}s')
+        pool_wait_duration.observe(time.perf_counter() - start)
         try:
-            yield conn
-            conn.commit()
+            conn = pg_pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                pg_pool.putconn(conn)
         finally:
-            pg_pool.putconn(conn)
+            pg_pool_slots.release()
 
 @contextmanager
 def get_db_cursor():
@@ -76,8 +188,40 @@ def get_db_cursor():
         finally:
             cursor.close()
 
+def register_statement(name, query):
+    """Register a hot query (with %s placeholders) for execute_prepared; returns its name"""
+    PREPARED_STATEMENTS[name] = query
+    return name
+
+def _numbered_placeholders(query):
+    """Rewrite %s placeholders as the $1, $2, ... form PREPARE expects"""
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', query)
+
+def execute_prepared(cursor, name, params=()):
+    """Execute a registered statement, preparing it on first use on this connection.
+
+    PostgreSQL then parses and plans the query once per pooled connection
+    instead of on every call. SQLite keeps its own statement cache, so there
+    the query is simply executed.
+    """
+    query = PREPARED_STATEMENTS[name]
+    prepared = getattr(cursor.connection, 'prepared', None)
+    if ENV != 'production' or not DB_PREPARED_STATEMENTS or prepared is None:
+        return cursor.execute(query, params)
+    if name not in prepared:
+        cursor.execute(f'PREPARE {name} AS {_numbered_placeholders(query)}')
+        prepared.add(name)
+        statement_prepares.inc(name)
+    if params:
+        return cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+    return cursor.execute(f'EXECUTE {name}')
+
 def convert_sqlite_to_postgres_query(query):
     """Convert SQLite query syntax to PostgreSQL"""
+    if ENV != 'production':
+        return query
+    
     # Replace SQLite's autoincrement with PostgreSQL's serial
     query = query.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
     
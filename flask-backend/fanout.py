@@ -0,0 +1,72 @@
+import os
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logs
+from metrics import Counter
+
+# Fill mode starts when the first search yields fewer restaurants than this
+FANOUT_MIN_RESULTS = int(os.getenv('FANOUT_MIN_RESULTS', 10))
+# Threads per process running tile searches; further tiles queue behind them
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', 6))
+# Rings of tiles searched around the original circle (ring k has 6k tiles)
+FANOUT_RINGS = int(os.getenv('FANOUT_RINGS', 1))
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320
+
+_executor = None
+_executor_lock = threading.Lock()
+
+tile_searches = Counter(
+    'fanout_tile_searches_total', 'Tile searches run to fill sparse battle pools, by outcome',
+    ('outcome',)
+)
+
+def _get_executor():
+    """Create the tile search thread pool on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+    return _executor
+
+def ring_centers(lat, lng, radius, rings=FANOUT_RINGS):
+    """Return centers of hexagonal rings of circles of `radius` meters around a point.
+
+    Circles of radius r centered sqrt(3) * r apart tile the plane with
+    small overlaps, so ring k holds 6k circles at that spacing.
+    """
+    spacing = math.sqrt(3) * radius
+    lng_scale = max(math.cos(math.radians(lat)), 0.01)
+    centers = []
+    for ring in range(1, rings + 1):
+        for step in range(6 * ring):
+            angle = 2 * math.pi * step / (6 * ring)
+            north = spacing * ring * math.cos(angle)
+            east = spacing * ring * math.sin(angle)
+            centers.append((
+                lat + north / METERS_PER_DEGREE,
+                lng + east / (METERS_PER_DEGREE * lng_scale)
+            ))
+    return centers
+
+def submit_all(search, centers, on_done):
+    """Run search(lat, lng) for every center on the pool; on_done receives each finished future"""
+    executor = _get_executor()
+    futures = []
+    for lat, lng in centers:
+        # Pool threads log under the submitting request's correlation ID
+        future = executor.submit(logs.in_current_context(search), lat, lng)
+        future.add_done_callback(logs.in_current_context(on_done))
+        futures.append(future)
+    return futures
+
+def shutdown(wait=True):
+    """Stop the tile search pool, optionally waiting for running searches"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait, cancel_futures=True)
+            _executor = None
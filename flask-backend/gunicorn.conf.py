@@ -0,0 +1,91 @@
+# Production entry point: gunicorn -c gunicorn.conf.py
+import os
+import sys
+import signal
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+wsgi_app = 'app:app'
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# Threaded workers: request threads mostly wait on Google and the database.
+# Battle sessions live in worker memory, so a client must keep hitting the
+# same worker; run more than one only behind sticky routing. Rooms are in the
+# database and any worker can serve them.
+# The app relies on real threads (thread-local metric shards, the psycopg2
+# pool, the hashing process pool), so only the gthread worker is supported.
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+
+# Import the app once in the master so workers fork with it already loaded
+preload_app = True
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+# Time in-flight requests get to finish after SIGTERM
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# Recycle workers periodically to bound memory growth of in-memory caches
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+# gunicorn writes access lines synchronously on the request thread; the app's
+# sampled "access" logger goes through the log queue instead. Set a path (or
+# "-" for stdout) to turn gunicorn's own access log back on.
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+
+# Room event streams and long-polls are served by push_server.py on PUSH_PORT,
+# which holds them on one event loop instead of a request thread each. Set to
+# "0" to run it as its own service instead of a child of the master.
+PUSH_SERVER_EMBEDDED = os.getenv('PUSH_SERVER_EMBEDDED', '1') == '1'
+
+def on_starting(server):
+    """Bootstrap the schema once in the master, before any worker starts"""
+    from database import bootstrap_schema
+    from database_config import close_db_pool
+    server.log.info("Schema is at version %s", bootstrap_schema())
+    # Connections must not be shared with forked workers
+    close_db_pool()
+
+def post_worker_init(worker):
+    """Warm the DB pool, outbound HTTP session and hash pool before serving"""
+    from app import warm_up, begin_drain
+    warm_up()
+
+    # Gunicorn's own SIGTERM handler only stops accepting connections. Start
+    # draining right away as well, so no new background fetches start and
+    # in-flight requests finish well inside graceful_timeout.
+    stop_worker = signal.getsignal(signal.SIGTERM)
+
+    def drain_then_stop(signum, frame):
+        begin_drain()
+        stop_worker(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_then_stop)
+    worker.log.info("Worker %s warmed up", worker.pid)
+
+def worker_exit(server, worker):
+    """Drain background fetches and close pooled connections"""
+    from app import shutdown
+    # Runs after the worker has already waited for in-flight requests, and the
+    # master kills it once graceful_timeout has passed since SIGTERM
+    shutdown(timeout=max(graceful_timeout / 6, 1))
+
+def when_ready(server):
+    """Start the room push server once the master is listening"""
+    if PUSH_SERVER_EMBEDDED:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'push_server.py')
+        server.push_server = subprocess.Popen([sys.executable, script])
+        server.log.info("Started push server (pid %s)", server.push_server.pid)
+
+def on_exit(server):
+    """Stop the push server with the master"""
+    push_server = getattr(server, 'push_server', None)
+    if push_server is not None:
+        push_server.terminate()
+        try:
+            push_server.wait(graceful_timeout)
+        except subprocess.TimeoutExpired:
+            push_server.kill()
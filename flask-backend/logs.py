@@ -0,0 +1,184 @@
+import os
+import re
+import sys
+import copy
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+from metrics import Counter, Gauge
+
+# Lowest level written: DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# "json" writes one object per line for log shippers; "text" is easier to read locally
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Records buffered for the writer thread; further records are dropped, never waited on
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Fraction of high-frequency events (per-tile and per-page failures) that are kept
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+# Fraction of completed requests logged with their route, status and duration
+LOG_REQUEST_SAMPLE_RATE = float(os.getenv('LOG_REQUEST_SAMPLE_RATE', 0.01))
+
+# Correlation ID of the request being handled by the current thread or greenlet
+request_id = contextvars.ContextVar('request_id', default=None)
+
+# Incoming X-Request-ID values are trusted only if they look like an ID
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+dropped_records = Counter(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full'
+)
+
+def bind_request_id(value=None):
+    """Set the current request's correlation ID, generating one unless `value` is usable"""
+    if not value or not REQUEST_ID_PATTERN.match(value):
+        value = uuid.uuid4().hex
+    request_id.set(value)
+    return value
+
+def clear_request_id():
+    request_id.set(None)
+
+def in_current_context(fn):
+    """Wrap fn to run once, in another thread, with the caller's correlation ID"""
+    return _ContextCall(fn)
+
+class _ContextCall:
+    # A copied context can only be entered by one thread at a time, so each wrapper owns one
+    __slots__ = ('context', 'fn')
+
+    def __init__(self, fn):
+        self.context = contextvars.copy_context()
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        return self.context.run(self.fn, *args, **kwargs)
+
+def sampled(rate=None):
+    """`extra=` for a high-frequency event kept with probability `rate` (LOG_SAMPLE_RATE by default)"""
+    return {'sample_rate': LOG_SAMPLE_RATE if rate is None else rate}
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the correlation ID and applies per-record sampling.
+
+    Runs on the emitting thread, where the request's context is still
+    current, before the record is handed to the writer thread.
+    """
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is not None and random.random() >= rate:
+            return False
+        # Records logged outside a request (background threads, startup) carry "-"
+        record.request_id = request_id.get() or '-'
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+    def prepare(self, record):
+        # Resolve the message and traceback now: args may be mutated after the
+        # call returns, and exc_info holds frames that should not outlive it
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with any `extra=` fields included"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # At shutdown wait for room behind a full backlog rather than failing to stop
+        self.queue.put(self._sentinel)
+
+_queue = None
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+def _output_handler():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+def _start_listener():
+    global _listener
+    _listener = _Listener(_queue, _output_handler())
+    _listener.start()
+
+def _after_fork():
+    # The parent's writer thread does not exist in the child, and its queue's
+    # locks may have been copied mid-use; give the child a fresh pair
+    global _queue
+    if _handler is None:
+        return
+    _queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler.queue = _queue
+    _start_listener()
+
+def configure():
+    """Route all logging through a bounded queue drained by a writer thread.
+
+    Emitting a record only stamps it and puts it on the queue, so request
+    threads never wait on stdout. Safe to call more than once; forked
+    workers get their own writer thread automatically.
+    """
+    global _queue, _handler
+    with _lock:
+        if _handler is not None:
+            return
+        _queue = queue.Queue(LOG_QUEUE_SIZE)
+        _handler = NonBlockingQueueHandler(_queue)
+        _handler.addFilter(ContextFilter())
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        root.handlers[:] = [_handler]
+        _start_listener()
+        os.register_at_fork(after_in_child=_after_fork)
+        atexit.register(stop)
+
+def stop():
+    """Write out queued records and stop the writer thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+Gauge('log_queue_depth', 'Log records waiting for the writer thread', lambda: _queue.qsize() if _queue else 0)
@@ -0,0 +1,212 @@
+import time
+import weakref
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+# Default latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric created through this module, in registration order
+REGISTRY = []
+
+class _Metric:
+    """Base class for metrics whose values are sharded per thread.
+
+    Each thread only ever writes to its own shard, so recording a value never
+    takes a lock. Shards are merged when the metrics are scraped. Once a
+    thread has exited its shard is folded into a shared total, so short-lived
+    threads (prefetches, the dev server's per-request threads) do not leave
+    one shard each behind.
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []        # (weak reference to the owning thread, shard)
+        self._retired = {}       # folded shards of threads that have exited
+        self._shards_lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            with self._shards_lock:
+                self._reap()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+    def _reap(self):
+        """Fold the shards of exited threads into the retired total; caller holds _shards_lock"""
+        live = []
+        for owner, shard in self._shards:
+            thread = owner()
+            if thread is not None and thread.is_alive():
+                live.append((owner, shard))
+            else:
+                # A thread that is no longer alive cannot write to its shard again
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def _merged(self):
+        """Return totals across every shard, keyed by label values"""
+        with self._shards_lock:
+            self._reap()
+            live = [shard for _, shard in self._shards]
+            merged = self._merge({}, self._retired)
+        for shard in live:
+            self._merge(merged, shard)
+        return merged
+
+    def _labels(self, labelvalues, extra=None):
+        pairs = list(zip(self.labelnames, labelvalues))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        body = ','.join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return '{' + body + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, value in list(shard.items()):
+            into[key] = into.get(key, 0) + value
+        return into
+
+    def values(self):
+        """Return the merged totals keyed by label values"""
+        return self._merged()
+
+    def _samples(self):
+        return [f'{self.name}{self._labels(key)} {_number(value)}' for key, value in sorted(self.values().items())]
+
+class Gauge(_Metric):
+    """Gauge whose value is computed by a callback at scrape time"""
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f'{self.name} {_number(value)}']
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        shard = self._shard()
+        row = shard.get(labelvalues)
+        if row is None:
+            # Per-bucket counts (last slot is +Inf), then sum and count
+            row = shard[labelvalues] = [0] * (len(self.buckets) + 3)
+        n = len(self.buckets)
+        row[bisect_left(self.buckets, value)] += 1
+        row[n + 1] += value
+        row[n + 2] += 1
+
+    def time(self, *labelvalues):
+        """Decorator that observes the wall time of each call"""
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labelvalues)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, row in list(shard.items()):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(row)
+            else:
+                for i, value in enumerate(row):
+                    total[i] += value
+        return into
+
+    def _samples(self):
+        lines = []
+        n = len(self.buckets)
+        for key, row in sorted(self._merged().items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (float('inf'),)):
+                cumulative += row[i]
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                lines.append(f'{self.name}_bucket{self._labels(key, ("le", le))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_number(row[n + 1])}')
+            lines.append(f'{self.name}_count{self._labels(key)} {row[n + 2]}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render_latest():
+    """Render every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics shared across modules
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Flask request latency by route',
+    ('route', 'method', 'status')
+)
+db_query_duration = Histogram(
+    'db_query_duration_seconds', 'Latency of database.py functions',
+    ('function',)
+)
+google_api_requests = Counter(
+    'google_api_requests_total', 'Outbound Google Places calls by endpoint and HTTP status',
+    ('endpoint', 'status')
+)
+google_api_duration = Histogram(
+    'google_api_request_duration_seconds', 'Latency of outbound Google Places calls',
+    ('endpoint',)
+)
+prefetch_outcomes = Counter(
+    'prefetch_total', 'Background next-page prefetch outcomes',
+    ('outcome',)
+)
+
+def timed_query(f):
+    """Decorator recording the latency of a database.py function"""
+    return db_query_duration.time(f.__name__)(f)
@@ -0,0 +1,153 @@
+import os
+import logging
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Hash cost configuration. The method string uses Werkzeug's format, e.g.
+# "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_SALT_LENGTH = int(os.getenv('PASSWORD_HASH_SALT_LENGTH', 16))
+
+# Number of hashing processes (0 hashes inline on the request thread)
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+# Maximum number of hash jobs queued or running before callers are rejected
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', 32))
+# Seconds a caller waits for a queue slot before giving up
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', 5))
+
+class PasswordHashUnavailable(Exception):
+    """Raised when a password cannot be hashed right now; callers answer 503"""
+
+class PasswordHashQueueFull(PasswordHashUnavailable):
+    """Raised when the hashing queue has no free slot"""
+
+_executor = None
+_executor_lock = threading.Lock()
+_queue_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_SIZE)
+
+hash_queue_wait = Histogram(
+    'password_hash_queue_wait_seconds', 'Time password hash jobs spend waiting for a worker'
+)
+hash_exec_time = Histogram(
+    'password_hash_exec_seconds', 'Time spent computing password hashes'
+)
+hash_rejected = Counter(
+    'password_hash_rejected_total', 'Password hash jobs rejected because the queue was full'
+)
+pool_restarts = Counter(
+    'password_hash_pool_restarts_total', 'Hashing process pools replaced after a worker died'
+)
+
+# Prefix Werkzeug writes for PASSWORD_HASH_METHOD, with its defaults filled
+# in (e.g. "scrypt" becomes "scrypt:32768:8:1"); set on first use
+_method_prefix = None
+
+def _get_executor():
+    """Create the hashing process pool on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # Spawn rather than fork so workers never inherit request threads or locks
+                _executor = ProcessPoolExecutor(
+                    max_workers=PASSWORD_HASH_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _executor
+
+def _discard_executor(broken):
+    """Drop a pool whose worker died, unless another thread already replaced it"""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+def _timed_generate(password, method, salt_length):
+    start = time.perf_counter()
+    result = generate_password_hash(password, method=method, salt_length=salt_length)
+    return result, time.perf_counter() - start
+
+def _timed_check(pwhash, password):
+    start = time.perf_counter()
+    result = check_password_hash(pwhash, password)
+    return result, time.perf_counter() - start
+
+def _record(queue_wait, exec_time):
+    hash_queue_wait.observe(queue_wait)
+    hash_exec_time.observe(exec_time)
+
+def _run(fn, *args):
+    """Run a hashing function in the pool, bounded by the queue size"""
+    if PASSWORD_HASH_WORKERS <= 0:
+        result, exec_time = fn(*args)
+        _record(0.0, exec_time)
+        return result
+
+    if not _queue_slots.acquire(timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        hash_rejected.inc()
+        raise PasswordHashQueueFull("Password hashing queue is full")
+    try:
+        # A worker killed mid-job (e.g. by the OOM killer) breaks the whole
+        # pool; start a fresh one and try once more
+        for _ in range(2):
+            executor = _get_executor()
+            submitted = time.perf_counter()
+            try:
+                result, exec_time = executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                pool_restarts.inc()
+                logger.warning("Password hashing pool broke, starting a new one")
+                _discard_executor(executor)
+                continue
+            total = time.perf_counter() - submitted
+            # Whatever was not spent hashing was spent queued or in IPC
+            _record(max(total - exec_time, 0.0), exec_time)
+            return result
+        raise PasswordHashUnavailable("Password hashing workers keep failing")
+    finally:
+        _queue_slots.release()
+
+def hash_password(password):
+    """Hash a password with the configured method and cost"""
+    return _run(_timed_generate, password, PASSWORD_HASH_METHOD, PASSWORD_HASH_SALT_LENGTH)
+
+def verify_password(pwhash, password):
+    """Check a password against a stored hash"""
+    return _run(_timed_check, pwhash, password)
+
+def method_prefix():
+    """Return the prefix hashes made with PASSWORD_HASH_METHOD start with"""
+    global _method_prefix
+    if _method_prefix is None:
+        # Werkzeug fills in omitted parameters itself, so ask it rather than parse the method
+        sample = generate_password_hash('', method=PASSWORD_HASH_METHOD, salt_length=1)
+        _method_prefix = sample.split('$', 1)[0]
+    return _method_prefix
+
+def needs_rehash(pwhash):
+    """Return True if a stored hash was made with different parameters than configured"""
+    return pwhash.split('$', 1)[0] != method_prefix()
+
+def warm_up():
+    """Start the hashing processes and resolve the method prefix ahead of the first login"""
+    method_prefix()
+    if PASSWORD_HASH_WORKERS > 0:
+        executor = _get_executor()
+        for future in [executor.submit(time.perf_counter) for _ in range(PASSWORD_HASH_WORKERS)]:
+            future.result()
+
+def shutdown(wait=True):
+    """Stop the hashing processes"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
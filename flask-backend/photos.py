@@ -0,0 +1,229 @@
+import io
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logs
+import places_api
+from metrics import Counter, Gauge, Histogram
+
+try:
+    from PIL import Image, features
+except ImportError:
+    # Without Pillow photos are fetched at the bucketed width and passed through
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Widths photos are served at; a requested max_width rounds up to the next bucket
+PHOTO_WIDTH_BUCKETS = tuple(sorted(
+    int(w) for w in os.getenv('PHOTO_WIDTH_BUCKETS', '200,400,800,1600').split(',')
+))
+# Width of the single original fetched from Google per photo_reference
+PHOTO_ORIGINAL_WIDTH = int(os.getenv('PHOTO_ORIGINAL_WIDTH', PHOTO_WIDTH_BUCKETS[-1]))
+# Encoder quality for resized JPEG/WebP/AVIF output
+PHOTO_QUALITY = int(os.getenv('PHOTO_QUALITY', 80))
+# Number of resized variants kept in memory
+PHOTO_VARIANT_CACHE_SIZE = int(os.getenv('PHOTO_VARIANT_CACHE_SIZE', 1000))
+# Total bytes of encoded variants kept in memory
+PHOTO_VARIANT_CACHE_MAX_BYTES = int(os.getenv('PHOTO_VARIANT_CACHE_MAX_BYTES', 64 * 2**20))
+# AVIF takes several times longer to encode than WebP, so it is never encoded
+# on the request thread: clients get the next accepted format until one of
+# these threads has added the AVIF variant to the cache. 0 never serves AVIF.
+PHOTO_AVIF_WORKERS = int(os.getenv('PHOTO_AVIF_WORKERS', 1))
+# Most AVIF encodes waiting for a thread; variants requested beyond it are skipped
+PHOTO_AVIF_QUEUE_SIZE = int(os.getenv('PHOTO_AVIF_QUEUE_SIZE', 100))
+
+CACHE_HEADERS = [('Cache-Control', 'public, max-age=86400'), ('Vary', 'Accept')]
+
+variant_cache = places_api.ResponseCache(
+    PHOTO_VARIANT_CACHE_SIZE, max_bytes=PHOTO_VARIANT_CACHE_MAX_BYTES, sizeof=places_api.photo_size
+)
+
+photo_variants = Counter(
+    'photo_variants_total', 'Photo proxy responses by how they were produced and their format',
+    ('source', 'format')
+)
+resize_duration = Histogram(
+    'photo_resize_seconds', 'Time to derive one resized photo variant from its original'
+)
+Gauge('photo_variant_cache_bytes', 'Bytes of encoded photo variants held in memory', lambda: variant_cache.bytes)
+
+def _supports(codec):
+    if Image is None:
+        return False
+    try:
+        return bool(features.check(codec))
+    except ValueError:
+        # Older Pillow releases do not know the codec at all
+        return False
+
+# Formats tried in order of preference when the client accepts them
+NEGOTIABLE_FORMATS = [(fmt, mime) for fmt, mime in (('AVIF', 'image/avif'), ('WEBP', 'image/webp'))
+                      if _supports(fmt.lower()) and (fmt != 'AVIF' or PHOTO_AVIF_WORKERS > 0)]
+# Formats only ever encoded in the background
+BACKGROUND_FORMATS = {'AVIF'}
+
+_executor = None
+_executor_lock = threading.Lock()
+# Variant keys queued or being encoded in the background
+_pending = set()
+_pending_lock = threading.Lock()
+
+# One lock per original being fetched, so concurrent requests share a single upstream call
+_fetch_locks = {}
+_fetch_locks_lock = threading.Lock()
+
+def bucket_width(max_width):
+    """Round a requested width up to the nearest configured bucket"""
+    try:
+        max_width = int(max_width)
+    except (TypeError, ValueError):
+        max_width = 400
+    for width in PHOTO_WIDTH_BUCKETS:
+        if width >= max_width:
+            return width
+    return PHOTO_WIDTH_BUCKETS[-1]
+
+def negotiate_format(accept, inline_only=False):
+    """Pick the output format from the Accept header, falling back to JPEG"""
+    accept = accept or ''
+    for fmt, mime in NEGOTIABLE_FORMATS:
+        if mime in accept and not (inline_only and fmt in BACKGROUND_FORMATS):
+            return fmt, mime
+    return 'JPEG', 'image/jpeg'
+
+def _fetch_original(photo_reference, api_key, user, session_id):
+    """Return (content, status, headers) of the full-size original, fetching it at most once"""
+    cache_key = (photo_reference, 'original')
+    with _fetch_locks_lock:
+        lock = _fetch_locks.setdefault(photo_reference, threading.Lock())
+    try:
+        with lock:
+            cached = places_api.photo_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            params = {"photoreference": photo_reference, "maxwidth": PHOTO_ORIGINAL_WIDTH, "key": api_key}
+            return places_api.get_photo(params, cache_key=cache_key, user=user, session_id=session_id)
+    finally:
+        with _fetch_locks_lock:
+            if _fetch_locks.get(photo_reference) is lock and not lock.locked():
+                del _fetch_locks[photo_reference]
+
+def _resize(original, width, fmt):
+    """Scale an image down to width (never up) and encode it as fmt"""
+    image = Image.open(io.BytesIO(original))
+    # Let the JPEG decoder downscale while decoding when the target is much smaller
+    image.draft('RGB', (width, width * image.height // max(image.width, 1)))
+    if image.width > width:
+        image = image.resize((width, max(image.height * width // image.width, 1)), Image.LANCZOS)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, fmt, quality=PHOTO_QUALITY)
+    return output.getvalue()
+
+def _derive(variant_key, original, mime, source):
+    """Resize and encode one variant of an original and cache it; returns the response, or None if undecodable"""
+    photo_reference, width, fmt = variant_key
+    start = time.perf_counter()
+    try:
+        content = _resize(original, width, fmt)
+    except OSError as e:
+        logger.warning("Could not resize photo: %s", e, extra=logs.sampled())
+        return None
+    resize_duration.observe(time.perf_counter() - start)
+
+    result = (content, 200, [('Content-Type', mime)] + CACHE_HEADERS)
+    variant_cache.put(variant_key, result)
+    photo_variants.inc(source, fmt.lower())
+    return result
+
+def _get_executor():
+    """Create the background encoding thread pool on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PHOTO_AVIF_WORKERS, thread_name_prefix='photo-encode')
+    return _executor
+
+def _encode_later(variant_key, mime):
+    """Queue a variant for background encoding unless it is already queued or the queue is full"""
+    with _pending_lock:
+        if variant_key in _pending or len(_pending) >= PHOTO_AVIF_QUEUE_SIZE:
+            return
+        _pending.add(variant_key)
+    try:
+        _get_executor().submit(logs.in_current_context(_encode_in_background), variant_key, mime)
+    except RuntimeError:
+        # Shutting down
+        with _pending_lock:
+            _pending.discard(variant_key)
+
+def _encode_in_background(variant_key, mime):
+    try:
+        # The original is cached by the request that queued this; skip it if already evicted
+        original = places_api.photo_cache.get((variant_key[0], 'original'))
+        if original is not None and original[1] == 200:
+            _derive(variant_key, original[0], mime, 'background')
+    finally:
+        with _pending_lock:
+            _pending.discard(variant_key)
+
+def shutdown(wait=False):
+    """Stop background encoding, dropping queued variants"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait, cancel_futures=True)
+            _executor = None
+
+def get_photo(photo_reference, max_width, accept, api_key, user=None, session_id=None):
+    """Return (content, status, headers) for a photo at a bucketed width in a negotiated format.
+
+    With Pillow installed one original per photo_reference is fetched from
+    Google and every width/format variant is derived from it locally and
+    cached. AVIF variants are encoded in the background (see
+    PHOTO_AVIF_WORKERS). Without Pillow the photo is fetched at the bucketed
+    width and passed through unchanged.
+    """
+    width = bucket_width(max_width)
+
+    if Image is None:
+        params = {"photoreference": photo_reference, "maxwidth": width, "key": api_key}
+        photo_variants.inc('passthrough', 'original')
+        return places_api.get_photo(params, cache_key=(photo_reference, str(width)),
+                                    user=user, session_id=session_id)
+
+    fmt, mime = negotiate_format(accept)
+    variant_key = (photo_reference, width, fmt)
+    cached = variant_cache.get(variant_key)
+    if cached is not None:
+        photo_variants.inc('cache', fmt.lower())
+        return cached
+
+    background = None
+    if fmt in BACKGROUND_FORMATS:
+        background = (variant_key, mime)
+        fmt, mime = negotiate_format(accept, inline_only=True)
+        variant_key = (photo_reference, width, fmt)
+        cached = variant_cache.get(variant_key)
+        if cached is not None:
+            photo_variants.inc('cache', fmt.lower())
+            _encode_later(*background)
+            return cached
+
+    content, status, headers = _fetch_original(photo_reference, api_key, user, session_id)
+    if status != 200:
+        return content, status, headers
+
+    result = _derive(variant_key, content, mime, 'resized')
+    if result is None:
+        # Not an image Pillow can decode; serve the original bytes as they came
+        photo_variants.inc('passthrough', 'original')
+        return content, status, headers
+    if background is not None:
+        _encode_later(*background)
+    return result
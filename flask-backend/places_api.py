@@ -0,0 +1,324 @@
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from metrics import Counter, Gauge, google_api_requests, google_api_duration
+from quota import quota_manager, QuotaExceeded, TokenBucket, parse_limit
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Base URL of the Places web service
+PLACES_BASE_URL = os.getenv('PLACES_BASE_URL', 'https://maps.googleapis.com/maps/api/place')
+
+# Path of each Places endpoint type, relative to PLACES_BASE_URL
+ENDPOINT_PATHS = {
+    'nearby': '/nearbysearch/json',
+    'details': '/details/json',
+    'autocomplete': '/autocomplete/json',
+    'photo': '/photo'
+}
+
+# Number of successful responses kept for serving when a budget is exhausted
+PLACES_CACHE_SIZE = int(os.getenv('PLACES_CACHE_SIZE', 2000))
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', 500))
+# Total bytes of photo originals kept; originals vary from tens of KB to MBs,
+# so this, not the entry count, is what bounds the cache's memory
+PHOTO_CACHE_MAX_BYTES = int(os.getenv('PHOTO_CACHE_MAX_BYTES', 128 * 2**20))
+
+# Seconds a cached JSON response is served as fresh, per endpoint.
+# Override with e.g. PLACES_CACHE_TTL_NEARBY=300, or 0 to always call Google.
+DEFAULT_CACHE_TTLS = {
+    'nearby': 600,        # open_now and ratings drift within minutes
+    'details': 3600,
+    'autocomplete': 86400
+}
+CACHE_TTLS = {
+    endpoint: float(os.getenv(f'PLACES_CACHE_TTL_{endpoint.upper()}', ttl))
+    for endpoint, ttl in DEFAULT_CACHE_TTLS.items()
+}
+# Past its TTL an entry is still served (and revalidated) for this many seconds
+PLACES_MAX_STALE = float(os.getenv('PLACES_MAX_STALE', 300))
+
+# Upstream budget for background revalidation as "calls/window_seconds"; "0" disables it
+PLACES_REFRESH_BUDGET = parse_limit(os.getenv('PLACES_REFRESH_BUDGET', '60/60'))
+# Seconds between refresher passes
+PLACES_REFRESH_INTERVAL = float(os.getenv('PLACES_REFRESH_INTERVAL', 5))
+# Entries are revalidated once they are this far through their TTL
+PLACES_REFRESH_AHEAD = 0.8
+
+# Keep-alive connections kept per Places host. By default every gunicorn
+# request thread, the tile fan-out pool and a couple of background fetches
+# can each hold one; beyond it connections are opened and thrown away.
+PLACES_POOL_SIZE = int(os.getenv(
+    'PLACES_POOL_SIZE', int(os.getenv('GUNICORN_THREADS', 32)) + int(os.getenv('FANOUT_WORKERS', 6)) + 2
+))
+
+# Shared session so outbound calls reuse keep-alive connections
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_maxsize=PLACES_POOL_SIZE))
+http_session.mount('http://', HTTPAdapter(pool_maxsize=PLACES_POOL_SIZE))
+
+stale_responses = Counter(
+    'places_stale_responses_total', 'Cached Places responses served because a budget was exhausted',
+    ('endpoint',)
+)
+cache_lookups = Counter(
+    'places_cache_lookups_total', 'Cached JSON Places lookups by endpoint and result (fresh, stale or miss)',
+    ('endpoint', 'result')
+)
+refreshes = Counter(
+    'places_refreshes_total', 'Background revalidations of cached Places responses by outcome',
+    ('endpoint', 'outcome')
+)
+
+class PlacesStatusError(Exception):
+    """Raised for a Places response whose status is an error, e.g. OVER_QUERY_LIMIT"""
+
+    def __init__(self, endpoint, status, error_message=None):
+        super().__init__(f"Google API Error: {status}" + (f" ({error_message})" if error_message else ""))
+        self.endpoint = endpoint
+        self.status = status
+        self.error_message = error_message
+
+    @property
+    def over_quota(self):
+        """Google refused the call for the project's quota or billing, not for the request itself"""
+        return self.status == 'OVER_QUERY_LIMIT'
+
+class ResponseCache:
+    """Thread-safe LRU of recent successful Places responses.
+
+    With max_bytes set, entries are also evicted to keep the total of
+    sizeof(value) within it; a value larger than the whole budget is not kept.
+    """
+
+    def __init__(self, max_size, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._entries) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.bytes -= self._sizes.pop(key)
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def __len__(self):
+        return len(self._entries)
+
+class CachedResponse:
+    """A cached JSON response plus what is needed to refetch it"""
+    __slots__ = ('data', 'fetched_at', 'params', 'kwargs', 'hits')
+
+    def __init__(self, data, params, kwargs):
+        self.data = data
+        self.fetched_at = time.monotonic()
+        self.params = params
+        self.kwargs = kwargs
+        # Reads since the last fetch; ranks entries for revalidation
+        self.hits = 0
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+response_cache = ResponseCache(PLACES_CACHE_SIZE)
+
+def photo_size(result):
+    """Bytes held by a cached (content, status, headers) photo response"""
+    return len(result[0])
+
+photo_cache = ResponseCache(PHOTO_CACHE_SIZE, max_bytes=PHOTO_CACHE_MAX_BYTES, sizeof=photo_size)
+
+def warm_up(timeout=3):
+    """Open a keep-alive connection to the Places host and start the cache refresher"""
+    try:
+        http_session.head(PLACES_BASE_URL, timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning("Could not pre-connect to Places API: %s", e)
+    refresher.start()
+
+def close():
+    """Stop the cache refresher and close pooled outbound connections"""
+    refresher.stop()
+    http_session.close()
+
+def get(endpoint, params, **kwargs):
+    """Make a GET request to a Places endpoint, recording count, latency and status"""
+    url = PLACES_BASE_URL + ENDPOINT_PATHS[endpoint]
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = http_session.get(url, params=params, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        google_api_duration.observe(time.perf_counter() - start, endpoint)
+        google_api_requests.inc(endpoint, status)
+
+def get_json(endpoint, params, cache_key=None, user=None, session_id=None, **kwargs):
+    """Call a JSON Places endpoint within its quota budgets.
+
+    Successful responses are remembered under `cache_key` and served without
+    calling Google while younger than the endpoint's TTL. For PLACES_MAX_STALE
+    seconds after that they are still served immediately, and the background
+    refresher revalidates them (the most read first) within its own budget.
+    When a budget is exhausted any remembered response is returned instead
+    of calling Google; without one, QuotaExceeded propagates to the caller.
+    """
+    entry = None
+    if cache_key is not None:
+        entry = response_cache.get((endpoint, cache_key))
+        if entry is not None:
+            entry.hits += 1
+            ttl = CACHE_TTLS.get(endpoint, 0)
+            age = entry.age()
+            if age < ttl:
+                cache_lookups.inc(endpoint, 'fresh')
+                return entry.data
+            if ttl and age < ttl + PLACES_MAX_STALE:
+                cache_lookups.inc(endpoint, 'stale')
+                return entry.data
+        cache_lookups.inc(endpoint, 'miss')
+
+    try:
+        quota_manager.acquire(endpoint, user=user, session_id=session_id)
+    except QuotaExceeded:
+        if entry is None:
+            raise
+        stale_responses.inc(endpoint)
+        return entry.data
+
+    data = get(endpoint, params, **kwargs).json()
+    if cache_key is not None and data.get('status') == 'OK':
+        response_cache.put((endpoint, cache_key), CachedResponse(data, params, kwargs))
+    return data
+
+class BackgroundRefresher:
+    """Revalidates the most read cached responses before they stop being served.
+
+    Every PLACES_REFRESH_INTERVAL seconds, entries that were read since their
+    last fetch and are past PLACES_REFRESH_AHEAD of their TTL are refetched,
+    most read first. Each refetch takes a token from the refresh budget and
+    from the endpoint's global quota, so revalidation can never starve user
+    traffic; entries nobody reads are left to expire.
+    """
+
+    def __init__(self, cache, budget=PLACES_REFRESH_BUDGET, interval=PLACES_REFRESH_INTERVAL):
+        self.cache = cache
+        self.interval = interval
+        self.bucket = TokenBucket(budget[0], budget[0] / budget[1]) if budget else None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def candidates(self):
+        """Return (key, entry) pairs due for revalidation, most read first"""
+        due = []
+        for key, entry in self.cache.items():
+            ttl = CACHE_TTLS.get(key[0], 0)
+            if ttl and entry.hits and entry.age() >= ttl * PLACES_REFRESH_AHEAD:
+                due.append((key, entry))
+        due.sort(key=lambda item: item[1].hits, reverse=True)
+        return due
+
+    def refresh_once(self):
+        """Revalidate due entries until the budget runs out; returns how many were refetched"""
+        refreshed = 0
+        for (endpoint, cache_key), entry in self.candidates():
+            self.bucket.refill(time.monotonic())
+            if self.bucket.tokens < 1:
+                break
+            try:
+                quota_manager.acquire(endpoint)
+            except QuotaExceeded:
+                refreshes.inc(endpoint, 'quota')
+                break
+            self.bucket.tokens -= 1
+            try:
+                data = get(endpoint, entry.params, **entry.kwargs).json()
+            except (requests.RequestException, ValueError) as e:
+                refreshes.inc(endpoint, 'error')
+                logger.warning("Could not refresh cached %s response: %s", endpoint, e, extra=logs.sampled())
+                continue
+            refreshed += 1
+            if data.get('status') != 'OK':
+                # Keep serving the old response until it runs out of staleness
+                refreshes.inc(endpoint, 'rejected')
+                continue
+            refreshes.inc(endpoint, 'success')
+            fresh = CachedResponse(data, entry.params, entry.kwargs)
+            # Carry half the read count over so popularity decays between fetches
+            fresh.hits = entry.hits // 2
+            self.cache.put((endpoint, cache_key), fresh)
+        return refreshed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.exception("Cache refresher pass failed")
+
+    def start(self):
+        if self.bucket is None or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='places-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+refresher = BackgroundRefresher(response_cache)
+
+Gauge('places_cache_entries', 'Cached JSON Places responses', lambda: len(response_cache))
+Gauge('photo_cache_bytes', 'Bytes of photo originals held in the photo cache', lambda: photo_cache.bytes)
+
+def get_photo(params, cache_key, user=None, session_id=None, **kwargs):
+    """Fetch a photo within its quota budgets, returning (content, status, headers)"""
+    try:
+        quota_manager.acquire('photo', user=user, session_id=session_id)
+    except QuotaExceeded:
+        cached = photo_cache.get(cache_key)
+        if cached is None:
+            raise
+        stale_responses.inc('photo')
+        return cached
+
+    response = get('photo', params, **kwargs)
+    result = (response.content, response.status_code, list(response.headers.items()))
+    if response.status_code == 200:
+        photo_cache.put(cache_key, result)
+    return result
@@ -0,0 +1,414 @@
+"""Push server for multiplayer battle rooms.
+
+Streams room state as Server-Sent Events and answers long-polls from one
+asyncio event loop, so an idle connection costs a socket and a parked
+coroutine rather than a gunicorn request thread. Rooms live in the database
+(see rooms.RoomStore): a single watcher task polls the versions of every
+room somebody is listening to in one query and fans each new state out to
+all of that room's connections, whichever worker made the change.
+
+gunicorn.conf.py starts it next to the workers; to run it on its own:
+    python push_server.py
+
+Endpoints (Authorization: Bearer <token>, like the API):
+    GET /api/rooms/<room_id>/events                 SSE; resumes after Last-Event-ID
+    GET /api/rooms/<room_id>?since=<v>&wait=<s>     long-poll for a version newer than v
+    GET /metrics
+"""
+import os
+import re
+import json
+import time
+import signal
+import asyncio
+import logging
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from dotenv import load_dotenv
+
+# Load environment variables before importing modules that read configuration
+load_dotenv()
+
+import logs
+logs.configure()
+
+import jwt
+from database import get_user
+from rooms import rooms
+from token_cache import token_cache
+from metrics import Counter, Gauge, render_latest, CONTENT_TYPE_LATEST
+
+logger = logging.getLogger(__name__)
+
+PUSH_HOST = os.getenv('PUSH_HOST', '0.0.0.0')
+# Defaults to the port after the API's
+PUSH_PORT = int(os.getenv('PUSH_PORT', int(os.getenv('PORT', 5001)) + 1))
+# Connections beyond this many are answered 503 straight away
+PUSH_MAX_CONNECTIONS = int(os.getenv('PUSH_MAX_CONNECTIONS', 10000))
+# Seconds between polls of the watched rooms' versions
+PUSH_POLL_INTERVAL = float(os.getenv('PUSH_POLL_INTERVAL', 0.25))
+# Threads running blocking work (token checks, room queries) off the event loop
+PUSH_DB_THREADS = int(os.getenv('PUSH_DB_THREADS', 4))
+# Time open streams and long-polls get to end after SIGTERM
+PUSH_SHUTDOWN_TIMEOUT = float(os.getenv('PUSH_SHUTDOWN_TIMEOUT', 5))
+
+# Longest a long-poll is held open, and the SSE heartbeat interval
+ROOM_LONG_POLL_SECONDS = 25
+ROOM_HEARTBEAT_SECONDS = 15
+# Event streams are closed after this long; EventSource reconnects with Last-Event-ID
+ROOM_STREAM_MAX_SECONDS = 300
+# Retry-After sent when the server already holds PUSH_MAX_CONNECTIONS
+PUSH_BUSY_RETRY_SECONDS = 5
+# A client that has not read what it was sent within this long is dropped
+PUSH_WRITE_TIMEOUT = 10
+# Time a client gets to send its request line and headers, and their size limit
+PUSH_REQUEST_TIMEOUT = 10
+PUSH_MAX_REQUEST_BYTES = 8192
+
+SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key')
+# The origins app.py allows
+CORS_ORIGINS = {
+    "https://foodfight-wuj7.onrender.com", "http://localhost:8081", "http://localhost:3000", "http://localhost:5000",
+    "http://localhost:19006", "http://localhost:19000", "http://localhost:19001"
+}
+
+ROOM_PATH = re.compile(r'^/api/rooms/([A-Za-z0-9_-]+)(/events)?$')
+
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+           405: 'Method Not Allowed', 503: 'Service Unavailable'}
+
+connections_rejected = Counter(
+    'push_connections_rejected_total', 'Push connections refused at PUSH_MAX_CONNECTIONS'
+)
+push_messages = Counter(
+    'push_messages_total', 'Room states sent to push clients, by transport',
+    ('transport',)
+)
+
+class PushRequest:
+    def __init__(self, method, path, query, headers):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+
+    def arg(self, name, convert=str):
+        """Return a query parameter passed through `convert`, or None if missing or malformed"""
+        try:
+            return convert(self.query[name][0])
+        except (KeyError, ValueError):
+            return None
+
+async def read_request(reader):
+    """Parse a request line and headers; raises ValueError for anything malformed"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    return PushRequest(method, url.path, parse_qs(url.query), headers)
+
+def authenticate(token):
+    """Return True if the token is valid and not revoked; runs on the executor"""
+    try:
+        claims = token_cache.decode(token, SECRET_KEY)
+    except jwt.InvalidTokenError:
+        return False
+    user = get_user(claims.get('username'))
+    return user is not None and not token_cache.revoked_for_user(claims, user)
+
+class RoomWatch:
+    """Latest known state of one room, shared by every connection listening to it"""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.listeners = 0
+        self.version = -1
+        self.state = None
+        # Closed or decided: streams end once they have sent this state
+        self.ended = False
+        self.gone = False
+        self._changed = asyncio.Event()
+
+    def update(self, version, state):
+        self.version = version
+        self.state = state
+        snapshot = json.loads(state)
+        self.ended = snapshot['closed'] or snapshot['winner'] is not None
+        self.notify()
+
+    def remove(self):
+        """Mark the room as deleted; its listeners end without another state"""
+        self.gone = self.ended = True
+        self.notify()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, since_version, timeout):
+        """Wait until the state moves past since_version (or timeout); True if it did"""
+        if self.version <= since_version and not self.gone:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.version > since_version
+
+class PushHub:
+    """Accepts push connections and fans room states out to them"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.watches = {}
+        self.connections = 0
+        self.draining = False
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def watch(self, room_id):
+        """Start listening to an open room; returns its RoomWatch, or None if there is none"""
+        watch = self.watches.get(room_id)
+        if watch is None:
+            snapshot = (await self.run_blocking(rooms.snapshots, [room_id])).get(room_id)
+            # Another connection may have started watching it meanwhile
+            watch = self.watches.get(room_id)
+            if watch is None:
+                if snapshot is None or json.loads(snapshot[1])['closed']:
+                    return None
+                watch = self.watches[room_id] = RoomWatch(room_id)
+                watch.update(snapshot[0], snapshot[1])
+        watch.listeners += 1
+        return watch
+
+    def unwatch(self, watch):
+        watch.listeners -= 1
+        if watch.listeners == 0 and self.watches.get(watch.room_id) is watch:
+            del self.watches[watch.room_id]
+
+    async def poll(self):
+        """Send new room states to their listeners; runs until the server stops"""
+        while True:
+            await asyncio.sleep(PUSH_POLL_INTERVAL)
+            if not self.watches:
+                continue
+            try:
+                await self._poll_once()
+            except Exception:
+                logger.exception("Error polling watched rooms")
+
+    async def _poll_once(self):
+        room_ids = list(self.watches)
+        versions = await self.run_blocking(rooms.versions, room_ids)
+        changed, expired = [], []
+        now = time.time()
+        # Rooms first watched while the query ran are not in it; they wait for the next poll
+        for room_id in room_ids:
+            watch = self.watches.get(room_id)
+            if watch is None:
+                continue
+            if room_id not in versions:
+                del self.watches[room_id]
+                watch.remove()
+                continue
+            version, round_deadline = versions[room_id]
+            if version > watch.version:
+                changed.append(room_id)
+            if round_deadline is not None and round_deadline <= now:
+                expired.append(room_id)
+
+        if changed:
+            for room_id, (version, state, _) in (await self.run_blocking(rooms.snapshots, changed)).items():
+                watch = self.watches.get(room_id)
+                if watch is not None and version > watch.version:
+                    watch.update(version, state)
+        # Rounds nobody finishes voting in close here; the new state goes out on the next poll
+        await asyncio.gather(*(self.run_blocking(rooms.close_expired_round, room_id) for room_id in expired))
+
+    def drain(self):
+        """End every open stream and long-poll, e.g. on shutdown"""
+        self.draining = True
+        for watch in self.watches.values():
+            watch.notify()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            if self.connections > PUSH_MAX_CONNECTIONS or self.draining:
+                connections_rejected.inc()
+                await self.respond(writer, None, 503, json.dumps({'error': 'Too many open connections, try again shortly'}),
+                                   {'Retry-After': str(PUSH_BUSY_RETRY_SECONDS)})
+                return
+            try:
+                request = await asyncio.wait_for(read_request(reader), PUSH_REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                return
+            await self.dispatch(request, writer)
+        except (ConnectionError, asyncio.TimeoutError):
+            # The client went away or stopped reading
+            pass
+        except Exception:
+            logger.exception("Error handling push request")
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        if request.method == 'OPTIONS':
+            await self.respond(writer, request, 204, '', {
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Authorization, Content-Type, Last-Event-ID',
+                'Access-Control-Max-Age': '600'
+            })
+            return
+        if request.method != 'GET':
+            await self.error(writer, request, 405, 'Method not allowed')
+            return
+        if request.path in ('/metrics', '/api/metrics'):
+            metrics_token = os.getenv('METRICS_TOKEN')
+            if metrics_token and request.headers.get('authorization', '').partition(' ')[2] != metrics_token:
+                await self.error(writer, request, 401, 'Unauthorized')
+                return
+            await self.respond(writer, request, 200, render_latest(), content_type=CONTENT_TYPE_LATEST)
+            return
+
+        match = ROOM_PATH.match(request.path)
+        if match is None:
+            await self.error(writer, request, 404, 'Not found')
+            return
+        token = request.headers.get('authorization', '').partition(' ')[2].strip()
+        if not token:
+            await self.error(writer, request, 401, 'Token is missing')
+            return
+        if not await self.run_blocking(authenticate, token):
+            await self.error(writer, request, 401, 'Token is invalid')
+            return
+
+        watch = await self.watch(match.group(1))
+        if watch is None:
+            await self.error(writer, request, 404, 'Room not found')
+            return
+        try:
+            if match.group(2):
+                await self.stream(writer, request, watch)
+            else:
+                await self.long_poll(writer, request, watch)
+        finally:
+            self.unwatch(watch)
+
+    async def long_poll(self, writer, request, watch):
+        since = request.arg('since', int)
+        if since is not None:
+            wait = request.arg('wait', float)
+            wait = ROOM_LONG_POLL_SECONDS if wait is None else min(max(wait, 0), ROOM_LONG_POLL_SECONDS)
+            if not self.draining:
+                await watch.wait(since, wait)
+        if watch.gone:
+            await self.error(writer, request, 404, 'Room not found')
+            return
+        push_messages.inc('long_poll')
+        await self.respond(writer, request, 200, watch.state)
+
+    async def stream(self, writer, request, watch):
+        try:
+            version = int(request.headers.get('last-event-id', -1))
+        except ValueError:
+            version = -1
+        await self.send(writer, self.head(request, 200, {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }))
+        stream_deadline = time.monotonic() + ROOM_STREAM_MAX_SECONDS
+        while not self.draining and time.monotonic() < stream_deadline:
+            if await watch.wait(version, ROOM_HEARTBEAT_SECONDS):
+                version = watch.version
+                push_messages.inc('sse')
+                await self.send(writer, f"id: {version}\nevent: state\ndata: {watch.state}\n\n".encode())
+            elif not watch.gone:
+                # Comment line keeps proxies from closing an idle connection
+                await self.send(writer, b": keepalive\n\n")
+            if watch.ended:
+                break
+
+    def head(self, request, status, headers):
+        lines = [f'HTTP/1.1 {status} {REASONS[status]}', 'Connection: close']
+        origin = request.headers.get('origin') if request is not None else None
+        if origin in CORS_ORIGINS:
+            lines += [f'Access-Control-Allow-Origin: {origin}', 'Access-Control-Allow-Credentials: true', 'Vary: Origin']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def respond(self, writer, request, status, body, headers=None, content_type='application/json'):
+        body = body.encode()
+        headers = dict(headers or {})
+        if body:
+            headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(len(body))
+        await self.send(writer, self.head(request, status, headers) + body)
+
+    async def error(self, writer, request, status, message):
+        await self.respond(writer, request, status, json.dumps({'error': message}))
+
+    async def send(self, writer, data):
+        writer.write(data)
+        await asyncio.wait_for(writer.drain(), PUSH_WRITE_TIMEOUT)
+
+# The running server's hub, for the gauges below
+hub = None
+
+Gauge('push_connections', 'Open push connections', lambda: hub.connections if hub else 0)
+Gauge('push_watched_rooms', 'Rooms with at least one push listener', lambda: len(hub.watches) if hub else 0)
+
+def raise_open_file_limit():
+    """Allow one descriptor per connection, up to the hard limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = PUSH_MAX_CONNECTIONS + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+async def serve(port=PUSH_PORT):
+    """Run the push server until SIGTERM or SIGINT (or cancellation)"""
+    global hub
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(PUSH_DB_THREADS, thread_name_prefix='push-db')
+    hub = PushHub(executor)
+    server = await asyncio.start_server(hub.handle, PUSH_HOST, port, limit=PUSH_MAX_REQUEST_BYTES, backlog=1024)
+    stop = asyncio.Event()
+    try:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+    except (ValueError, RuntimeError):
+        # Not the main thread, e.g. next to the development server
+        pass
+    poller = asyncio.create_task(hub.poll())
+    logger.info("Push server listening on %s:%d", PUSH_HOST, port)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        hub.drain()
+        deadline = time.monotonic() + PUSH_SHUTDOWN_TIMEOUT
+        while hub.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        poller.cancel()
+        executor.shutdown(wait=False)
+        logger.info("Push server stopped")
+
+def start_in_thread(port=PUSH_PORT):
+    """Run the push server on a daemon thread, e.g. next to the development server"""
+    thread = threading.Thread(target=asyncio.run, args=(serve(port),), name='push-server', daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == '__main__':
+    raise_open_file_limit()
+    asyncio.run(serve())
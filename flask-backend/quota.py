@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from metrics import Counter
+
+# Default budgets as (capacity, window_seconds): a bucket holds up to
+# `capacity` calls and refills evenly over `window_seconds`. Override with
+# e.g. PLACES_QUOTA_NEARBY_USER=30/3600, or "0" to disable a scope.
+DEFAULT_LIMITS = {
+    'nearby': {'global': (600, 60), 'user': (60, 3600), 'session': (20, 3600)},
+    'details': {'global': (300, 60), 'user': (100, 3600), 'session': None},
+    'autocomplete': {'global': (600, 60), 'user': (300, 3600), 'session': None},
+    'photo': {'global': (3000, 60), 'user': (1000, 3600), 'session': (300, 3600)}
+}
+
+# Price in USD per 1000 calls, used to report spend. Override with e.g. PLACES_PRICE_NEARBY=32
+DEFAULT_PRICES = {
+    'nearby': 32.0,
+    'details': 17.0,
+    'autocomplete': 2.83,
+    'photo': 7.0
+}
+
+PRICES = {
+    endpoint: float(os.getenv(f'PLACES_PRICE_{endpoint.upper()}', price))
+    for endpoint, price in DEFAULT_PRICES.items()
+}
+
+# Set to "0" to disable every budget, e.g. for load tests against a fake Places server
+PLACES_QUOTA_ENABLED = os.getenv('PLACES_QUOTA_ENABLED', '1') != '0'
+
+# Maximum number of per-user and per-session buckets kept in memory
+QUOTA_MAX_TRACKED = int(os.getenv('QUOTA_MAX_TRACKED', 10000))
+
+quota_denied = Counter(
+    'places_quota_denied_total', 'Places calls refused by the quota manager',
+    ('endpoint', 'scope')
+)
+places_spend = Counter(
+    'places_spend_usd_total', 'Estimated Google Places spend in USD',
+    ('endpoint',)
+)
+
+class QuotaExceeded(Exception):
+    """Raised when a Places call would exceed one of its budgets"""
+
+    def __init__(self, endpoint, scope, retry_after):
+        super().__init__(f"Places quota exceeded for {endpoint} ({scope})")
+        self.endpoint = endpoint
+        self.scope = scope
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def retry_after(self, cost=1):
+        """Seconds until `cost` tokens are available"""
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+def parse_limit(value):
+    """Parse a "capacity/window_seconds" budget; None when empty or "0" """
+    if not value or value == '0':
+        return None
+    capacity, _, window = value.partition('/')
+    return int(capacity), float(window or 60)
+
+class QuotaManager:
+    """Global, per-user and per-session token buckets for each Places endpoint"""
+
+    def __init__(self, limits=None, max_tracked=QUOTA_MAX_TRACKED):
+        self.limits = limits if limits is not None else self._limits_from_env()
+        self.max_tracked = max_tracked
+        self._global = {}
+        self._scoped = OrderedDict()  # (endpoint, scope, key) -> TokenBucket
+        self._lock = threading.Lock()
+        for endpoint, scopes in self.limits.items():
+            if scopes.get('global'):
+                self._global[endpoint] = self._new_bucket(scopes['global'])
+
+    @staticmethod
+    def _limits_from_env():
+        limits = {}
+        for endpoint, scopes in DEFAULT_LIMITS.items():
+            limits[endpoint] = {}
+            for scope, default in scopes.items():
+                if not PLACES_QUOTA_ENABLED:
+                    limits[endpoint][scope] = None
+                    continue
+                override = os.getenv(f'PLACES_QUOTA_{endpoint.upper()}_{scope.upper()}')
+                limits[endpoint][scope] = parse_limit(override) if override is not None else default
+        return limits
+
+    @staticmethod
+    def _new_bucket(limit):
+        capacity, window = limit
+        return TokenBucket(capacity, capacity / window)
+
+    def _scoped_bucket(self, endpoint, scope, key):
+        limit = self.limits.get(endpoint, {}).get(scope)
+        if limit is None or key is None:
+            return None
+        bucket_key = (endpoint, scope, key)
+        bucket = self._scoped.get(bucket_key)
+        if bucket is None:
+            bucket = self._scoped[bucket_key] = self._new_bucket(limit)
+            while len(self._scoped) > self.max_tracked:
+                self._scoped.popitem(last=False)
+        else:
+            self._scoped.move_to_end(bucket_key)
+        return bucket
+
+    def acquire(self, endpoint, user=None, session_id=None, cost=1):
+        """Take `cost` tokens from every applicable bucket, or raise QuotaExceeded"""
+        with self._lock:
+            now = time.monotonic()
+            buckets = [
+                ('global', self._global.get(endpoint)),
+                ('user', self._scoped_bucket(endpoint, 'user', user)),
+                ('session', self._scoped_bucket(endpoint, 'session', session_id))
+            ]
+            buckets = [(scope, bucket) for scope, bucket in buckets if bucket is not None]
+            # Check every bucket before consuming so a refusal costs nothing
+            for scope, bucket in buckets:
+                bucket.refill(now)
+                if bucket.tokens < cost:
+                    quota_denied.inc(endpoint, scope)
+                    raise QuotaExceeded(endpoint, scope, bucket.retry_after(cost))
+            for _, bucket in buckets:
+                bucket.tokens -= cost
+        places_spend.inc(endpoint, amount=cost * PRICES.get(endpoint, 0.0) / 1000)
+
+    def spend(self):
+        """Return the estimated spend in USD so far, keyed by endpoint"""
+        return {key[0]: value for key, value in places_spend.values().items()}
+
+quota_manager = QuotaManager()
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import secrets
+import database
+from metrics import Counter
+
+# Rooms idle for longer than this are discarded
+ROOM_TTL = int(os.getenv('ROOM_TTL', 3600))
+ROOM_MAX_PARTICIPANTS = int(os.getenv('ROOM_MAX_PARTICIPANTS', 20))
+# Seconds after the first vote before a round closes without the missing votes
+ROOM_ROUND_TIMEOUT = float(os.getenv('ROOM_ROUND_TIMEOUT', 30))
+# Fetch the next page once this few unseen restaurants remain
+ROOM_REFILL_THRESHOLD = 5
+# A page fetch claimed longer ago than this is presumed lost (e.g. with its
+# worker) and the next vote or read claims it again
+ROOM_FETCH_TIMEOUT = float(os.getenv('ROOM_FETCH_TIMEOUT', 30))
+
+rooms_created = Counter('battle_rooms_created_total', 'Multiplayer battle rooms created')
+
+class RoomError(Exception):
+    """Raised for invalid room operations; carries the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class Room:
+    """A battle shared by several users.
+
+    Every participant sees the same matchup. When all participants have voted
+    (or the round times out) the majority pick stays on as champion against
+    the next restaurant in the shared pool; ties keep the current champion.
+
+    A Room is a plain state machine loaded from and saved back to the
+    database by RoomStore, so any worker can serve any room. Deadlines are
+    wall-clock times for the same reason.
+    """
+
+    # Attributes saved with the room; place_ids is rebuilt from the pool
+    FIELDS = (
+        'id', 'owner', 'participants', 'pool', 'next_page_token', 'fetch_claimed_at', 'champion',
+        'challenger', 'next_index', 'round', 'votes', 'round_deadline', 'winner', 'closed', 'version', 'updated'
+    )
+
+    def __init__(self, room_id, owner, restaurants, next_page_token=None):
+        self.id = room_id
+        self.owner = owner
+        self.participants = {owner: time.time()}
+        self.pool = []
+        self.place_ids = set()
+        self.next_page_token = next_page_token
+        self.fetch_claimed_at = None
+        self.champion = 0
+        self.challenger = 1
+        self.next_index = 2
+        self.round = 1
+        self.votes = {}
+        self.round_deadline = None
+        self.winner = None
+        self.closed = False
+        self.version = 0
+        self.updated = time.time()
+        self.modified = False
+        self._add_restaurants(restaurants)
+
+    @classmethod
+    def from_dict(cls, data):
+        room = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(room, field, data[field])
+        room.place_ids = {restaurant["place_id"] for restaurant in room.pool}
+        room.modified = False
+        return room
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def _add_restaurants(self, restaurants):
+        for restaurant in restaurants:
+            if restaurant["place_id"] not in self.place_ids:
+                self.place_ids.add(restaurant["place_id"])
+                self.pool.append(restaurant)
+
+    def _changed(self):
+        """Bump the version subscribers compare against"""
+        self.version += 1
+        self.updated = time.time()
+        self.modified = True
+
+    @property
+    def finished(self):
+        return self.winner is not None
+
+    @property
+    def fetching(self):
+        return self.fetch_claimed_at is not None and time.time() - self.fetch_claimed_at < ROOM_FETCH_TIMEOUT
+
+    @property
+    def round_expired(self):
+        return self.round_deadline is not None and time.time() >= self.round_deadline
+
+    @property
+    def refill_due(self):
+        remaining = len(self.pool) - self.next_index
+        return bool(self.next_page_token) and not self.fetching and remaining < ROOM_REFILL_THRESHOLD
+
+    def join(self, username):
+        if username not in self.participants:
+            if len(self.participants) >= ROOM_MAX_PARTICIPANTS:
+                raise RoomError("Room is full", 409)
+            self.participants[username] = time.time()
+            self._changed()
+
+    def leave(self, username):
+        if self.participants.pop(username, None) is None:
+            return
+        self.votes.pop(username, None)
+        if not self.participants:
+            self.closed = True
+        elif username == self.owner:
+            self.owner = next(iter(self.participants))
+        self._close_round_if_complete()
+        self._changed()
+
+    def vote(self, username, place_id):
+        if self.finished:
+            raise RoomError("Battle is over", 409)
+        if username not in self.participants:
+            raise RoomError("Join the room before voting", 403)
+        if self.challenger is None:
+            raise RoomError("Waiting for more restaurants", 409)
+        matchup = {self.pool[self.champion]["place_id"], self.pool[self.challenger]["place_id"]}
+        if place_id not in matchup:
+            raise RoomError("Vote must be for one of the current restaurants")
+        self.votes[username] = place_id
+        if self.round_deadline is None:
+            self.round_deadline = time.time() + ROOM_ROUND_TIMEOUT
+        self._close_round_if_complete()
+        self._changed()
+
+    def _close_round_if_complete(self, force=False):
+        if self.finished or not self.votes:
+            return False
+        if not force and len(self.votes) < len(self.participants):
+            return False
+
+        champion_id = self.pool[self.champion]["place_id"]
+        champion_votes = sum(1 for v in self.votes.values() if v == champion_id)
+        if champion_votes * 2 < len(self.votes):
+            self.champion = self.challenger
+
+        self.votes = {}
+        self.round_deadline = None
+        self.round += 1
+        if self.next_index < len(self.pool):
+            self.challenger = self.next_index
+            self.next_index += 1
+        elif not self.next_page_token and not self.fetching:
+            self.winner = self.pool[self.champion]
+        else:
+            # More restaurants are on the way; park the challenger until they arrive
+            self.challenger = None
+        return True
+
+    def close_expired_round(self):
+        """Close the round if its vote deadline has passed"""
+        if self.round_expired and self._close_round_if_complete(force=True):
+            self._changed()
+
+    def claim_refill(self):
+        """Return the page token to fetch if the pool is running low, marking the room as fetching"""
+        if not self.refill_due:
+            return None
+        self.fetch_claimed_at = time.time()
+        self.modified = True
+        return self.next_page_token
+
+    def extend(self, restaurants, next_page_token):
+        """Add the next page of restaurants to the shared pool"""
+        self._add_restaurants(restaurants)
+        self.next_page_token = next_page_token
+        self.fetch_claimed_at = None
+        if self.challenger is None and not self.finished:
+            if self.next_index < len(self.pool):
+                self.challenger = self.next_index
+                self.next_index += 1
+            elif not self.next_page_token:
+                self.winner = self.pool[self.champion]
+        self._changed()
+
+    def state(self):
+        """Return the state every participant sees, as a JSON string"""
+        matchup = [self.pool[self.champion]]
+        if self.challenger is not None:
+            matchup.append(self.pool[self.challenger])
+        return json.dumps({
+            "room_id": self.id,
+            "version": self.version,
+            "round": self.round,
+            "owner": self.owner,
+            "participants": list(self.participants),
+            "matchup": [] if self.finished else matchup,
+            "voted": list(self.votes),
+            "votes_needed": len(self.participants),
+            "winner": self.winner,
+            "closed": self.closed
+        })
+
+    def row(self):
+        """Return the database row for this room"""
+        return {
+            'id': self.id,
+            'version': self.version,
+            'data': json.dumps(self.to_dict(), separators=(',', ':')),
+            'state': self.state(),
+            'round_deadline': self.round_deadline,
+            'updated_at': self.updated
+        }
+
+class RoomStore:
+    """Rooms kept in the database, so every worker and the push server share them.
+
+    Each change loads the room, applies it and writes it back in one
+    transaction holding the room's row lock, and bumps the version the push
+    server watches for.
+    """
+
+    def create(self, owner, restaurants, next_page_token):
+        self.expire()
+        while True:
+            room = Room(secrets.token_urlsafe(6), owner, restaurants, next_page_token)
+            if database.insert_room(room.row()):
+                rooms_created.inc()
+                return room
+
+    def get(self, room_id):
+        data = database.get_room(room_id)
+        if data is None:
+            raise RoomError("Room not found", 404)
+        room = Room.from_dict(json.loads(data))
+        if room.closed:
+            raise RoomError("Room not found", 404)
+        return room
+
+    def _update(self, room_id, action):
+        """Apply action(room) to the stored room; returns the room and what action returned"""
+        outcome = {}
+
+        def change(data):
+            room = Room.from_dict(json.loads(data))
+            if room.closed:
+                raise RoomError("Room not found", 404)
+            outcome['result'] = action(room)
+            outcome['room'] = room
+            return room.row() if room.modified else None
+
+        if not database.update_room(room_id, change):
+            raise RoomError("Room not found", 404)
+        return outcome['room'], outcome['result']
+
+    def join(self, room_id, username):
+        return self._update(room_id, lambda room: room.join(username))[0]
+
+    def leave(self, room_id, username):
+        return self._update(room_id, lambda room: room.leave(username))[0]
+
+    def vote(self, room_id, username, place_id):
+        """Record a vote; returns the room and the page token to fetch if it claimed a refill"""
+        def vote_and_claim(room):
+            room.vote(username, place_id)
+            return room.claim_refill()
+
+        return self._update(room_id, vote_and_claim)
+
+    def refresh(self, room_id):
+        """Return the room (with an expired round closed) and the page token to fetch if a refill is due"""
+        room = self.get(room_id)
+        if not room.round_expired and not room.refill_due:
+            return room, None
+
+        def close_and_claim(room):
+            room.close_expired_round()
+            return room.claim_refill()
+
+        return self._update(room_id, close_and_claim)
+
+    def close_expired_round(self, room_id):
+        """Close the room's round if its deadline has passed, e.g. when nobody votes again"""
+        try:
+            self._update(room_id, lambda room: room.close_expired_round())
+        except RoomError:
+            pass
+
+    def extend(self, room_id, restaurants, next_page_token):
+        try:
+            self._update(room_id, lambda room: room.extend(restaurants, next_page_token))
+        except RoomError:
+            # Closed or expired while the page was being fetched
+            pass
+
+    def versions(self, room_ids):
+        """Return {room_id: (version, round_deadline)} for the given rooms that still exist"""
+        return database.get_room_versions(room_ids)
+
+    def snapshots(self, room_ids):
+        """Return {room_id: (version, state JSON, round_deadline)} for the given rooms that still exist"""
+        return database.get_room_states(room_ids)
+
+    def expire(self):
+        """Drop rooms idle for longer than ROOM_TTL"""
+        database.delete_idle_rooms(time.time() - ROOM_TTL)
+
+rooms = RoomStore()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Set to "0" to keep battle sessions in memory only
+SESSION_CHECKPOINT_ENABLED = os.getenv('SESSION_CHECKPOINT_ENABLED', '1') == '1'
+SESSION_CHECKPOINT_PATH = os.getenv('SESSION_CHECKPOINT_PATH', 'session_checkpoint.db')
+# Seconds between checkpoints of the sessions changed since the last one
+SESSION_CHECKPOINT_INTERVAL = float(os.getenv('SESSION_CHECKPOINT_INTERVAL', 5))
+# Checkpointed sessions untouched for this long are not restored and get purged
+SESSION_CHECKPOINT_TTL = int(os.getenv('SESSION_CHECKPOINT_TTL', 86400))
+
+checkpoint_duration = Histogram(
+    'session_checkpoint_seconds', 'Time to write one battle session checkpoint'
+)
+checkpoint_writes = Counter(
+    'session_checkpoint_writes_total', 'Battle sessions written to or removed from the checkpoint',
+    ('action',)
+)
+session_restores = Counter(
+    'session_restores_total', 'Lookups of sessions missing from memory, by whether the checkpoint had them',
+    ('outcome',)
+)
+
+class SessionCheckpoint:
+    """Periodically checkpoints battle sessions to disk and restores them lazily.
+
+    Request handlers call touch() after changing a session. A background
+    thread writes the touched sessions every SESSION_CHECKPOINT_INTERVAL
+    seconds as zlib-compressed JSON rows in a small SQLite file. Resetting
+    a session goes through discard(), which deletes its row at once. After a restart
+    nothing is loaded up front: restore() reads a session back the first
+    time a request asks for it, so users keep their place without another
+    Nearby Search.
+
+    An in-progress page fetch is not saved; the restored session keeps its
+    page token and the next swipe starts the prefetch again.
+    """
+
+    def __init__(self, sessions, path=SESSION_CHECKPOINT_PATH, interval=SESSION_CHECKPOINT_INTERVAL,
+                 ttl=SESSION_CHECKPOINT_TTL, enabled=SESSION_CHECKPOINT_ENABLED):
+        self.sessions = sessions
+        self.path = path
+        self.interval = interval
+        self.ttl = ttl
+        self.enabled = enabled
+        self._dirty = set()
+        self._lock = threading.Lock()
+        # Held while reading, writing or deleting rows, so a discarded session
+        # cannot be written back by a checkpoint or read back by a restore
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_purge = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                updated REAL NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        return conn
+
+    def touch(self, session_id):
+        """Mark a session as changed (or removed) since the last checkpoint"""
+        if self.enabled:
+            with self._lock:
+                self._dirty.add(session_id)
+
+    def restore(self, session_id):
+        """Return the in-memory session, loading it from the checkpoint if needed"""
+        session_data = self.sessions.get(session_id)
+        if session_data is not None or not self.enabled:
+            return session_data
+
+        with self._io_lock:
+            try:
+                conn = self._connect()
+                try:
+                    row = conn.execute(
+                        'SELECT data FROM sessions WHERE session_id = ? AND updated >= ?',
+                        (session_id, time.time() - self.ttl)
+                    ).fetchone()
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.error("Error restoring session: %s", e)
+                return None
+
+            if row is None:
+                session_restores.inc('miss')
+                return None
+            session_restores.inc('hit')
+            session_data = json.loads(zlib.decompress(row[0]))
+            # The place_id index is stored as a list; older checkpoints lack it
+            session_data['place_ids'] = set(
+                session_data.get('place_ids') or (restaurant['place_id'] for restaurant in session_data['all'])
+            )
+            # Another request may have restored it meanwhile; keep whichever got there first
+            return self.sessions.setdefault(session_id, session_data)
+
+    def discard(self, session_id):
+        """Remove a session from memory and from the checkpoint, e.g. when it is reset"""
+        with self._io_lock:
+            self.sessions.pop(session_id, None)
+            if not self.enabled:
+                return
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.error("Error discarding session: %s", e)
+                # The next checkpoint deletes it instead
+                self.touch(session_id)
+                return
+            checkpoint_writes.inc('delete')
+
+    def _snapshot(self, session_data):
+        snapshot = dict(session_data)
+        snapshot['all'] = list(session_data['all'])
+        snapshot['place_ids'] = list(session_data.get('place_ids', ()))
+        snapshot['is_fetching'] = False
+        return zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode())
+
+    def checkpoint(self):
+        """Write every session touched since the last checkpoint"""
+        if not self.enabled:
+            return
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        purge = now - self._last_purge >= self.ttl / 24
+        if not dirty and not purge:
+            return
+
+        started = time.perf_counter()
+        upserts, deletes = [], []
+        with self._io_lock:
+            for session_id in dirty:
+                session_data = self.sessions.get(session_id)
+                if session_data is None:
+                    deletes.append((session_id,))
+                else:
+                    upserts.append((session_id, now, self._snapshot(session_data)))
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.executemany(
+                            'INSERT OR REPLACE INTO sessions (session_id, updated, data) VALUES (?, ?, ?)', upserts
+                        )
+                        conn.executemany('DELETE FROM sessions WHERE session_id = ?', deletes)
+                        if purge:
+                            conn.execute('DELETE FROM sessions WHERE updated < ?', (now - self.ttl,))
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.error("Error checkpointing %d sessions: %s", len(dirty), e)
+                # Try these sessions again on the next checkpoint
+                with self._lock:
+                    self._dirty |= dirty
+                return
+
+        if purge:
+            self._last_purge = now
+        checkpoint_writes.inc('write', amount=len(upserts))
+        checkpoint_writes.inc('delete', amount=len(deletes))
+        checkpoint_duration.observe(time.perf_counter() - started)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.checkpoint()
+
+    def start(self):
+        """Start the periodic checkpoint thread"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='session-checkpoint', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the checkpoint thread and write a final checkpoint"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.checkpoint()
@@ -0,0 +1,59 @@
+import os
+import signal
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+import password_hashing
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Hash in a one-process pool, torn down after the test"""
+    monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_WORKERS', 1)
+    monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    password_hashing.shutdown()
+    yield
+    password_hashing.shutdown()
+
+def restarts():
+    return password_hashing.pool_restarts.values().get((), 0)
+
+def test_hash_and_verify_in_pool(pool):
+    pwhash = password_hashing.hash_password('secret')
+    assert password_hashing.verify_password(pwhash, 'secret')
+    assert not password_hashing.verify_password(pwhash, 'wrong')
+
+def test_replaces_pool_after_worker_dies(pool):
+    pwhash = password_hashing.hash_password('secret')
+    broken = password_hashing._executor
+    for process in list(broken._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+    before = restarts()
+
+    assert password_hashing.verify_password(pwhash, 'secret')
+    assert password_hashing._executor is not broken
+    assert restarts() == before + 1
+    # The new pool keeps working
+    assert password_hashing.verify_password(pwhash, 'secret')
+
+def test_gives_up_when_pool_keeps_breaking(pool, monkeypatch):
+    class BrokenExecutor:
+        def submit(self, fn, *args):
+            raise BrokenProcessPool('worker died')
+
+        def shutdown(self, wait=True):
+            pass
+
+    monkeypatch.setattr(password_hashing, '_get_executor', BrokenExecutor)
+    with pytest.raises(password_hashing.PasswordHashUnavailable):
+        password_hashing.hash_password('secret')
+    # The queue slot is released even on failure
+    assert password_hashing._queue_slots.acquire(blocking=False)
+    password_hashing._queue_slots.release()
+
+def test_needs_rehash_matches_werkzeug_defaults(monkeypatch):
+    monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_WORKERS', 0)
+    monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_METHOD', 'scrypt')
+    monkeypatch.setattr(password_hashing, '_method_prefix', None)
+    pwhash = password_hashing.hash_password('secret')
+    assert not password_hashing.needs_rehash(pwhash)
+    assert password_hashing.needs_rehash('pbkdf2:sha256:600000$salt$hash')
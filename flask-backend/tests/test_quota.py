@@ -0,0 +1,76 @@
+import pytest
+import quota
+from quota import QuotaExceeded, QuotaManager, TokenBucket, parse_limit
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(quota, 'time', clock)
+    return clock
+
+def test_bucket_refills_continuously_up_to_capacity(clock):
+    bucket = TokenBucket(10, 2.0)
+    bucket.tokens = 0
+    clock.now += 1.5
+    bucket.refill(clock.now)
+    assert bucket.tokens == pytest.approx(3.0)
+    clock.now += 100
+    bucket.refill(clock.now)
+    assert bucket.tokens == 10
+
+def test_bucket_ignores_clock_going_backwards(clock):
+    bucket = TokenBucket(10, 1.0)
+    bucket.tokens = 5
+    bucket.refill(clock.now - 10)
+    assert bucket.tokens == 5
+
+def test_retry_after():
+    bucket = TokenBucket(10, 2.0)
+    assert bucket.retry_after() == 0.0
+    bucket.tokens = 0.5
+    assert bucket.retry_after(2) == pytest.approx(0.75)
+
+def test_denied_until_refilled(clock):
+    manager = QuotaManager({'nearby': {'global': (2, 60), 'user': None, 'session': None}})
+    manager.acquire('nearby')
+    manager.acquire('nearby')
+    with pytest.raises(QuotaExceeded) as excinfo:
+        manager.acquire('nearby')
+    assert excinfo.value.scope == 'global'
+    assert excinfo.value.retry_after == pytest.approx(30)
+
+    clock.now += 30
+    manager.acquire('nearby')
+    with pytest.raises(QuotaExceeded):
+        manager.acquire('nearby')
+
+def test_refusal_consumes_nothing(clock):
+    manager = QuotaManager({'nearby': {'global': (10, 60), 'user': (1, 3600), 'session': None}})
+    manager.acquire('nearby', user='alice')
+    with pytest.raises(QuotaExceeded) as excinfo:
+        manager.acquire('nearby', user='alice')
+    assert excinfo.value.scope == 'user'
+    assert manager._global['nearby'].tokens == 9
+    # Other users have their own bucket
+    manager.acquire('nearby', user='bob')
+
+def test_scoped_buckets_are_bounded(clock):
+    manager = QuotaManager({'photo': {'global': None, 'user': None, 'session': (1, 3600)}}, max_tracked=2)
+    for session_id in ('a', 'b', 'c'):
+        manager.acquire('photo', session_id=session_id)
+    assert len(manager._scoped) == 2
+    # The evicted session starts over with a full bucket
+    manager.acquire('photo', session_id='a')
+
+def test_parse_limit():
+    assert parse_limit('30/3600') == (30, 3600.0)
+    assert parse_limit('30') == (30, 60.0)
+    assert parse_limit('0') is None
+    assert parse_limit('') is None
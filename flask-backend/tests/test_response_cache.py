@@ -0,0 +1,41 @@
+from places_api import ResponseCache, photo_size
+
+def photo(size):
+    return (b'x' * size, 200, [('Content-Type', 'image/jpeg')])
+
+def test_evicts_least_recently_used_to_fit_byte_budget():
+    cache = ResponseCache(100, max_bytes=100, sizeof=photo_size)
+    cache.put('a', photo(40))
+    cache.put('b', photo(40))
+    cache.get('a')
+    cache.put('c', photo(40))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.bytes == 80
+
+def test_replacing_an_entry_updates_its_size():
+    cache = ResponseCache(100, max_bytes=100, sizeof=photo_size)
+    cache.put('a', photo(60))
+    cache.put('a', photo(10))
+    assert cache.bytes == 10
+    assert len(cache) == 1
+
+def test_value_larger_than_budget_is_not_kept():
+    cache = ResponseCache(100, max_bytes=100, sizeof=photo_size)
+    cache.put('a', photo(50))
+    cache.put('a', photo(500))
+    assert cache.get('a') is None
+    assert cache.bytes == 0
+
+def test_entry_count_still_applies():
+    cache = ResponseCache(2, max_bytes=1000, sizeof=photo_size)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, photo(10))
+    assert len(cache) == 2
+    assert cache.bytes == 20
+
+def test_without_byte_budget_only_counts_entries():
+    cache = ResponseCache(2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, {'results': []})
+    assert [key for key, _ in cache.items()] == ['b', 'c']
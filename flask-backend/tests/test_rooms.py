@@ -0,0 +1,76 @@
+import json
+import pytest
+import rooms
+from rooms import Room, RoomError
+
+def restaurants(*place_ids):
+    return [{'place_id': place_id, 'name': place_id} for place_id in place_ids]
+
+def matchup(room):
+    return [r['place_id'] for r in json.loads(room.state())['matchup']]
+
+def test_round_closes_when_everyone_has_voted():
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    room.join('bob')
+    room.vote('alice', 'b')
+    assert room.round == 1
+    room.vote('bob', 'b')
+    assert room.round == 2
+    assert matchup(room) == ['b', 'c']
+
+def test_tie_keeps_the_champion():
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    room.join('bob')
+    room.vote('alice', 'a')
+    room.vote('bob', 'b')
+    assert matchup(room) == ['a', 'c']
+
+def test_last_round_picks_the_winner():
+    room = Room('r1', 'alice', restaurants('a', 'b'))
+    room.vote('alice', 'b')
+    assert room.winner['place_id'] == 'b'
+    with pytest.raises(RoomError):
+        room.vote('alice', 'b')
+
+def test_vote_must_be_for_the_current_matchup():
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    with pytest.raises(RoomError):
+        room.vote('alice', 'c')
+    with pytest.raises(RoomError) as excinfo:
+        room.vote('mallory', 'a')
+    assert excinfo.value.status == 403
+
+def test_expired_round_closes_with_the_votes_cast(monkeypatch):
+    monkeypatch.setattr(rooms, 'ROOM_ROUND_TIMEOUT', 0)
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    room.join('bob')
+    room.vote('alice', 'b')
+    room.close_expired_round()
+    assert room.round == 2
+    assert matchup(room) == ['b', 'c']
+
+def test_parked_challenger_resumes_when_the_next_page_arrives():
+    room = Room('r1', 'alice', restaurants('a', 'b'), next_page_token='page2')
+    assert room.claim_refill() == 'page2'
+    assert room.claim_refill() is None
+    room.vote('alice', 'a')
+    assert room.challenger is None and not room.finished
+    room.extend(restaurants('a', 'c'), None)
+    assert matchup(room) == ['a', 'c']
+
+def test_round_trips_through_its_saved_form():
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    room.join('bob')
+    room.vote('alice', 'b')
+    loaded = Room.from_dict(json.loads(room.row()['data']))
+    assert loaded.state() == room.state()
+    assert loaded.place_ids == {'a', 'b', 'c'}
+    assert not loaded.modified
+
+def test_last_participant_leaving_closes_the_room():
+    room = Room('r1', 'alice', restaurants('a', 'b', 'c'))
+    room.join('bob')
+    room.leave('alice')
+    assert room.owner == 'bob'
+    room.leave('bob')
+    assert room.closed
@@ -0,0 +1,84 @@
+import pytest
+from session_store import SessionCheckpoint
+
+def make_session(*place_ids):
+    restaurants = [{'place_id': place_id, 'name': place_id} for place_id in place_ids]
+    return {'all': restaurants, 'place_ids': set(place_ids), 'index': 1, 'is_fetching': True}
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionCheckpoint({}, path=str(tmp_path / 'checkpoint.db'), interval=60, ttl=3600, enabled=True)
+
+def restart(store):
+    """A new process: same checkpoint file, empty memory"""
+    return SessionCheckpoint({}, path=store.path, interval=store.interval, ttl=store.ttl, enabled=True)
+
+def test_checkpointed_session_is_restored_after_restart(store):
+    store.sessions['s1'] = make_session('a', 'b')
+    store.touch('s1')
+    store.checkpoint()
+
+    restored = restart(store).restore('s1')
+    assert [r['place_id'] for r in restored['all']] == ['a', 'b']
+    assert restored['place_ids'] == {'a', 'b'}
+    assert restored['index'] == 1
+    # An in-progress page fetch is not carried over
+    assert restored['is_fetching'] is False
+
+def test_untouched_session_is_not_written(store):
+    store.sessions['s1'] = make_session('a')
+    store.checkpoint()
+    assert restart(store).restore('s1') is None
+
+def test_restore_prefers_the_session_in_memory(store):
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+    store.sessions['s1']['index'] = 5
+    assert store.restore('s1')['index'] == 5
+
+def test_discard_deletes_the_checkpoint_row(store):
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+
+    store.discard('s1')
+    assert 's1' not in store.sessions
+    assert store.restore('s1') is None
+    assert restart(store).restore('s1') is None
+
+def test_checkpoint_after_discard_does_not_bring_it_back(store):
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+    store.touch('s1')
+
+    store.discard('s1')
+    store.checkpoint()
+    assert restart(store).restore('s1') is None
+
+def test_removed_session_is_deleted_on_next_checkpoint(store):
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+    del store.sessions['s1']
+    store.touch('s1')
+    store.checkpoint()
+    assert restart(store).restore('s1') is None
+
+def test_expired_session_is_not_restored(store):
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+    stale = restart(store)
+    stale.ttl = -1
+    assert stale.restore('s1') is None
+
+def test_disabled_store_keeps_sessions_in_memory_only(tmp_path):
+    path = tmp_path / 'checkpoint.db'
+    store = SessionCheckpoint({}, path=str(path), enabled=False)
+    store.sessions['s1'] = make_session('a')
+    store.touch('s1')
+    store.checkpoint()
+    store.discard('s1')
+    assert not path.exists()
@@ -0,0 +1,89 @@
+import time
+import jwt
+import pytest
+from token_cache import VerifiedTokenCache, issued_at_ms
+
+SECRET = 'test-secret'
+
+def make_token(username, issued_at, lifetime=3600):
+    return jwt.encode(
+        {'username': username, 'iat': round(issued_at, 3), 'exp': int(issued_at + lifetime)},
+        SECRET, algorithm='HS256'
+    )
+
+def test_decode_caches_verified_claims():
+    cache = VerifiedTokenCache()
+    token = make_token('alice', time.time())
+    claims = cache.decode(token, SECRET)
+    assert cache.get(token) == claims
+    # A cached token skips verification, so even a wrong key succeeds
+    assert cache.decode(token, 'other-secret') == claims
+
+def test_invalid_token_is_not_cached():
+    cache = VerifiedTokenCache()
+    token = make_token('alice', time.time())
+    with pytest.raises(jwt.InvalidTokenError):
+        cache.decode(token, 'other-secret')
+    assert len(cache) == 0
+
+def test_expired_entry_is_dropped():
+    cache = VerifiedTokenCache()
+    cache.put('token', {'username': 'alice', 'exp': time.time() - 1})
+    assert cache.get('token') is None
+    assert len(cache) == 0
+
+def test_lru_eviction():
+    cache = VerifiedTokenCache(max_size=2)
+    for name in ('a', 'b'):
+        cache.put(name, {'username': name})
+    cache.get('a')
+    cache.put('c', {'username': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+def test_revocation_rejects_tokens_issued_up_to_it():
+    cache = VerifiedTokenCache()
+    now = time.time()
+    old = make_token('alice', now - 10)
+    cache.decode(old, SECRET)
+    revoked_at = int(now * 1000)
+    cache.revoke_user('alice', revoked_at)
+
+    assert cache.get(old) is None
+    with pytest.raises(jwt.InvalidTokenError):
+        cache.decode(old, SECRET)
+    # Same millisecond as the revocation is still revoked; one later is not
+    with pytest.raises(jwt.InvalidTokenError):
+        cache.decode(make_token('alice', revoked_at / 1000), SECRET)
+    assert cache.decode(make_token('alice', (revoked_at + 1) / 1000), SECRET)['username'] == 'alice'
+
+def test_sub_second_precision():
+    assert issued_at_ms({'iat': 1700000000.123}) == 1700000000123
+    assert issued_at_ms({'iat': 1700000000}) == 1700000000000
+    assert issued_at_ms({}) == 0
+
+def test_repeated_revocation_keeps_newer_tokens_cached():
+    cache = VerifiedTokenCache()
+    now = time.time()
+    revoked_at = int(now * 1000)
+    cache.revoke_user('alice', revoked_at)
+    fresh = make_token('alice', (revoked_at + 1) / 1000)
+    cache.decode(fresh, SECRET)
+    other = make_token('bob', now - 10)
+    cache.decode(other, SECRET)
+
+    # Every request re-applies the stored revocation time; that must not evict
+    cache.revoked_for_user(cache.get(fresh), {'username': 'alice', 'tokens_revoked_at': revoked_at})
+    cache.revoke_user('alice', revoked_at - 5)
+    assert cache.get(fresh) is not None
+
+    cache.revoke_user('alice', revoked_at + 10)
+    assert cache.get(fresh) is None
+    assert cache.get(other) is not None
+
+def test_revoked_for_user_applies_stored_time():
+    cache = VerifiedTokenCache()
+    now = time.time()
+    claims = cache.decode(make_token('alice', now - 10), SECRET)
+    assert not cache.revoked_for_user(claims, {'username': 'alice', 'tokens_revoked_at': None})
+    assert cache.revoked_for_user(claims, {'username': 'alice', 'tokens_revoked_at': int(now * 1000)})
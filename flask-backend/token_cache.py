@@ -0,0 +1,121 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import jwt
+
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+
+def issued_at_ms(claims):
+    """Return a token's iat in epoch milliseconds; tokens without one count as issued at the epoch"""
+    return round(float(claims.get('iat', 0)) * 1000)
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of verified JWT digests mapped to their claims.
+
+    Entries are valid until the token's own expiry, so a cache hit can skip
+    signature verification without extending the token's lifetime. It also
+    holds the latest known revocation time per user, so tokens issued before
+    it can be rejected without a database read.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # digest -> (claims, exp)
+        self._by_username = {}         # username -> set of digests
+        self._revoked_at = {}          # username -> epoch ms tokens were last revoked at
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """Return cached claims for a token, or None if unknown or expired"""
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            claims, exp = entry
+            if exp is not None and exp <= time.time():
+                self._discard(digest, claims)
+                return None
+            self._entries.move_to_end(digest)
+            return claims
+
+    def put(self, token, claims):
+        """Remember the claims of a token whose signature has been verified"""
+        digest = self._digest(token)
+        exp = claims.get('exp')
+        with self._lock:
+            self._entries[digest] = (claims, exp)
+            self._entries.move_to_end(digest)
+            self._by_username.setdefault(claims.get('username'), set()).add(digest)
+            while len(self._entries) > self.max_size:
+                old_digest, (old_claims, _) = self._entries.popitem(last=False)
+                self._forget_username(old_digest, old_claims)
+
+    def decode(self, token, secret_key):
+        """Return a token's verified claims, raising jwt.InvalidTokenError if invalid or revoked"""
+        # Tokens seen before skip signature verification until they expire
+        claims = self.get(token)
+        if claims is None:
+            claims = jwt.decode(token, secret_key, algorithms=["HS256"])
+            self.put(token, claims)
+        if self.is_revoked(claims):
+            raise jwt.InvalidTokenError('Token has been revoked')
+        return claims
+
+    def revoked_for_user(self, claims, user):
+        """Return True if the token is revoked by its user's stored revocation time"""
+        # The stored time also covers revocations made by other processes;
+        # recording one the cache already knows is a no-op
+        if user['tokens_revoked_at'] is not None:
+            self.revoke_user(user['username'], user['tokens_revoked_at'])
+        return self.is_revoked(claims)
+
+    def revoke_user(self, username, revoked_at=None):
+        """Reject a user's tokens issued at or before `revoked_at` (epoch ms, now by default).
+
+        Repeating a revocation that is already known changes nothing, so the
+        user's newer tokens stay cached.
+        """
+        revoked_at = int(time.time() * 1000) if revoked_at is None else revoked_at
+        with self._lock:
+            if revoked_at <= self._revoked_at.get(username, -1):
+                return
+            self._revoked_at[username] = revoked_at
+            for digest in list(self._by_username.get(username, ())):
+                claims, _ = self._entries[digest]
+                if issued_at_ms(claims) <= revoked_at:
+                    self._discard(digest, claims)
+
+    def is_revoked(self, claims):
+        """Return True if the token was issued at or before its user's last revocation"""
+        revoked_at = self._revoked_at.get(claims.get('username'))
+        return revoked_at is not None and issued_at_ms(claims) <= revoked_at
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_username.clear()
+            self._revoked_at.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, digest, claims):
+        self._entries.pop(digest, None)
+        self._forget_username(digest, claims)
+
+    def _forget_username(self, digest, claims):
+        digests = self._by_username.get(claims.get('username'))
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_username[claims.get('username')]
+
+token_cache = VerifiedTokenCache()
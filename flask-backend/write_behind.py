@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import logging
+import threading
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Write-behind is opt-in; mutations are committed synchronously otherwise
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', '0') == '1'
+# How often queued mutations are flushed, in milliseconds
+WRITE_BEHIND_INTERVAL_MS = float(os.getenv('WRITE_BEHIND_INTERVAL_MS', 5))
+# Directory holding the journal segments that make queued mutations durable
+WRITE_BEHIND_JOURNAL_DIR = os.getenv('WRITE_BEHIND_JOURNAL_DIR', 'write_behind_journal')
+# Set to "0" to skip fsync per mutation (faster, but a crash can lose queued writes)
+WRITE_BEHIND_FSYNC = os.getenv('WRITE_BEHIND_FSYNC', '1') != '0'
+
+# File in the journal directory collecting ops the database rejected, one JSON object per line
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+batch_size = Histogram(
+    'write_behind_batch_size', 'Mutations committed per write-behind transaction',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+flush_duration = Histogram(
+    'write_behind_flush_seconds', 'Time to commit one write-behind batch'
+)
+coalesced = Counter(
+    'write_behind_coalesced_total', 'Queued mutations superseded before being written'
+)
+flush_failures = Counter(
+    'write_behind_flush_failures_total', 'Write-behind batches that failed and were retried op by op'
+)
+dead_letters = Counter(
+    'write_behind_dead_letters_total', 'Queued mutations the database rejected, set aside in the dead-letter file'
+)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class WriteBehindQueue:
+    """Coalescing write-behind queue backed by an append-only journal.
+
+    A mutation is an op dict with an `owner` (e.g. ["user", 7]), a `key`
+    unique within the owner, an `action` ("put" or "delete") and its `data`.
+    Only the latest op per (owner, key) is kept, so an add followed by a
+    remove writes just the remove. Every op is appended to the journal
+    (and fsynced) before submit() returns, and journal segments are deleted
+    only after the batch they cover has committed. Concurrent submitters
+    share one fsync, taken outside the lock that reads and the flusher use.
+
+    `validate(op)` raises ValueError for an op the database would reject, so
+    it is refused up front rather than acknowledged and lost. When a batch
+    still fails, its ops are retried one per transaction: ops failing with an
+    error `is_permanent(error)` accepts go to the dead-letter file, and the
+    first op failing any other way (the database is likely down) sends the
+    rest back to the queue to be retried with backoff.
+    """
+
+    def __init__(self, apply_batch, journal_dir=WRITE_BEHIND_JOURNAL_DIR,
+                 interval=WRITE_BEHIND_INTERVAL_MS / 1000, fsync=WRITE_BEHIND_FSYNC,
+                 validate=None, is_permanent=None):
+        self.apply_batch = apply_batch
+        self.journal_dir = journal_dir
+        self.interval = interval
+        self.fsync = fsync
+        self.validate = validate
+        self.is_permanent = is_permanent or (lambda error: False)
+        self._pending = {}       # owner -> {key: op}, in submission order
+        self._inflight = {}      # the same, for ops being committed by the flusher
+        self._uncommitted_segments = []
+        self._segment = None
+        self._segment_seq = 0
+        self._lock = threading.Condition()
+        # Journal lines appended and known durable; whoever holds _sync_lock
+        # fsyncs on behalf of every line written so far
+        self._written = 0
+        self._synced = 0
+        self._sync_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Replay journals left by dead processes, then start the flusher thread"""
+        os.makedirs(self.journal_dir, exist_ok=True)
+        try:
+            self._replay_orphans()
+        except Exception:
+            # Journals stay on disk for the next start; serving must not depend on them
+            logger.exception("Could not replay write-behind journals")
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        return self
+
+    def _segment_path(self, seq):
+        return os.path.join(self.journal_dir, f'wb-{os.getpid()}-{seq:08d}.journal')
+
+    def _open_segment(self):
+        self._segment_seq += 1
+        path = self._segment_path(self._segment_seq)
+        self._segment = (path, open(path, 'a', encoding='utf-8'))
+
+    def _replay_orphans(self):
+        orphans = []
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not name.startswith('wb-') or not name.endswith('.journal'):
+                continue
+            pid = int(name.split('-')[1])
+            if pid == os.getpid() or not _pid_alive(pid):
+                orphans.append(os.path.join(self.journal_dir, name))
+        if not orphans:
+            return
+
+        ops = {}
+        for path in orphans:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line was never acknowledged to the client
+                        continue
+                    ops.setdefault(tuple(op['owner']), {})[op['key']] = op
+        ops = [op for owner_ops in ops.values() for op in owner_ops.values()]
+        logger.info("Replaying %d journaled writes from %d segments", len(ops), len(orphans))
+        # Ops are idempotent, so a replay racing another worker's replay is harmless
+        retry = self._commit(ops)
+        if retry:
+            # Hand what could not be written to the flusher; the segments go once it succeeds
+            self._pending = self._group(retry)
+            self._uncommitted_segments.extend(orphans)
+            return
+        self._remove_segments(orphans)
+
+    @staticmethod
+    def _remove_segments(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker replayed the same orphans
+                pass
+
+    def _commit(self, ops):
+        """Commit ops, isolating any the database rejects; returns the ops to retry later"""
+        try:
+            self.apply_batch(ops)
+            return []
+        except Exception as e:
+            flush_failures.inc()
+            logger.error("Write-behind flush of %d ops failed: %s", len(ops), e)
+            error = e
+        if len(ops) > 1:
+            for i, op in enumerate(ops):
+                try:
+                    self.apply_batch([op])
+                except Exception as e:
+                    if not self.is_permanent(e):
+                        return ops[i:]
+                    self._dead_letter(op, e)
+            return []
+        if not self.is_permanent(error):
+            return ops
+        self._dead_letter(ops[0], error)
+        return []
+
+    def _dead_letter(self, op, error):
+        """Set aside an op the database rejects so it stops holding up the queue"""
+        entry = json.dumps({'op': op, 'error': str(error), 'failed_at': time.time()}) + '\n'
+        with open(os.path.join(self.journal_dir, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+            f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+        dead_letters.inc()
+        logger.error("Moved write-behind op %s of %s to the dead-letter file: %s", op['key'], op['owner'], error)
+
+    @staticmethod
+    def _group(ops):
+        """Index ops as {owner: {key: op}}"""
+        grouped = {}
+        for op in ops:
+            grouped.setdefault(tuple(op['owner']), {})[op['key']] = op
+        return grouped
+
+    def submit(self, op):
+        """Durably queue a mutation; returns once it is journaled, raises ValueError if it is invalid"""
+        if self.validate is not None:
+            self.validate(op)
+        line = json.dumps(op) + '\n'
+        owner = tuple(op['owner'])
+        with self._lock:
+            self._segment[1].write(line)
+            self._written += 1
+            seq = self._written
+            owner_ops = self._pending.setdefault(owner, {})
+            if owner_ops.pop(op['key'], None) is not None:
+                coalesced.inc()
+            owner_ops[op['key']] = op
+            self._lock.notify()
+        self._sync(seq)
+
+    def _sync(self, seq):
+        """Make the journal durable up to line `seq`, fsyncing for every waiting submitter at once"""
+        if self._synced >= seq:
+            # Another submitter's fsync already covered this line
+            return
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            with self._lock:
+                f = self._segment[1]
+                f.flush()
+                written = self._written
+            # The segment cannot be rotated (closed) while _sync_lock is held
+            if self.fsync:
+                os.fsync(f.fileno())
+            self._synced = written
+
+    def overlay(self, owner):
+        """Return the queued ops for an owner, oldest first, for read-your-writes"""
+        owner = tuple(owner)
+        with self._lock:
+            inflight = self._inflight.get(owner)
+            pending = self._pending.get(owner)
+            if not inflight and not pending:
+                return []
+            ops = dict(inflight or ())
+            ops.update(pending or ())
+            return list(ops.values())
+
+    def discard_owner(self, owner):
+        """Drop queued ops for an owner that is being deleted, after any in-flight commit"""
+        owner = tuple(owner)
+        with self._lock:
+            while owner in self._inflight:
+                self._lock.wait()
+            self._pending.pop(owner, None)
+
+    def __len__(self):
+        return sum(map(len, self._pending.values())) + sum(map(len, self._inflight.values()))
+
+    def _take_batch(self):
+        """Swap out pending ops and rotate the journal"""
+        with self._sync_lock:
+            with self._lock:
+                self._inflight = self._pending
+                self._pending = {}
+                path, f = self._segment
+                segments = self._uncommitted_segments + [path]
+                self._uncommitted_segments = []
+                self._open_segment()
+                written = self._written
+            # Lines of the old segment still waiting on _sync are made durable here
+            f.flush()
+            if self.fsync and self._synced < written:
+                os.fsync(f.fileno())
+            f.close()
+            self._synced = written
+        ops = [op for owner_ops in self._inflight.values() for op in owner_ops.values()]
+        return ops, segments
+
+    def _run(self):
+        backoff = self.interval
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopping:
+                    self._lock.wait()
+                if self._stopping and not self._pending:
+                    return
+            # Let more mutations accumulate into this batch
+            time.sleep(backoff)
+            ops, segments = self._take_batch()
+
+            start = time.perf_counter()
+            try:
+                retry = self._commit(ops)
+            except OSError as e:
+                # The dead-letter file could not be written; keep everything queued
+                logger.error("Could not write the write-behind dead-letter file: %s", e)
+                retry = ops
+            if retry:
+                with self._lock:
+                    # Newer ops for the same keys win over the failed ones
+                    restored = self._group(retry)
+                    for owner, owner_ops in self._pending.items():
+                        restored.setdefault(owner, {}).update(owner_ops)
+                    self._pending = restored
+                    self._inflight = {}
+                    self._uncommitted_segments = segments + self._uncommitted_segments
+                    self._lock.notify_all()
+                backoff = min(backoff * 2, 5.0)
+                if self._stopping:
+                    return
+                continue
+
+            flush_duration.observe(time.perf_counter() - start)
+            batch_size.observe(len(ops))
+            backoff = self.interval
+            with self._lock:
+                self._inflight = {}
+                self._lock.notify_all()
+            self._remove_segments(segments)
+
+    def stop(self, timeout=10):
+        """Flush everything still queued and stop the flusher"""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._sync_lock, self._lock:
+            path, f = self._segment
+            f.close()
+            if not self._pending and not self._uncommitted_segments:
+                os.remove(path)
+
+Gauge('write_behind_pending', 'Mutations queued but not yet committed', lambda: len(queue) if queue else 0)
+
+# The process-wide queue, created by start() when WRITE_BEHIND_ENABLED is set
+queue = None
+_queue_lock = threading.Lock()
+
+def start(apply_batch, validate=None, is_permanent=None):
+    """Create and start the process-wide queue if write-behind is enabled"""
+    global queue
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    with _queue_lock:
+        if queue is None:
+            queue = WriteBehindQueue(apply_batch, validate=validate, is_permanent=is_permanent).start()
+    return queue
+
+def stop():
+    global queue
+    with _queue_lock:
+        if queue is not None:
+            queue.stop()
+            queue = None